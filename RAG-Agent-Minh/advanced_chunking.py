@@ -1,54 +1,96 @@
 import re
-import nltk
+import bisect
+from collections import Counter
 from typing import List, Dict, Any
 import logging
+from model_loader import sent_tokenize
+from near_duplicates import find_near_duplicates, DEFAULT_SIMILARITY_THRESHOLD
+from entity_matcher import get_matcher
 
-# Download required NLTK resources if not already present
-try:
-    nltk.data.find('tokenizers/punkt')
-except LookupError:
-    nltk.download('punkt', quiet=True)
+# Common heading patterns in documents, matched in a single pass
+HEADING_PATTERN = re.compile(
+    r'^#+[ \t]+(?P<markdown>.+?)[ \t]*$'  # Markdown heading
+    r'|^(?P<numbered>\d+\..*?)$'  # Numbered section
+    r'|^(?P<caps>[A-Z][A-Z \t]+)$'  # ALL CAPS heading
+    r'|^(?P<underlined>.+?)\n[=\-]{3,}[ \t]*$',  # Underlined heading
+    re.MULTILINE
+)
+
+PARAGRAPH_BREAK = re.compile(r'\n\n')
+
+def split_sentences(text: str, offset: int = 0) -> List[Dict[str, Any]]:
+    """Tokenise text into sentences with character offsets and word counts."""
+    sentences = []
+    cursor = 0
+    for sentence in sent_tokenize(text):
+        start = text.find(sentence, cursor)
+        if start < 0:
+            start = cursor
+        end = start + len(sentence)
+        cursor = end
+        sentences.append({
+            "text": sentence,
+            "start": offset + start,
+            "end": offset + end,
+            "words": len(sentence.split())
+        })
+    return sentences
+
+def analyze_document(text: str) -> Dict[str, Any]:
+    """Single analysis pass shared by all chunking strategies.
+
+    Tokenises sentences once and records their character offsets and word
+    counts, together with the position of every heading in the document.
+    """
+    sentences = split_sentences(text)
+    headings = [(match.start(), match.group(match.lastgroup)) for match in HEADING_PATTERN.finditer(text)]
+    return {
+        "text": text,
+        "sentences": sentences,
+        "sentence_starts": [sentence["start"] for sentence in sentences],
+        "headings": headings
+    }
+
+def section_spans(analysis: Dict[str, Any]) -> List[tuple]:
+    """Returns (title, start, end) character spans of the document's sections."""
+    text = analysis["text"]
+    headings = analysis["headings"]
 
-def extract_sections_by_headings(text: str) -> List[tuple]:
-    """Extract sections from document based on headings."""
-    # Common heading patterns in documents
-    heading_patterns = [
-        r'\n#+\s+(.+?)\n',  # Markdown heading
-        r'\n(\d+\..*?)\n',  # Numbered section
-        r'\n([A-Z][A-Z\s]+)\n',  # ALL CAPS heading
-        r'\n(.+?)\n[=\-]{3,}\n'  # Underlined heading
-    ]
-
-    # Find all potential section headings
-    all_headings = []
-    for pattern in heading_patterns:
-        for match in re.finditer(pattern, '\n' + text + '\n'):
-            all_headings.append((match.start(), match.group(1)))
-    
-    # Sort headings by position
-    all_headings.sort()
-    
     # If no headings found, treat the whole document as one section
-    if not all_headings:
-        return [("Document", text)]
-    
-    # Extract sections based on headings
-    sections = []
-    for i, (pos, title) in enumerate(all_headings):
-        start_pos = pos
+    if not headings:
+        return [("Document", 0, len(text))]
+
+    spans = []
+    for i, (pos, title) in enumerate(headings):
         # Determine end of current section (start of next section or end of text)
-        end_pos = all_headings[i+1][0] if i < len(all_headings) - 1 else len(text)
-        # Extract content between headings
-        content = text[start_pos:end_pos].strip()
-        if content:
-            sections.append((title.strip(), content))
-    
-    return sections
+        end_pos = headings[i+1][0] if i < len(headings) - 1 else len(text)
+        if text[pos:end_pos].strip():
+            spans.append((title.strip(), pos, end_pos))
+    return spans
+
+def sentences_in_span(analysis: Dict[str, Any], start: int, end: int) -> List[Dict[str, Any]]:
+    """Returns the analysed sentences that start inside a character span."""
+    starts = analysis["sentence_starts"]
+    first = bisect.bisect_left(starts, start)
+    last = bisect.bisect_left(starts, end)
+    return analysis["sentences"][first:last]
+
+def extract_sections_by_headings(text: str, analysis: Dict[str, Any] = None) -> List[tuple]:
+    """Extract sections from document based on headings."""
+    if analysis is None:
+        analysis = analyze_document(text)
+    return [(title, text[start:end].strip()) for title, start, end in section_spans(analysis)]
 
-def topic_based_chunking(text: str, metadata: Dict[str, Any], max_chunk_size: int = 500) -> List[Dict]:
+def topic_based_chunking(text: str, metadata: Dict[str, Any], max_chunk_size: int = 500, offset: int = 0) -> List[Dict]:
     """Split long text into coherent topic-based chunks."""
-    # Split into paragraphs
-    paragraphs = [p for p in text.split('\n\n') if p.strip()]
+    # Split into paragraphs, keeping their character offsets
+    paragraphs = []
+    para_start = 0
+    for match in PARAGRAPH_BREAK.finditer(text + '\n\n'):
+        para = text[para_start:match.start()]
+        if para.strip():
+            paragraphs.append((para, para_start, match.start()))
+        para_start = match.end()
     if not paragraphs:
         return []
     
@@ -56,17 +98,19 @@ def topic_based_chunking(text: str, metadata: Dict[str, Any], max_chunk_size: in
     chunks = []
     current_chunk = []
     current_length = 0
+
+    def make_chunk(paras):
+        return {
+            "text": '\n\n'.join(para for para, _, _ in paras),
+            "metadata": {**metadata, "start_char": offset + paras[0][1], "end_char": offset + paras[-1][2]}
+        }
     
     for para in paragraphs:
-        para_length = len(para.split())
+        para_length = len(para[0].split())
         
         # If adding this paragraph would exceed max size, start a new chunk
         if current_length + para_length > max_chunk_size and current_chunk:
-            chunk_text = '\n\n'.join(current_chunk)
-            chunks.append({
-                "text": chunk_text,
-                "metadata": metadata.copy()
-            })
+            chunks.append(make_chunk(current_chunk))
             current_chunk = [para]
             current_length = para_length
         else:
@@ -75,17 +119,15 @@ def topic_based_chunking(text: str, metadata: Dict[str, Any], max_chunk_size: in
     
     # Add the last chunk if not empty
     if current_chunk:
-        chunk_text = '\n\n'.join(current_chunk)
-        chunks.append({
-            "text": chunk_text, 
-            "metadata": metadata.copy()
-        })
+        chunks.append(make_chunk(current_chunk))
     
     return chunks
 
-def sliding_window_chunking(text: str, metadata: Dict[str, Any], chunk_size: int = 300, overlap: int = 80) -> List[Dict]:
+def sliding_window_chunking(text: str, metadata: Dict[str, Any], chunk_size: int = 300, overlap: int = 80,
+                            sentences: List[Dict[str, Any]] = None) -> List[Dict]:
     """Create overlapping chunks to ensure context continuity."""
-    sentences = nltk.sent_tokenize(text)
+    if sentences is None:
+        sentences = split_sentences(text)
     chunks = []
     
     i = 0
@@ -97,15 +139,21 @@ def sliding_window_chunking(text: str, metadata: Dict[str, Any], chunk_size: int
         
         # Build chunk up to chunk_size words
         while j < len(sentences) and word_count < chunk_size:
-            chunk_text.append(sentences[j])
-            word_count += len(sentences[j].split())
+            chunk_text.append(sentences[j]["text"])
+            word_count += sentences[j]["words"]
             j += 1
             
         # Create chunk with current text
         if chunk_text:
             chunk = {
                 "text": " ".join(chunk_text),
-                "metadata": {**metadata, "start_idx": i, "end_idx": j-1}
+                "metadata": {
+                    **metadata,
+                    "start_idx": i,
+                    "end_idx": j-1,
+                    "start_char": sentences[i]["start"],
+                    "end_char": sentences[j-1]["end"]
+                }
             }
             chunks.append(chunk)
         
@@ -116,34 +164,49 @@ def sliding_window_chunking(text: str, metadata: Dict[str, Any], chunk_size: int
     
     return chunks
 
-def entity_centric_chunking(text: str, metadata: Dict[str, Any], target_entities: List[str] = None) -> List[Dict]:
-    """Create chunks centered around key entities."""
-    if target_entities is None:
-        # Default target entities based on your project's focus
-        target_entities = ["coffee", "pepper", "fertilizer", "soil", "climate", "carbon", "emission", "sustainability"]
+def entity_centric_chunking(text: str, metadata: Dict[str, Any], target_entities: List[str] = None,
+                            sentences: List[Dict[str, Any]] = None) -> List[Dict]:
+    """Create chunks centered around key entities.
+
+    Target entities default to the agronomy vocabulary in entity_vocabulary.json.
+    Entities are found with a single compiled, word-boundary-aware matcher.
+    """
+    matcher = get_matcher(tuple(target_entities) if target_entities is not None else None)
     
     # Split into sentences
-    sentences = nltk.sent_tokenize(text)
+    if sentences is None:
+        sentences = split_sentences(text)
     
     # Group sentences by entity mentions
-    entity_chunks = {entity: [] for entity in target_entities}
+    entity_chunks = {entity: [] for entity in matcher.entities}
     other_sentences = []
+    sentence_hits = []
     
     for sentence in sentences:
-        sentence_lower = sentence.lower()
-        mentioned_entities = set()
-        
         # Check for entity mentions
-        for entity in target_entities:
-            if entity in sentence_lower:
-                mentioned_entities.add(entity)
+        hits = matcher.count_entities(sentence["text"])
+        sentence_hits.append(hits)
         
         # Add to appropriate chunks
-        if mentioned_entities:
-            for entity in mentioned_entities:
-                entity_chunks[entity].append(sentence)
+        if hits:
+            for entity in hits:
+                entity_chunks[entity].append(len(sentence_hits) - 1)
         else:
-            other_sentences.append(sentence)
+            other_sentences.append(len(sentence_hits) - 1)
+
+    def make_chunk(sentence_ids, entity_focus):
+        entity_hits = Counter()
+        for i in sentence_ids:
+            entity_hits.update(sentence_hits[i])
+        return {
+            "text": " ".join(sentences[i]["text"] for i in sentence_ids),
+            "metadata": {
+                **metadata,
+                "entity_focus": entity_focus,
+                "entity_hits": dict(entity_hits),
+                "char_spans": [[sentences[i]["start"], sentences[i]["end"]] for i in sentence_ids]
+            }
+        }
     
     # Create final chunks
     result_chunks = []
@@ -151,80 +214,89 @@ def entity_centric_chunking(text: str, metadata: Dict[str, Any], target_entities
     # Entity-specific chunks
     for entity, entity_sentences in entity_chunks.items():
         if entity_sentences:
-            chunk_text = " ".join(entity_sentences)
-            if len(chunk_text.split()) > 30:  # Only create chunk if it has enough content
-                result_chunks.append({
-                    "text": chunk_text,
-                    "metadata": {**metadata, "entity_focus": entity}
-                })
+            # Only create chunk if it has enough content
+            if sum(sentences[i]["words"] for i in entity_sentences) > 30:
+                result_chunks.append(make_chunk(entity_sentences, entity))
     
     # Remaining content (if any substantial content is left)
-    if other_sentences and len(" ".join(other_sentences).split()) > 50:
-        chunk_text = " ".join(other_sentences)
-        result_chunks.append({
-            "text": chunk_text,
-            "metadata": {**metadata, "entity_focus": "general"}
-        })
+    if other_sentences and sum(sentences[i]["words"] for i in other_sentences) > 50:
+        result_chunks.append(make_chunk(other_sentences, "general"))
     
     return result_chunks
 
-def remove_redundancy(chunks: List[Dict]) -> List[Dict]:
-    """Remove duplicate or highly similar chunks."""
+def remove_redundancy(chunks: List[Dict], threshold: float = DEFAULT_SIMILARITY_THRESHOLD) -> List[Dict]:
+    """Remove duplicate or highly similar chunks.
+
+    Uses MinHash/LSH near-duplicate detection, so the pass stays near-linear in
+    the number of chunks. Each kept chunk records how many chunks were merged
+    into it under metadata["merged_duplicates"].
+    """
     if not chunks:
         return []
-    
+
+    duplicates = find_near_duplicates([chunk["text"] for chunk in chunks], threshold)
+
+    merged_counts = {}
+    for duplicate_idx, kept_idx in duplicates.items():
+        merged_counts[kept_idx] = merged_counts.get(kept_idx, 0) + 1
+        logging.debug(f"Chunk {duplicate_idx} merged into near-duplicate chunk {kept_idx}")
+
     unique_chunks = []
-    unique_texts = set()
-    
-    for chunk in chunks:
-        # Create a simplified representation for comparison
-        simplified = ' '.join(chunk["text"].lower().split())
-        
-        # Check if we already have a very similar chunk
-        is_duplicate = False
-        for existing in unique_texts:
-            # Simple similarity check - can be improved with more sophisticated methods
-            if simplified in existing or existing in simplified:
-                is_duplicate = True
-                break
-        
-        if not is_duplicate:
-            unique_texts.add(simplified)
-            unique_chunks.append(chunk)
-    
+    for i, chunk in enumerate(chunks):
+        if i in duplicates:
+            continue
+        if i in merged_counts:
+            chunk = {**chunk, "metadata": {**chunk["metadata"], "merged_duplicates": merged_counts[i]}}
+        unique_chunks.append(chunk)
+
+    if duplicates:
+        logging.info(f"Merged {len(duplicates)} near-duplicate chunks (threshold {threshold:.2f})")
+
     return unique_chunks
 
 def optimized_chunking_pipeline(document: str, metadata: Dict[str, Any]) -> List[Dict]:
     """Multi-stage chunking pipeline optimized for agricultural domain."""
     logging.info(f"Starting multi-stage chunking pipeline for document: {metadata.get('filename', 'Unknown')}")
     
+    # Stage 0: Tokenise sentences and locate headings once for every stage
+    analysis = analyze_document(document)
+    
     # Stage 1: Split document into major structural sections
-    structural_chunks = extract_sections_by_headings(document)
-    logging.info(f"Identified {len(structural_chunks)} structural sections")
+    sections = section_spans(analysis)
+    logging.info(f"Identified {len(sections)} structural sections")
     
     all_chunks = []
-    for section_title, section_content in structural_chunks:
+    for section_title, section_start, section_end in sections:
         section_metadata = {**metadata, "section": section_title}
+        section_sentences = sentences_in_span(analysis, section_start, section_end)
+        section_words = sum(sentence["words"] for sentence in section_sentences)
         
         # Stage 2: For long sections, apply topic-based chunking
-        if len(section_content.split()) > 1000:
-            topic_chunks = topic_based_chunking(section_content, section_metadata)
+        if section_words > 1000:
+            section_content = document[section_start:section_end]
+            topic_chunks = topic_based_chunking(section_content, section_metadata, offset=section_start)
             all_chunks.extend(topic_chunks)
             logging.info(f"Applied topic-based chunking to section '{section_title}', created {len(topic_chunks)} chunks")
         else:
             # Stage 3: For shorter sections, use sliding window with overlap
-            sliding_chunks = sliding_window_chunking(section_content, section_metadata)
+            sliding_chunks = sliding_window_chunking(document[section_start:section_end], section_metadata, sentences=section_sentences)
             all_chunks.extend(sliding_chunks)
             logging.info(f"Applied sliding window chunking to section '{section_title}', created {len(sliding_chunks)} chunks")
     
     # Stage 4: Add specialized entity-centric chunks for high-value content
-    entity_chunks = entity_centric_chunking(document, metadata)
+    entity_chunks = entity_centric_chunking(document, metadata, sentences=analysis["sentences"])
     logging.info(f"Created {len(entity_chunks)} entity-focused chunks")
     
     # Combine while eliminating redundant content
     combined_chunks = all_chunks + entity_chunks
     final_chunks = remove_redundancy(combined_chunks)
     
+    # Per-entity hit counts for every chunk (entity chunks already have them)
+    matcher = get_matcher()
+    for chunk in final_chunks:
+        if "entity_hits" not in chunk["metadata"]:
+            chunk["metadata"]["entity_hits"] = dict(matcher.count_entities(chunk["text"]))
+    
     logging.info(f"Final output: {len(final_chunks)} unique chunks after removing redundancy")
     
-    return final_chunks
\ No newline at end of file
+    return final_chunks
@@ -0,0 +1,77 @@
+# benchmark_imports.py
+import sys
+import json
+import argparse
+import subprocess
+import logging
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Pipeline modules that CLI runs and the maintenance cron import
+MODULES = ["advanced_chunking", "semantic_chunking", "preprocess_text", "chunk_analysis", "fix_chunks", "orchestrator"]
+
+# Heavy packages that must only be loaded when a model is actually needed
+HEAVY_MODULES = ["sentence_transformers", "torch", "transformers"]
+
+DEFAULT_MAX_SECONDS = 2.0
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(json.dumps({{"seconds": elapsed, "heavy": heavy}}))
+"""
+
+
+def measure_import(module):
+    """Imports a module in a fresh interpreter and returns its import time and heavy imports."""
+    result = subprocess.run(
+        [sys.executable, "-c", _PROBE.format(module=module, heavy=HEAVY_MODULES)],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed: {result.stderr.strip()}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def run_benchmark(modules=MODULES, max_seconds=DEFAULT_MAX_SECONDS):
+    """Benchmarks each module's import and returns the modules that failed."""
+    failures = []
+    for module in modules:
+        try:
+            result = measure_import(module)
+        except RuntimeError as e:
+            logging.error(str(e))
+            failures.append(module)
+            continue
+
+        logging.info(f"{module}: {result['seconds']:.2f} seconds")
+        if result["heavy"]:
+            logging.error(f"{module} loads {', '.join(result['heavy'])} at import time")
+            failures.append(module)
+        elif result["seconds"] > max_seconds:
+            logging.error(f"{module} took {result['seconds']:.2f}s to import (limit {max_seconds:.2f}s)")
+            failures.append(module)
+
+    if failures:
+        logging.error(f"Import benchmark failed for: {', '.join(failures)}")
+    else:
+        logging.info("All modules import within the limit")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Guard the import time of the RAG pipeline modules")
+    parser.add_argument("--max-seconds", type=float, default=DEFAULT_MAX_SECONDS,
+                        help="Maximum allowed import time per module")
+    parser.add_argument("modules", nargs="*", default=MODULES, help="Modules to benchmark")
+    args = parser.parse_args()
+
+    if run_benchmark(args.modules, args.max_seconds):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
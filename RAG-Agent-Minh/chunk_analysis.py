@@ -1,25 +1,182 @@
 import os
+import re
 import json
-import nltk
+import hashlib
+import logging
 from collections import Counter
-from nltk.tokenize import word_tokenize
-from nltk.corpus import stopwords
+
+import numpy as np
+
+from model_loader import get_stopwords
+from chunk_stats import load_chunk_stats, compute_chunk_stats
+from near_duplicates import find_near_duplicates
 
 # File paths
 CHUNKED_FILE = "processed_chunks.json"  # Updated to JSON format
 SIMILARITY_LOG_FILE = "similarity_log.txt"
+ANALYSIS_CACHE_FILE = "chunk_analysis_cache.json"  # Corpus analysis keyed by the chunks file hash
+
+# Bump when the analysis output changes so old caches are recomputed
+ANALYSIS_VERSION = 1
+
+NUM_KEYWORDS = 5
+NUM_TOP_TERMS = 20
+HISTOGRAM_BINS = 10
 
-# Download NLTK resources if not available
-nltk.download("punkt")
-nltk.download("stopwords")
+_word_re = re.compile(r"[a-z0-9]+")
 
-def extract_keywords(text, num_keywords=5):
+def file_hash(file_path, block_size=1 << 20):
+    """SHA-256 of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def tokenize_words(text):
+    """Lowercased alphanumeric words of a text without stopwords."""
+    stop_words = get_stopwords("english")
+    return [word for word in _word_re.findall(text.lower()) if word not in stop_words]
+
+def extract_keywords(text, num_keywords=NUM_KEYWORDS):
     """Extracts top keywords from a chunk."""
-    words = word_tokenize(text.lower())
-    words = [word for word in words if word.isalnum()]  # Remove punctuation
-    words = [word for
-              word in words if word not in stopwords.words("english")]  # Remove stopwords
-    return [word for word, count in Counter(words).most_common(num_keywords)]
+    return [word for word, count in Counter(tokenize_words(text)).most_common(num_keywords)]
+
+def _distribution(values, bins=HISTOGRAM_BINS):
+    """Summary statistics and a histogram of a list of numbers."""
+    values = np.asarray(values, dtype=np.float64)
+    if not values.size:
+        return {"count": 0}
+    counts, edges = np.histogram(values, bins=bins)
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {
+        "count": int(values.size),
+        "mean": float(values.mean()),
+        "min": float(values.min()),
+        "p50": float(p50),
+        "p90": float(p90),
+        "p99": float(p99),
+        "max": float(values.max()),
+        "histogram": {"counts": counts.tolist(), "edges": edges.tolist()}
+    }
+
+def tfidf_summary(texts, num_keywords=NUM_KEYWORDS, num_top_terms=NUM_TOP_TERMS):
+    """Computes per-chunk TF-IDF keywords and corpus-wide top terms in one pass.
+
+    Every chunk is tokenised once; term counts, document frequencies and scores
+    are computed on flat (chunk, term) arrays instead of per-chunk Counters.
+    """
+    vocabulary = {}
+    doc_ids = []
+    term_ids = []
+    for doc_id, text in enumerate(texts):
+        words = tokenize_words(text)
+        term_ids.extend(vocabulary.setdefault(word, len(vocabulary)) for word in words)
+        doc_ids.extend([doc_id] * len(words))
+
+    num_docs = len(texts)
+    if not term_ids:
+        return {"keywords": [[] for _ in range(num_docs)], "top_terms": []}
+
+    terms = np.array(list(vocabulary), dtype=object)
+    num_terms = len(terms)
+
+    # Term frequency per (chunk, term) pair
+    pairs, tf = np.unique(np.asarray(doc_ids, dtype=np.int64) * num_terms + np.asarray(term_ids, dtype=np.int64),
+                          return_counts=True)
+    pair_docs = pairs // num_terms
+    pair_terms = pairs % num_terms
+
+    # Smoothed IDF, as in scikit-learn
+    df = np.bincount(pair_terms, minlength=num_terms)
+    idf = np.log((1 + num_docs) / (1 + df)) + 1
+    scores = tf * idf[pair_terms]
+
+    # Best-scoring terms per chunk: sort by chunk, then score descending
+    order = np.lexsort((-scores, pair_docs))
+    sorted_docs = pair_docs[order]
+    rank = np.arange(len(order)) - np.searchsorted(sorted_docs, sorted_docs)
+    top = order[rank < num_keywords]
+    keywords = [[] for _ in range(num_docs)]
+    for doc_id, term_id in zip(pair_docs[top].tolist(), pair_terms[top].tolist()):
+        keywords[doc_id].append(terms[term_id])
+
+    corpus_scores = np.bincount(pair_terms, weights=scores, minlength=num_terms)
+    top_terms = np.argsort(-corpus_scores)[:num_top_terms]
+    return {
+        "keywords": keywords,
+        "top_terms": [[terms[i], round(float(corpus_scores[i]), 3), int(df[i])] for i in top_terms]
+    }
+
+def duplication_rates(stats, texts):
+    """Shares of chunks that repeat an earlier chunk exactly, after normalisation, or nearly."""
+    num_chunks = len(texts)
+    if not num_chunks:
+        return {"exact": 0.0, "normalized": 0.0, "near": 0.0}
+    exact = num_chunks - len(set(stats["content_hash"]))
+    normalized = num_chunks - len(set(stats["normalized_hash"]))
+    near = len(find_near_duplicates(texts, containment=False))
+    return {
+        "exact": exact / num_chunks,
+        "normalized": normalized / num_chunks,
+        "near": near / num_chunks
+    }
+
+def analyze_corpus(chunks):
+    """Computes keyword, size, token and duplication analytics for a whole chunk set."""
+    texts = [chunk["text"] for chunk in chunks]
+    stats = load_chunk_stats(chunks=chunks) or compute_chunk_stats(chunks)
+    summary = tfidf_summary(texts)
+
+    return {
+        "total_chunks": len(chunks),
+        "chunks_per_file": dict(Counter(chunk["metadata"].get("filename", "Unknown") for chunk in chunks)),
+        "word_counts": _distribution(stats["word_count"]),
+        "char_counts": _distribution(stats["char_count"]),
+        "token_counts": _distribution(stats["token_count"]),
+        "duplication": duplication_rates(stats, texts),
+        "top_terms": summary["top_terms"],
+        "keywords": summary["keywords"]
+    }
+
+def load_corpus_analysis(chunks_file=CHUNKED_FILE, cache_file=ANALYSIS_CACHE_FILE, chunks=None):
+    """Returns the corpus analysis for a chunks file, recomputing it only when the file changed.
+
+    Pass chunks if the file is already loaded to avoid parsing it again on a cache miss.
+    """
+    chunks_hash = file_hash(chunks_file)
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, "r", encoding="utf-8") as file:
+                cached = json.load(file)
+            if cached.get("chunks_hash") == chunks_hash and cached.get("version") == ANALYSIS_VERSION:
+                return cached["analysis"]
+        except Exception as e:
+            logging.warning(f"Could not read analysis cache {cache_file}: {e}")
+
+    if chunks is None:
+        with open(chunks_file, "r", encoding="utf-8") as file:
+            chunks = json.load(file)
+    analysis = analyze_corpus(chunks)
+
+    with open(cache_file, "w", encoding="utf-8") as file:
+        json.dump({"chunks_hash": chunks_hash, "version": ANALYSIS_VERSION, "analysis": analysis},
+                  file, ensure_ascii=False)
+    return analysis
+
+def _print_distribution(title, distribution, unit):
+    """Prints a distribution's summary and a text histogram."""
+    if not distribution["count"]:
+        return
+    print(f"{title}: mean {distribution['mean']:.1f}, median {distribution['p50']:.0f}, "
+          f"p90 {distribution['p90']:.0f}, p99 {distribution['p99']:.0f}, "
+          f"min {distribution['min']:.0f}, max {distribution['max']:.0f} {unit}")
+    counts = distribution["histogram"]["counts"]
+    edges = distribution["histogram"]["edges"]
+    widest = max(counts) or 1
+    for count, low, high in zip(counts, edges, edges[1:]):
+        print(f"  {low:>8.0f} - {high:<8.0f} {'█' * max(1 if count else 0, round(30 * count / widest))} {count}")
+    print()
 
 def analyze_chunked_file():
     """Reads processed_chunks.json and analyzes chunk count, division, and content."""
@@ -31,25 +188,34 @@ def analyze_chunked_file():
     with open(CHUNKED_FILE, "r", encoding="utf-8") as file:
         chunks = json.load(file)  # Load JSON instead of reading as text
 
+    # Corpus-wide analytics, cached until the chunks file changes
+    analysis = load_corpus_analysis(CHUNKED_FILE, chunks=chunks)
+
     print("\n===== 📊 Chunk Analysis =====")
-    print(f"✅ Total Chunks Created: {len(chunks)}\n")
+    print(f"✅ Total Chunks Created: {analysis['total_chunks']}\n")
+
+    words = analysis["word_counts"]
+    if words["count"]:
+        print(f"📏 Average Chunk Size: {words['mean']:.2f} words")
+        print(f"🔍 Largest Chunk: {words['max']:.0f} words")
+        print(f"✂️ Smallest Chunk: {words['min']:.0f} words\n")
+
+    _print_distribution("📏 Words per chunk", words, "words")
+    _print_distribution("🔢 Tokens per chunk", analysis["token_counts"], "tokens")
 
-    # Track statistics
-    chunk_sizes = [len(chunk["text"].split()) for chunk in chunks]
-    avg_chunk_size = sum(chunk_sizes) / len(chunk_sizes) if chunk_sizes else 0
-    max_chunk_size = max(chunk_sizes) if chunk_sizes else 0
-    min_chunk_size = min(chunk_sizes) if chunk_sizes else 0
+    duplication = analysis["duplication"]
+    print(f"♻️ Duplicate chunks: {duplication['exact']:.1%} exact, "
+          f"{duplication['normalized']:.1%} after normalisation, {duplication['near']:.1%} near-duplicates\n")
 
-    print(f"📏 Average Chunk Size: {avg_chunk_size:.2f} words")
-    print(f"🔍 Largest Chunk: {max_chunk_size} words")
-    print(f"✂️ Smallest Chunk: {min_chunk_size} words\n")
+    print("🏷️ Top corpus terms (TF-IDF): " + ", ".join(term for term, _, _ in analysis["top_terms"]))
+    print()
 
     # Display only the first 5 and last 5 chunks
     num_chunks = len(chunks)
     preview_count = 5  # Show first and last 5 chunks
 
     def display_chunk(i, chunk):
-        keywords = extract_keywords(chunk["text"])
+        keywords = analysis["keywords"][i]
         print(f"📝 Chunk {i+1} (From {chunk['metadata']['filename']}):")
         print(f"🔑 Keywords: {', '.join(keywords)}")
         print(f"📜 Content Preview: {chunk['text'][:200]}...")  # Show first 200 characters
@@ -0,0 +1,111 @@
+import re
+import logging
+
+import numpy as np
+
+from context_builder import get_encoding
+from chunk_stats import content_hash
+from model_loader import sent_tokenize
+
+# Largest chunk sent to the embedding model, well below the 8191 limit of text-embedding-3-large
+MAX_CHUNK_TOKENS = 6000
+
+_PARAGRAPH_SPLIT = re.compile(r"\n\s*\n")
+
+
+def token_counts(texts):
+    """Counts tokens for many texts with one batched encode call."""
+    texts = list(texts)
+    if not texts:
+        return []
+    return [len(tokens) for tokens in get_encoding().encode_batch(texts, disallowed_special=())]
+
+
+def slice_tokens(tokens, max_tokens):
+    """Splits a token sequence into consecutive slices of at most max_tokens."""
+    tokens = np.asarray(tokens)
+    return np.split(tokens, np.arange(max_tokens, len(tokens), max_tokens))
+
+
+def slice_text(text, max_tokens, tokens=None):
+    """Splits text at raw token boundaries, the last resort for a single huge sentence."""
+    encoding = get_encoding()
+    if tokens is None:
+        tokens = encoding.encode(text, disallowed_special=())
+    return encoding.decode_batch([part.tolist() for part in slice_tokens(tokens, max_tokens)])
+
+
+def _fitting_units(texts, max_tokens, joiner, sentence_level=False):
+    """Breaks texts down until every unit fits: paragraphs, then sentences, then token slices.
+
+    Returns (text, token count, joiner) tuples; joiner is what goes before the unit when packed.
+    """
+    units = []
+    for text, count in zip(texts, token_counts(texts)):
+        if count <= max_tokens:
+            units.append((text, count, joiner))
+        elif not sentence_level:
+            sentence_units = _fitting_units(sent_tokenize(text), max_tokens, " ", sentence_level=True)
+            if sentence_units:
+                # The first sentence of a paragraph still starts a new paragraph
+                units.append((sentence_units[0][0], sentence_units[0][1], joiner))
+                units.extend(sentence_units[1:])
+        else:
+            parts = slice_text(text, max_tokens)
+            units.extend((part, part_count, joiner) for part, part_count in zip(parts, token_counts(parts)))
+    return units
+
+
+def split_text(text, max_tokens=MAX_CHUNK_TOKENS):
+    """Splits text into parts of at most max_tokens, cutting at paragraph, then sentence boundaries.
+
+    Neighbouring paragraphs and sentences are packed together so parts stay as large as allowed.
+    """
+    paragraphs = [paragraph.strip() for paragraph in _PARAGRAPH_SPLIT.split(text) if paragraph.strip()]
+    parts = []
+    current = []
+    used = 0
+    for unit, count, joiner in _fitting_units(paragraphs, max_tokens, "\n\n"):
+        # One token of slack per unit for the joiner
+        if current and used + count + 1 > max_tokens:
+            parts.append("".join(current).strip())
+            current = []
+            used = 0
+        current.append((joiner if current else "") + unit)
+        used += count + 1
+    if current:
+        parts.append("".join(current).strip())
+    return parts
+
+
+def split_oversized_chunks(chunks, max_tokens=MAX_CHUNK_TOKENS):
+    """Returns chunks with each chunk above max_tokens replaced by its parts, in the original order.
+
+    Every part becomes its own vector and keeps the parent's metadata, plus
+    parent_hash, part and parts so results can be traced back to the parent.
+    All returned chunks carry their token_count in the metadata.
+    """
+    chunks = [chunk if isinstance(chunk, dict) else {"text": chunk, "metadata": {}} for chunk in chunks]
+    result = []
+    for chunk, count in zip(chunks, token_counts(chunk["text"] for chunk in chunks)):
+        metadata = chunk.get("metadata", {})
+        if count <= max_tokens:
+            result.append({**chunk, "metadata": {**metadata, "token_count": count}})
+            continue
+
+        parts = split_text(chunk["text"], max_tokens)
+        parent_hash = content_hash(chunk["text"])
+        logging.info(f"Split a chunk of {count} tokens from {metadata.get('filename', 'Unknown')} into {len(parts)} parts")
+        for part_number, (text, part_count) in enumerate(zip(parts, token_counts(parts)), start=1):
+            result.append({
+                **chunk,
+                "text": text,
+                "metadata": {
+                    **metadata,
+                    "token_count": part_count,
+                    "parent_hash": parent_hash,
+                    "part": part_number,
+                    "parts": len(parts)
+                }
+            })
+    return result
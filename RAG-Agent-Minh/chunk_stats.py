@@ -0,0 +1,94 @@
+import os
+import re
+import json
+import hashlib
+import logging
+from context_builder import chunk_token_count
+
+# Setup logging
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Side file written next to processed_chunks.json
+CHUNK_STATS_FILE = "chunk_stats.json"
+
+STAT_COLUMNS = ["vector_id", "token_count", "content_hash", "normalized_hash", "char_count", "word_count"]
+
+_whitespace_re = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    """Lowercases and collapses whitespace, used for duplicate-insensitive hashing."""
+    return _whitespace_re.sub(" ", text.lower()).strip()
+
+
+def content_hash(text):
+    """Returns the MD5 hash of a chunk's text (same scheme as the embedding cache)."""
+    return hashlib.md5(text.encode()).hexdigest()
+
+
+def empty_chunk_stats():
+    """Returns an empty set of stat columns."""
+    return {column: [] for column in STAT_COLUMNS}
+
+
+def extend_chunk_stats(stats, chunks):
+    """Appends rows for chunks to existing stat columns, continuing the vector ids."""
+    vector_id = len(stats["vector_id"])
+    for chunk in chunks:
+        text, metadata = (chunk["text"], chunk.get("metadata")) if isinstance(chunk, dict) else (chunk, None)
+        stats["vector_id"].append(vector_id)
+        stats["token_count"].append(chunk_token_count(text, metadata))
+        stats["content_hash"].append(content_hash(text))
+        stats["normalized_hash"].append(content_hash(normalize_text(text)))
+        stats["char_count"].append(len(text))
+        stats["word_count"].append(len(text.split()))
+        vector_id += 1
+    return stats
+
+
+def compute_chunk_stats(chunks):
+    """Computes per-chunk statistics as columns, one row per chunk in file order.
+
+    The row position is the vector id the chunk gets when the index is rebuilt.
+    """
+    return extend_chunk_stats(empty_chunk_stats(), chunks)
+
+
+def save_chunk_stats(stats, file_path=CHUNK_STATS_FILE):
+    """Writes the columnar chunk statistics to disk."""
+    with open(file_path, "w", encoding="utf-8") as file:
+        json.dump(stats, file)
+    logging.info(f"Saved statistics for {len(stats['vector_id'])} chunks to {file_path}")
+
+
+def load_chunk_stats(file_path=CHUNK_STATS_FILE, chunks=None):
+    """Loads chunk statistics, or returns None if missing or out of date.
+
+    When chunks are given, the stats are only used if they describe the same
+    chunks, row for row (hashing every chunk is far cheaper than tokenising it).
+    """
+    if not os.path.exists(file_path):
+        return None
+
+    try:
+        with open(file_path, "r", encoding="utf-8") as file:
+            stats = json.load(file)
+    except Exception as e:
+        logging.warning(f"Could not read chunk statistics from {file_path}: {e}")
+        return None
+
+    if chunks is not None:
+        hashes = [content_hash(chunk["text"] if isinstance(chunk, dict) else chunk) for chunk in chunks]
+        if stats.get("content_hash") != hashes:
+            logging.warning(f"{file_path} does not match the current chunks, ignoring it")
+            return None
+
+    return stats
+
+
+def get_token_counts(chunks, file_path=CHUNK_STATS_FILE):
+    """Returns token counts for chunks from the side file, computing them only if needed."""
+    stats = load_chunk_stats(file_path, chunks)
+    if stats is None:
+        stats = compute_chunk_stats(chunks)
+    return stats["token_count"]
@@ -0,0 +1,226 @@
+# chunk_store.py
+import os
+import json
+import zlib
+import mmap
+import struct
+import logging
+import threading
+from itertools import chain, islice
+from collections import OrderedDict
+
+import numpy as np
+
+from embedders import index_generation
+
+PROCESSED_FILE = "processed_chunks.json"
+METADATA_FILE = "faiss_metadata.json"
+
+# Rows per block; a compressed block is decompressed as a whole to read one of its rows
+BLOCK_ROWS = 64
+COMPRESS_BLOCKS = False
+# Decompressed blocks kept per open store
+BLOCK_CACHE_SIZE = 32
+
+MAGIC = b"RAGCHNK1"
+FLAG_ZLIB = 1
+# magic, flags, rows per block, row count, block table offset
+HEADER = struct.Struct("<8sIIQQ")
+
+
+def store_path(chunks_file=PROCESSED_FILE):
+    """processed_chunks.json -> processed_chunks.store"""
+    return os.path.splitext(chunks_file)[0] + ".store"
+
+
+def _encode_record(text, metadata):
+    text = text.encode("utf-8")
+    return struct.pack("<I", len(text)) + text + json.dumps(metadata, ensure_ascii=False,
+                                                            separators=(",", ":")).encode("utf-8")
+
+
+def _encode_block(records, compress):
+    """A block is its row offset table (uint32, relative to the block) followed by the records."""
+    offsets = np.cumsum([0] + [len(record) for record in records], dtype=np.uint64) + 4 * (len(records) + 1)
+    payload = offsets.astype("<u4").tobytes() + b"".join(records)
+    return zlib.compress(payload) if compress else payload
+
+
+def write_chunk_store(rows, store_file=None, block_rows=BLOCK_ROWS, compress=COMPRESS_BLOCKS):
+    """Writes (text, metadata) rows, in vector id order, as a chunk store. Returns the row count.
+
+    Rows are streamed block by block, so the corpus never has to fit in memory.
+    The file is written next to store_file and moved into place, because
+    serving processes map the live file.
+    """
+    store_file = store_file or store_path()
+    tmp_file = f"{store_file}.{os.getpid()}.tmp"
+    block_offsets = []
+    count = 0
+    with open(tmp_file, "wb") as file:
+        file.write(b"\0" * HEADER.size)
+        rows = iter(rows)
+        while True:
+            records = [_encode_record(text, metadata) for text, metadata in islice(rows, block_rows)]
+            if not records:
+                break
+            block_offsets.append(file.tell())
+            file.write(_encode_block(records, compress))
+            count += len(records)
+        block_offsets.append(file.tell())
+        table_offset = file.tell()
+        file.write(np.asarray(block_offsets, dtype="<u8").tobytes())
+        file.seek(0)
+        file.write(HEADER.pack(MAGIC, FLAG_ZLIB if compress else 0, block_rows, count, table_offset))
+    os.replace(tmp_file, store_file)
+    return count
+
+
+class ChunkStore:
+    """Read-only, memory-mapped chunk texts and metadata, addressed by vector id.
+
+    Only the header and the block offset table are read on open; a lookup
+    touches just the pages of the block holding the row, so opening and
+    querying cost the same for a thousand chunks or millions.
+    """
+
+    def __init__(self, store_file):
+        self.store_file = store_file
+        with open(store_file, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, flags, self.block_rows, self.count, table_offset = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f"{store_file} is not a chunk store")
+        self.compressed = bool(flags & FLAG_ZLIB)
+        block_count = -(-self.count // self.block_rows)
+        self._blocks = np.frombuffer(self._map, dtype="<u8", count=block_count + 1, offset=table_offset)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def _block(self, block):
+        start, end = int(self._blocks[block]), int(self._blocks[block + 1])
+        if not self.compressed:
+            return memoryview(self._map)[start:end]
+        with self._lock:
+            payload = self._cache.get(block)
+            if payload is not None:
+                self._cache.move_to_end(block)
+                return payload
+        payload = zlib.decompress(self._map[start:end])
+        with self._lock:
+            self._cache[block] = payload
+            if len(self._cache) > BLOCK_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return payload
+
+    def get(self, vector_id):
+        """Returns {"text", "metadata"} for a vector id."""
+        vector_id = int(vector_id)
+        if not 0 <= vector_id < self.count:
+            raise IndexError(f"Vector id {vector_id} is not in {self.store_file} ({self.count} rows)")
+        block, row = divmod(vector_id, self.block_rows)
+        payload = self._block(block)
+        start, end = struct.unpack_from("<II", payload, 4 * row)
+        text_length, = struct.unpack_from("<I", payload, start)
+        text_end = start + 4 + text_length
+        return {"text": bytes(payload[start + 4:text_end]).decode("utf-8"),
+                "metadata": json.loads(bytes(payload[text_end:end]))}
+
+    def get_many(self, vector_ids):
+        return [self.get(vector_id) for vector_id in vector_ids]
+
+    def rows(self):
+        """Iterates over every row as (text, metadata), in vector id order."""
+        for vector_id in range(self.count):
+            row = self.get(vector_id)
+            yield row["text"], row["metadata"]
+
+
+def chunk_rows(chunks, metadata_mapping):
+    """(text, metadata) rows in vector id order from the chunks and metadata JSON structures.
+
+    Vectors added by incremental or client updates have metadata but no entry
+    in the chunks file; their text preview is the best text there is for them.
+    """
+    count = max(len(chunks), max(map(int, metadata_mapping), default=-1) + 1)
+    for vector_id in range(count):
+        chunk = chunks[vector_id] if vector_id < len(chunks) else {}
+        metadata = metadata_mapping.get(str(vector_id))
+        if isinstance(chunk, dict):
+            text = chunk.get("text", (metadata or {}).get("text_preview", ""))
+            metadata = metadata if metadata is not None else chunk.get("metadata", {})
+        else:
+            text = chunk
+        yield text, metadata or {}
+
+
+def load_sources(chunks_file=PROCESSED_FILE, metadata_file=METADATA_FILE):
+    """Reads the chunks and metadata JSON files the store is built from; missing files read as empty."""
+    chunks, metadata_mapping = [], {}
+    if os.path.exists(chunks_file):
+        with open(chunks_file, "r", encoding="utf-8") as file:
+            chunks = json.load(file)
+    if os.path.exists(metadata_file):
+        with open(metadata_file, "r", encoding="utf-8") as file:
+            metadata_mapping = json.load(file)
+    return chunks, metadata_mapping
+
+
+def build_chunk_store(chunks_file=PROCESSED_FILE, metadata_file=METADATA_FILE, store_file=None, **options):
+    """Builds the chunk store from the chunks and metadata JSON files."""
+    store_file = store_file or store_path(chunks_file)
+    count = write_chunk_store(chunk_rows(*load_sources(chunks_file, metadata_file)), store_file, **options)
+    logging.info(f"✅ Wrote {count} chunks to {store_file}")
+    return count
+
+
+def extend_chunk_store(rows, first_id, chunks_file=PROCESSED_FILE, metadata_file=METADATA_FILE, store_file=None):
+    """Rewrites the store with rows added from vector id first_id on. Call it after writing the metadata file."""
+    store_file = store_file or store_path(chunks_file)
+    if os.path.exists(store_file):
+        existing = ChunkStore(store_file)
+        options = {"block_rows": existing.block_rows, "compress": existing.compressed}
+        existing = existing.rows()
+    else:
+        options = {}
+        existing = chunk_rows(*load_sources(chunks_file, metadata_file))
+    return write_chunk_store(chain(islice(existing, first_id), rows), store_file, **options)
+
+
+def filter_chunk_store(keep_mask, store_file=None):
+    """Rewrites the store without the rows whose keep_mask entry is False, renumbering the rest."""
+    store_file = store_file or store_path()
+    if not os.path.exists(store_file):
+        return 0
+    existing = ChunkStore(store_file)
+    kept = (row for row, keep in zip(existing.rows(), keep_mask) if keep)
+    return write_chunk_store(kept, store_file, block_rows=existing.block_rows, compress=existing.compressed)
+
+
+_open_stores = {}
+_open_stores_lock = threading.Lock()
+
+
+def open_chunk_store(chunks_file=PROCESSED_FILE, metadata_file=METADATA_FILE):
+    """Returns the chunk store for a chunks file, opened once per process.
+
+    The store is built from the JSON files the first time, and rebuilt if one
+    of them is newer (they were rewritten by something that does not know
+    about the store). It is reopened whenever its file is replaced.
+    """
+    store_file = store_path(chunks_file)
+    with _open_stores_lock:
+        store_mtime = os.stat(store_file).st_mtime_ns if os.path.exists(store_file) else None
+        sources = [os.stat(path).st_mtime_ns for path in (chunks_file, metadata_file) if os.path.exists(path)]
+        if store_mtime is None or any(mtime > store_mtime for mtime in sources):
+            logging.info(f"Building {store_file} from {chunks_file} and {metadata_file}")
+            build_chunk_store(chunks_file, metadata_file, store_file)
+
+        generation = index_generation(store_file)
+        opened = _open_stores.get(store_file)
+        if opened is None or opened[0] != generation:
+            opened = _open_stores[store_file] = (generation, ChunkStore(store_file))
+    return opened[1]
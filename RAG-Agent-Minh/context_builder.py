@@ -0,0 +1,109 @@
+import logging
+from functools import lru_cache
+
+import tiktoken
+
+# OpenAI's encoding for GPT-4 and text-embedding-3-large
+ENCODING_NAME = "cl100k_base"
+
+# Default token budget for a prompt, well below the 10,000 TPM limit
+DEFAULT_MAX_TOKENS = 6000
+
+TRUNCATION_NOTE = "\n\n[Note: Additional relevant content was found but truncated to stay within limits]"
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name=ENCODING_NAME):
+    """Returns the tiktoken encoding, built once per process."""
+    return tiktoken.get_encoding(name)
+
+
+# Replaces the tiktoken encoding when set, e.g. by offline stubs that must not download it
+_token_counter = None
+
+
+def set_token_counter(counter):
+    """Counts tokens with counter(text) instead of the shared encoding; None restores the encoding."""
+    global _token_counter
+    _token_counter = counter
+
+
+def count_tokens(text):
+    """Counts tokens in a piece of text with the shared encoding."""
+    if not text:
+        return 0
+    if _token_counter is not None:
+        return _token_counter(text)
+    return len(get_encoding().encode(text))
+
+
+def chunk_token_count(text, metadata=None):
+    """Returns the token count for a chunk, preferring the count stored at ingestion time."""
+    if metadata:
+        token_count = metadata.get("token_count")
+        if token_count is not None:
+            return int(token_count)
+    return count_tokens(text)
+
+
+def pack_chunks(token_costs, budget, scores=None):
+    """Chooses which chunks fit in a token budget.
+
+    Chunks are considered greedily by relevance per token (scores default to
+    their rank order, best first) and the selection is returned in the original
+    rank order. Returns (selected indices, tokens used).
+    """
+    if scores is None:
+        scores = [1.0 / (rank + 1) for rank in range(len(token_costs))]
+
+    order = sorted(
+        range(len(token_costs)),
+        key=lambda i: scores[i] / max(token_costs[i], 1),
+        reverse=True
+    )
+
+    selected = []
+    used = 0
+    for i in order:
+        if used + token_costs[i] <= budget:
+            selected.append(i)
+            used += token_costs[i]
+
+    selected.sort()
+    return selected, used
+
+
+def build_context(chunks, metadata_list, format_chunk, format_citation,
+                  max_tokens=DEFAULT_MAX_TOKENS, reserved_tokens=0, scores=None):
+    """Packs retrieved chunks and their citations into a token budget in one pass.
+
+    format_chunk(i, text, metadata) and format_citation(i, metadata) produce the
+    strings that go into the prompt. Chunk bodies use their precomputed token
+    counts when available; only the short headers and citations are encoded.
+
+    Returns a dict with the context and citation strings, the indices of the
+    chunks that were kept and the estimated prompt token count.
+    """
+    token_costs = []
+    for i, (text, metadata) in enumerate(zip(chunks, metadata_list)):
+        overhead = count_tokens(format_chunk(i, "", metadata)) + count_tokens(format_citation(i, metadata))
+        token_costs.append(chunk_token_count(text, metadata) + overhead)
+
+    budget = max(max_tokens - reserved_tokens, 0)
+    selected, used = pack_chunks(token_costs, budget, scores)
+
+    # Number the kept chunks consecutively in the final prompt
+    context = "".join(format_chunk(n, chunks[i], metadata_list[i]) for n, i in enumerate(selected))
+    citations = "".join(format_citation(n, metadata_list[i]) for n, i in enumerate(selected))
+    if len(selected) < len(chunks):
+        context += TRUNCATION_NOTE
+
+    total_tokens = reserved_tokens + used
+    logging.info(f"Packed {len(selected)}/{len(chunks)} chunks into the prompt (~{total_tokens} tokens)")
+
+    return {
+        "context": context,
+        "citations": citations,
+        "selected": selected,
+        "token_count": total_tokens
+    }
@@ -0,0 +1,261 @@
+# embedding_migration.py
+import os
+import re
+import json
+import time
+import random
+import shutil
+import logging
+from datetime import datetime
+
+import faiss
+import numpy as np
+
+from embedders import (get_embedder, load_index, embedder_spec, manifest_path,
+                       save_index_manifest, load_index_manifest)
+from chunk_stats import load_chunk_stats, compute_chunk_stats
+from jsonl_utils import iter_jsonl, append_jsonl, truncate_jsonl
+from vectorize_store_faiss import create_hnsw_index, fit_embedding_input, load_chunks, FAISS_INDEX_FILE, PROCESSED_FILE
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Packed embedding caches, one per embedder, reused by later migrations to the same embedder
+PACK_DIR = "embedding_packs"
+PROGRESS_FILE = "migration_progress.json"
+
+# Optional evaluation queries: a JSON list of {"query": ..., "relevant": [vector ids]}
+QUERY_SET_FILE = "migration_queries.json"
+
+# Embedding budget; the job sleeps between batches to stay under it
+TOKENS_PER_MINUTE = 200000
+BATCH_SIZE = 64
+
+RECALL_K = 5
+SAMPLE_QUERIES = 50
+# The new index must find at least this share of what the live index finds
+MIN_RECALL_RATIO = 0.95
+
+
+class EmbeddingPack:
+    """Append-only packed embedding cache for one embedder.
+
+    Vectors are raw float32 rows in one file, with one JSONL key line (the
+    chunk's content hash) per row. Rows are written before their keys, so
+    rows without a key are an interrupted write and are dropped on open.
+    An interrupted migration resumes from here without paying again.
+    """
+
+    def __init__(self, spec, dimension, pack_dir=PACK_DIR):
+        os.makedirs(pack_dir, exist_ok=True)
+        name = re.sub(r"[^A-Za-z0-9._-]+", "_", spec)
+        self.vectors_file = os.path.join(pack_dir, f"{name}.f32")
+        self.keys_file = os.path.join(pack_dir, f"{name}.keys.jsonl")
+        self.dimension = dimension
+        self.row_bytes = dimension * np.dtype(np.float32).itemsize
+
+        keys = [record["hash"] for record in iter_jsonl(self.keys_file)] if os.path.exists(self.keys_file) else []
+        vector_rows = os.path.getsize(self.vectors_file) // self.row_bytes if os.path.exists(self.vectors_file) else 0
+        self.count = min(len(keys), vector_rows)
+        if self.count != len(keys):
+            truncate_jsonl(self.keys_file, self.count)
+        if os.path.exists(self.vectors_file):
+            with open(self.vectors_file, "r+b") as file:
+                file.truncate(self.count * self.row_bytes)
+        self.rows = {key: row for row, key in enumerate(keys[:self.count])}
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def add(self, keys, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dimension)
+        with open(self.vectors_file, "ab") as file:
+            file.write(vectors.tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+        with open(self.keys_file, "a", encoding="utf-8") as file:
+            append_jsonl(file, [{"hash": key} for key in keys])
+        for key in keys:
+            self.rows[key] = self.count
+            self.count += 1
+
+    def get(self, keys):
+        """Returns the vectors for keys as a float32 matrix, read through a memory map."""
+        vectors = np.memmap(self.vectors_file, dtype=np.float32, mode="r", shape=(self.count, self.dimension))
+        return np.array(vectors[[self.rows[key] for key in keys]])
+
+
+def write_progress(progress, progress_file=PROGRESS_FILE):
+    progress = {**progress, "updated_at": datetime.now().isoformat(timespec="seconds")}
+    with open(progress_file + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(progress, file, indent=4)
+    os.replace(progress_file + ".tmp", progress_file)
+
+
+def embed_into_pack(pack, embedder, texts, hashes, token_counts, tokens_per_minute=TOKENS_PER_MINUTE,
+                    batch_size=BATCH_SIZE, progress=None):
+    """Embeds every text whose hash is not in the pack yet, throttled to a token budget."""
+    missing = []
+    queued = set()
+    for row, key in enumerate(hashes):
+        if key not in pack and key not in queued:  # Duplicate texts are embedded once
+            queued.add(key)
+            missing.append(row)
+    progress = {**(progress or {}), "status": "embedding", "total": len(missing), "embedded": 0,
+                "reused": len(hashes) - len(missing), "tokens": 0}
+    write_progress(progress)
+    logging.info(f"🚀 Embedding {len(missing)} chunks ({progress['reused']} reused from the pack)")
+
+    start_time = time.time()
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        vectors = embedder.embed([fit_embedding_input(texts[row], token_count=token_counts[row]) for row in batch])
+        pack.add([hashes[row] for row in batch], vectors)
+
+        progress["embedded"] += len(batch)
+        progress["tokens"] += int(sum(token_counts[row] for row in batch))
+        elapsed = time.time() - start_time
+        rate = progress["embedded"] / elapsed if elapsed else 0
+        progress["eta_seconds"] = round((progress["total"] - progress["embedded"]) / rate) if rate else None
+        write_progress(progress)
+        logging.info(f"Embedded {progress['embedded']}/{progress['total']} chunks ({progress['tokens']} tokens)")
+
+        if tokens_per_minute:
+            # Sleep until the tokens spent so far fit the budget
+            time.sleep(max(0.0, start_time + progress["tokens"] * 60 / tokens_per_minute - time.time()))
+    return progress
+
+
+def load_query_set(texts, query_file=QUERY_SET_FILE, sample=SAMPLE_QUERIES, seed=0):
+    """Evaluation queries from query_file, or passages sampled from the chunks.
+
+    A sampled query is a span of about 30 words from the middle of a chunk,
+    and that chunk is the one relevant result.
+    """
+    if os.path.exists(query_file):
+        with open(query_file, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    queries = []
+    for vector_id in random.Random(seed).sample(range(len(texts)), min(sample, len(texts))):
+        words = texts[vector_id].split()
+        middle = len(words) // 2
+        queries.append({"query": " ".join(words[max(0, middle - 15):middle + 15]), "relevant": [vector_id]})
+    return [query for query in queries if query["query"]]
+
+
+def recall_at_k(index, embedder, queries, k=RECALL_K):
+    """Average share of each query's relevant vectors found in its top k."""
+    if not queries:
+        return 0.0
+    vectors = embedder.embed_queries([query["query"] for query in queries])
+    _, indices = index.search(np.ascontiguousarray(vectors, dtype=np.float32), k)
+    return float(np.mean([
+        len(set(query["relevant"]) & set(found.tolist())) / min(len(query["relevant"]), k)
+        for query, found in zip(queries, indices)
+    ]))
+
+
+def variant_path(index_file, variant):
+    """faiss_index.bin -> faiss_index.<variant>.bin"""
+    base, extension = os.path.splitext(index_file)
+    return f"{base}.{variant}{extension}"
+
+
+def switch_index(index_file, source_file):
+    """Makes source_file (and its manifest) the live index, keeping the live one as the previous generation.
+
+    Every file moves with os.replace, so readers never see a partial file,
+    and load_index retries a read that lands between the index and its manifest.
+    """
+    previous = variant_path(index_file, "previous")
+    kept = [(index_file, previous), (manifest_path(index_file), manifest_path(previous))]
+    # Set the live generation aside first: when rolling back, source_file is the previous generation
+    for live, target in kept:
+        if os.path.exists(live):
+            try:
+                os.link(live, target + ".tmp")  # Instant, and keeps the mtime its manifest refers to
+            except OSError:
+                shutil.copy2(live, target + ".tmp")
+
+    os.replace(source_file, index_file)
+    os.replace(manifest_path(source_file), manifest_path(index_file))
+
+    for _, target in kept:
+        if os.path.exists(target + ".tmp"):
+            os.replace(target + ".tmp", target)
+
+
+def rollback_index(index_file=FAISS_INDEX_FILE):
+    """Switches back to the previous index generation (switching again rolls forward)."""
+    previous = variant_path(index_file, "previous")
+    if not os.path.exists(previous) or not os.path.exists(manifest_path(previous)):
+        logging.error(f"❌ No previous generation of {index_file} to roll back to")
+        return False
+    switch_index(index_file, previous)
+    manifest = load_index_manifest(index_file)
+    logging.info(f"✅ Rolled back {index_file} to {embedder_spec(manifest['embedder'])}")
+    return True
+
+
+def run_migration(target_spec, index_file=FAISS_INDEX_FILE, chunks_file=PROCESSED_FILE,
+                  tokens_per_minute=TOKENS_PER_MINUTE, batch_size=BATCH_SIZE,
+                  min_recall_ratio=MIN_RECALL_RATIO, switch=True):
+    """Re-embeds the corpus with another embedder into a shadow index and switches to it.
+
+    The live index keeps serving while the shadow index is built. The switch
+    only happens if the shadow index's recall on the query set is at least
+    min_recall_ratio of the live index's; the live index is kept for rollback.
+    Returns a report, or None if the migration could not run.
+    """
+    start_time = time.time()
+    live_index, live_embedder = load_index(index_file)
+    chunks = load_chunks(chunks_file)
+    if live_index.ntotal != len(chunks):
+        # Vectors added by incremental or client updates have no stored text to re-embed
+        logging.error(f"❌ {index_file} has {live_index.ntotal} vectors but {chunks_file} has {len(chunks)} chunks. "
+                      f"Run a full rebuild before migrating.")
+        return None
+
+    live_spec = embedder_spec(live_embedder.describe())
+    if live_spec == target_spec:
+        logging.info(f"{index_file} is already built with {target_spec}")
+        return None
+
+    target = get_embedder(target_spec)
+    stats = load_chunk_stats(chunks=chunks) or compute_chunk_stats(chunks)
+    texts = [chunk["text"] if isinstance(chunk, dict) else chunk for chunk in chunks]
+    progress = {"from": live_spec, "to": target_spec}
+
+    # 1. Embed into the pack, then build the shadow index from it in vector id order
+    pack = EmbeddingPack(target_spec, target.dimension)
+    progress = embed_into_pack(pack, target, texts, stats["content_hash"], stats["token_count"],
+                               tokens_per_minute, batch_size, progress)
+    shadow = create_hnsw_index(target.dimension)
+    shadow.add(pack.get(stats["content_hash"]))
+    shadow_file = variant_path(index_file, "shadow")
+    faiss.write_index(shadow, shadow_file)
+    save_index_manifest(shadow_file, target)
+
+    # 2. Compare recall before switching
+    write_progress({**progress, "status": "evaluating"})
+    queries = load_query_set(texts)
+    recall = {"live": recall_at_k(live_index, live_embedder, queries),
+              "shadow": recall_at_k(shadow, target, queries)}
+    passed = recall["shadow"] >= min_recall_ratio * recall["live"]
+    logging.info(f"Recall@{RECALL_K} on {len(queries)} queries: live {recall['live']:.3f}, shadow {recall['shadow']:.3f}")
+
+    # 3. Switch atomically, keeping the live generation for rollback
+    switched = passed and switch
+    if switched:
+        if load_index_manifest(index_file) is None:
+            save_index_manifest(index_file, live_embedder)  # So the kept generation can be switched back in
+        switch_index(index_file, shadow_file)
+        logging.info(f"✅ Switched {index_file} from {live_spec} to {target_spec}")
+    elif not passed:
+        logging.warning(f"⚠ Recall dropped below {min_recall_ratio:.0%} of the live index, keeping {live_spec}. "
+                        f"The shadow index is in {shadow_file}.")
+
+    report = {**progress, "status": "switched" if switched else "built", "recall": recall,
+              "queries": len(queries), "seconds": round(time.time() - start_time, 1)}
+    write_progress(report)
+    return report
@@ -0,0 +1,105 @@
+import os
+import re
+import json
+import logging
+from collections import Counter
+from functools import lru_cache
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+VOCABULARY_FILE = os.path.join(BASE_DIR, "entity_vocabulary.json")
+
+# Optional plural suffix accepted after every term ("soils", "emissions")
+PLURAL_SUFFIX = r"(?:e?s)?"
+
+
+def _trie_pattern(terms):
+    """Builds a regex alternation from a trie of terms, so shared prefixes are matched once.
+
+    A flat alternation of thousands of terms makes the regex engine try each
+    branch in turn; the trie form keeps matching close to linear in the text.
+    """
+    trie = {}
+    for term in terms:
+        node = trie
+        for char in term:
+            node = node.setdefault(char, {})
+        node[""] = True
+
+    def to_regex(node):
+        is_end = node.get("", False)
+        branches = [
+            (r"\s+" if char == " " else re.escape(char)) + to_regex(child)
+            for char, child in sorted(node.items()) if char
+        ]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if is_end:
+            return "(?:" + body + ")?"
+        return body
+
+    return to_regex(trie)
+
+
+class EntityMatcher:
+    """Compiled multi-term matcher mapping surface forms to canonical entities.
+
+    Matching is case-insensitive, respects word boundaries ("soil" does not
+    match "subsoil") and accepts simple plurals.
+    """
+
+    def __init__(self, entity_terms):
+        self.term_to_entity = {}
+        for entity, terms in entity_terms.items():
+            for term in [entity, *terms]:
+                self.term_to_entity[" ".join(term.lower().split())] = entity
+
+        self.entities = list(entity_terms)
+        if self.term_to_entity:
+            pattern = r"\b(" + _trie_pattern(self.term_to_entity) + r")" + PLURAL_SUFFIX + r"\b"
+            self.pattern = re.compile(pattern, re.IGNORECASE)
+        else:
+            self.pattern = None
+
+    def _entity_for(self, matched):
+        return self.term_to_entity.get(" ".join(matched.lower().split()))
+
+    def find_entities(self, text):
+        """Returns the set of entities mentioned in a text."""
+        if self.pattern is None:
+            return set()
+        return {self._entity_for(match.group(1)) for match in self.pattern.finditer(text)}
+
+    def count_entities(self, text):
+        """Returns per-entity hit counts for a text."""
+        if self.pattern is None:
+            return Counter()
+        return Counter(self._entity_for(match.group(1)) for match in self.pattern.finditer(text))
+
+
+def load_vocabulary(file_path=VOCABULARY_FILE):
+    """Loads the entity vocabulary as {entity: [surface forms]}, flattening its categories."""
+    with open(file_path, "r", encoding="utf-8") as file:
+        vocabulary = json.load(file)
+
+    entity_terms = {}
+    for category, entities in vocabulary.items():
+        for entity, terms in entities.items():
+            entity_terms.setdefault(entity, []).extend(terms)
+
+    logging.info(f"Loaded {len(entity_terms)} entities from {file_path}")
+    return entity_terms
+
+
+@lru_cache(maxsize=None)
+def get_vocabulary_matcher(file_path=VOCABULARY_FILE):
+    """Returns the matcher for the vocabulary file, compiled once per process."""
+    return EntityMatcher(load_vocabulary(file_path))
+
+
+@lru_cache(maxsize=32)
+def get_matcher(target_entities=None):
+    """Returns a matcher for a tuple of target entities, or for the vocabulary file if None."""
+    if target_entities is None:
+        return get_vocabulary_matcher()
+    return EntityMatcher({entity: [] for entity in target_entities})
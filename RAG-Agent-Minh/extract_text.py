@@ -19,8 +19,8 @@ def extract_text_from_pdf(file_path):
     try:
         with fitz.open(file_path) as doc:
             metadata = doc.metadata  # Extract metadata from PDF
-            for page in doc:
-                text += page.get_text() + "\n"
+            # Pages are separated by a form feed so cleaning can spot running headers/footers
+            text = "\f".join(page.get_text() for page in doc)
         logging.info(f"Extracted text from PDF: {file_path}")
     except Exception as e:
         logging.error(f"Error extracting text from PDF {file_path}: {e}")
@@ -49,18 +49,29 @@ def extract_text_from_docx(file_path):
         logging.error(f"Error extracting text from DOCX {file_path}: {e}")
     return text, {}
 
-def process_directory(directory, topic="General"):
-    """Process all files in a directory, including subdirectories."""
-    supported_formats = {
-        ".pdf": extract_text_from_pdf,
-        ".txt": extract_text_from_txt,
-        ".docx": extract_text_from_docx,
-    }
-    
-    extracted_data = []
-    
+SUPPORTED_FORMATS = {
+    ".pdf": extract_text_from_pdf,
+    ".txt": extract_text_from_txt,
+    ".docx": extract_text_from_docx,
+}
+
+def extract_text_from_file(file_path):
+    """Extracts text from a single supported file (empty string if unsupported)."""
+    file_extension = os.path.splitext(file_path)[1].lower()
+    if file_extension not in SUPPORTED_FORMATS:
+        logging.warning(f"Skipping unsupported file: {file_path}")
+        return ""
+    text, _ = SUPPORTED_FORMATS[file_extension](file_path)
+    return text
+
+def iter_directory(directory, topic="General", skip=None):
+    """Yields extracted documents one at a time from a directory and its subdirectories.
+
+    Files whose path is in skip (e.g. already indexed by a resumed rebuild) are not read.
+    """
     for root, dirs, files in os.walk(directory):
-        for filename in files:
+        dirs.sort()
+        for filename in sorted(files):
             file_path = os.path.join(root, filename)
             file_extension = os.path.splitext(filename)[1].lower()
             
@@ -69,9 +80,12 @@ def process_directory(directory, topic="General"):
             if current_topic == "docs":
                 current_topic = topic
                 
-            if file_extension in supported_formats:
+            if file_extension in SUPPORTED_FORMATS:
+                if skip and file_path in skip:
+                    logging.info(f"Skipping already processed file: {filename}")
+                    continue
                 logging.info(f"Processing file: {filename} (Topic: {current_topic})")
-                text, metadata = supported_formats[file_extension](file_path)
+                text, metadata = SUPPORTED_FORMATS[file_extension](file_path)
                 
                 # Skip if extraction failed (empty text)
                 if not text.strip():
@@ -89,17 +103,19 @@ def process_directory(directory, topic="General"):
                 metadata["source"] = "document_extraction"
                 metadata["topic"] = current_topic
                 
-                extracted_data.append({
+                yield {
                     "filename": file_path,
                     "file_type": file_extension,
                     "metadata": metadata,
                     "text": text
-                })
+                }
             else:
                 if file_extension:  # Only log warnings for actual files, not directories
                     logging.warning(f"Skipping unsupported file: {filename}")
-    
-    return extracted_data
+
+def process_directory(directory, topic="General"):
+    """Process all files in a directory, including subdirectories."""
+    return list(iter_directory(directory, topic))
 
 def extract_text_from_files():
     """Extract text from all documents in the docs folder and its subfolders."""
@@ -1,8 +1,8 @@
 import os
 import json
 import logging
-import tiktoken
-from advanced_chunking import optimized_chunking_pipeline
+from chunk_splitter import split_oversized_chunks, MAX_CHUNK_TOKENS
+from chunk_stats import get_token_counts, compute_chunk_stats, save_chunk_stats
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -10,10 +10,13 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(
 # File paths
 CHUNKS_FILE = "processed_chunks.json"
 FIXED_CHUNKS_FILE = "processed_chunks_fixed.json"
-MAX_TOKENS = 6000  # Keep this well below the 8192 limit to be safe
+MAX_TOKENS = MAX_CHUNK_TOKENS  # Keep this well below the 8192 limit to be safe
 
 def fix_oversized_chunks():
-    """Identifies and fixes chunks that exceed the token limit."""
+    """Splits chunks that exceed the token limit in an existing chunks file.
+
+    New chunk files are already split at chunking time; this repairs older ones.
+    """
     try:
         # Load existing chunks
         with open(CHUNKS_FILE, "r", encoding="utf-8") as f:
@@ -21,40 +24,19 @@ def fix_oversized_chunks():
         
         logging.info(f"Loaded {len(chunks)} chunks for analysis")
         
-        # Initialize the tokenizer
-        encoding = tiktoken.get_encoding("cl100k_base")
-        
-        # Identify oversized chunks
-        oversized_chunks = []
-        normal_chunks = []
-        
-        for i, chunk in enumerate(chunks):
-            text = chunk["text"]
-            tokens = encoding.encode(text)
-            token_count = len(tokens)
-            
-            if token_count > MAX_TOKENS:
-                logging.warning(f"Chunk {i} has {token_count} tokens (exceeds {MAX_TOKENS})")
-                oversized_chunks.append((i, chunk))
-            else:
-                normal_chunks.append(chunk)
+        # Token counts come from the chunking stage's side file when it is current
+        token_counts = get_token_counts(chunks)
+        oversized = [i for i, token_count in enumerate(token_counts) if token_count > MAX_TOKENS]
+        for i in oversized:
+            logging.warning(f"Chunk {i} has {token_counts[i]} tokens (exceeds {MAX_TOKENS})")
         
-        logging.info(f"Found {len(oversized_chunks)} oversized chunks out of {len(chunks)} total chunks")
+        logging.info(f"Found {len(oversized)} oversized chunks out of {len(chunks)} total chunks")
+        if not oversized:
+            return 0, len(chunks)
         
-        # Process oversized chunks
-        fixed_chunks = []
-        for i, chunk in oversized_chunks:
-            logging.info(f"Re-chunking oversized chunk {i}")
-            metadata = chunk["metadata"]
-            text = chunk["text"]
-            
-            # Apply optimized chunking to large text
-            rechunked = optimized_chunking_pipeline(text, metadata)
-            fixed_chunks.extend(rechunked)
-            logging.info(f"Split into {len(rechunked)} smaller chunks")
-        
-        # Combine normal and fixed chunks
-        final_chunks = normal_chunks + fixed_chunks
+        # Split oversized chunks at paragraph/sentence boundaries, keeping the chunk order
+        final_chunks = split_oversized_chunks(chunks, MAX_TOKENS)
+        fixed_count = len(final_chunks) - (len(chunks) - len(oversized))
         logging.info(f"Final chunk count: {len(final_chunks)}")
         
         # Create backup of original file
@@ -68,7 +50,10 @@ def fix_oversized_chunks():
             json.dump(final_chunks, f, indent=2, ensure_ascii=False)
         
         logging.info(f"Fixed chunks saved to {CHUNKS_FILE}")
-        return len(fixed_chunks), len(normal_chunks)
+
+        # Keep the statistics side file in sync with the rewritten chunks
+        save_chunk_stats(compute_chunk_stats(final_chunks))
+        return fixed_count, len(chunks) - len(oversized)
         
     except Exception as e:
         logging.error(f"Error fixing chunks: {e}")
@@ -0,0 +1,88 @@
+import os
+import json
+import logging
+
+
+def iter_jsonl(file_path):
+    """Yields one record per non-empty line of a JSONL file."""
+    with open(file_path, "r", encoding="utf-8") as file:
+        for line_number, line in enumerate(file, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                # A crash mid-write can leave a truncated last line
+                logging.warning(f"Skipping unreadable line {line_number} in {file_path}: {e}")
+
+
+def append_jsonl(file, records):
+    """Appends records to an open JSONL file and flushes, so a crash loses at most one line."""
+    for record in records:
+        file.write(json.dumps(record, ensure_ascii=False) + "\n")
+    file.flush()
+
+
+def write_json_array_from_jsonl(jsonl_path, json_path):
+    """Writes a JSON array file from a JSONL file one line at a time.
+
+    Keeps memory flat while producing the processed_chunks.json format that the
+    index build and the UIs read. The file is written next to the target and
+    renamed into place so readers never see a half-written file.
+    """
+    tmp_path = json_path + ".tmp"
+    count = 0
+    with open(tmp_path, "w", encoding="utf-8") as out_file:
+        out_file.write("[\n")
+        for record in iter_jsonl(jsonl_path):
+            if count:
+                out_file.write(",\n")
+            out_file.write(json.dumps(record, ensure_ascii=False))
+            count += 1
+        out_file.write("\n]\n")
+    os.replace(tmp_path, json_path)
+    return count
+
+
+def read_records(file_path):
+    """Reads all records from either a JSON array file or a JSONL file."""
+    if file_path.endswith(".jsonl"):
+        return list(iter_jsonl(file_path))
+    with open(file_path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def write_json_object_from_jsonl(jsonl_path, json_path, key_field="id", value_field="value"):
+    """Writes a JSON object file from JSONL records of {key_field: ..., value_field: ...}.
+
+    Used to produce faiss_metadata.json without holding the whole mapping in memory.
+    """
+    tmp_path = json_path + ".tmp"
+    count = 0
+    with open(tmp_path, "w", encoding="utf-8") as out_file:
+        out_file.write("{\n")
+        for record in iter_jsonl(jsonl_path):
+            if count:
+                out_file.write(",\n")
+            out_file.write(f"{json.dumps(str(record[key_field]))}: {json.dumps(record[value_field], ensure_ascii=False)}")
+            count += 1
+        out_file.write("\n}\n")
+    os.replace(tmp_path, json_path)
+    return count
+
+
+def truncate_jsonl(file_path, keep_records):
+    """Keeps only the first keep_records records of a JSONL file (drops a partial tail)."""
+    if not os.path.exists(file_path):
+        return 0
+    tmp_path = file_path + ".tmp"
+    kept = 0
+    with open(tmp_path, "w", encoding="utf-8") as out_file:
+        for record in iter_jsonl(file_path):
+            if kept >= keep_records:
+                break
+            out_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            kept += 1
+    os.replace(tmp_path, file_path)
+    return kept
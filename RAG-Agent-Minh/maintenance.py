@@ -1,55 +1,81 @@
 # maintenance.py
 import os
 import json
+import shutil
 import logging
 import time
 from datetime import datetime
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+def referenced_embedding_models(index_file, progress_file="migration_progress.json"):
+    """Models whose cached embeddings may still be needed.
+
+    These are the models of the live index, of the generation a rollback
+    would return to, of a shadow index waiting to be switched in, and both
+    sides of the last migration (which may still be running).
+    """
+    from embedders import resolve_embedder, load_index_manifest, parse_embedder_spec
+
+    models = {resolve_embedder(index_file).model}
+    # Named like embedding_migration.variant_path, without importing the embedding pipeline
+    base, extension = os.path.splitext(index_file)
+    for variant in ("previous", "shadow"):
+        manifest = load_index_manifest(f"{base}.{variant}{extension}")
+        if manifest:
+            models.add(manifest["embedder"]["model"])
+    if os.path.exists(progress_file):
+        with open(progress_file, "r", encoding="utf-8") as file:
+            progress = json.load(file)
+        for spec in (progress.get("from"), progress.get("to")):
+            if spec:
+                models.add(parse_embedder_spec(spec)[1])
+    return models
+
 def perform_maintenance():
     """Perform routine maintenance on the RAG system."""
-    
+    # Every step runs in this process, so faiss and the embedding client are loaded once
+    from vectorize_store_faiss import remove_clients_data, load_new_documents, incremental_update
+
     # 1. Check for expired client data
     client_expiry_file = "client_expiry.json"
     if os.path.exists(client_expiry_file):
         try:
             with open(client_expiry_file, "r") as f:
                 expiry_data = json.load(f)
-                
+
             today = datetime.now().strftime("%Y-%m-%d")
-            expired_clients = []
-            
-            for client_id, data in expiry_data.items():
-                if data["expiry_date"] <= today:
-                    # Run client removal
-                    os.system(f"python vectorize_store_faiss.py --remove-client {client_id}")
-                    expired_clients.append(client_id)
-            
+            expired_clients = [
+                client_id for client_id, data in expiry_data.items()
+                if data["expiry_date"] <= today
+            ]
+
             if expired_clients:
+                # Remove all expired clients with a single index rewrite
+                remove_clients_data(expired_clients)
                 logging.info(f"Removed expired client data for: {', '.join(expired_clients)}")
         except Exception as e:
             logging.error(f"Error processing client expiry data: {e}")
-    
+
     # 2. Check for new documents
     try:
-        os.system("python vectorize_store_faiss.py --discover")
-        logging.info("Checked for new documents")
+        added = incremental_update(load_new_documents())
+        logging.info(f"Checked for new documents ({added} chunks added)")
     except Exception as e:
         logging.error(f"Error checking for new documents: {e}")
-    
+
     # 3. Backup current vector database
     backup_dir = "backups"
     os.makedirs(backup_dir, exist_ok=True)
-    
+
     today = datetime.now().strftime("%Y-%m-%d")
     try:
-        os.system(f"cp faiss_index.bin {backup_dir}/faiss_index_{today}.bin")
-        os.system(f"cp faiss_metadata.json {backup_dir}/faiss_metadata_{today}.json")
+        shutil.copy2("faiss_index.bin", f"{backup_dir}/faiss_index_{today}.bin")
+        shutil.copy2("faiss_metadata.json", f"{backup_dir}/faiss_metadata_{today}.json")
         logging.info(f"Created backup in {backup_dir}")
     except Exception as e:
         logging.error(f"Error creating backup: {e}")
-    
+
     # 4. Optimize index (only for large indices)
     try:
         import faiss
@@ -59,11 +85,25 @@ def perform_maintenance():
                 if hasattr(index, 'hnsw'):
                     logging.info("Running HNSW optimization...")
                     index.hnsw.optimize()
-                    faiss.write_index(index, "faiss_index.bin")
+                    from embedders import write_index, refresh_index_manifest
+                    write_index(index, "faiss_index.bin")
+                    refresh_index_manifest("faiss_index.bin")
     except Exception as e:
         logging.error(f"Error optimizing index: {e}")
-        
+
+    # 5. Drop cached embeddings of models no index generation or migration uses
+    try:
+        from embedding_cache import get_cache_stats, clear_cache
+        if os.path.exists("faiss_index.bin"):
+            models_in_use = referenced_embedding_models("faiss_index.bin")
+            for model in get_cache_stats()["models"]:
+                if model not in models_in_use:
+                    cleared = clear_cache(model)
+                    logging.info(f"Cleared {cleared} stale cached embeddings of {model}")
+    except Exception as e:
+        logging.error(f"Error clearing stale embedding caches: {e}")
+
     logging.info("Maintenance completed")
 
 if __name__ == "__main__":
-    perform_maintenance()
\ No newline at end of file
+    perform_maintenance()
@@ -0,0 +1,110 @@
+import bisect
+import hashlib
+from collections import defaultdict
+from typing import List, Dict
+
+import numpy as np
+
+# Estimated Jaccard similarity of word shingles above which two chunks are duplicates
+DEFAULT_SIMILARITY_THRESHOLD = 0.8
+
+SHINGLE_SIZE = 5  # Words per shingle
+NUM_PERMUTATIONS = 64
+NUM_BANDS = 16  # 16 bands x 4 rows: candidate pairs start appearing around 0.5 similarity
+
+_rng = np.random.RandomState(1)  # Fixed seed so signatures are stable across runs
+_HASH_A = _rng.randint(1, 2 ** 62, size=NUM_PERMUTATIONS, dtype=np.int64).astype(np.uint64) | np.uint64(1)
+_HASH_B = _rng.randint(0, 2 ** 62, size=NUM_PERMUTATIONS, dtype=np.int64).astype(np.uint64)
+
+
+def _stable_hash(value: str) -> int:
+    """32-bit hash that does not change between processes (unlike hash())."""
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=4).digest(), "little")
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> np.ndarray:
+    """Returns the hashed word shingles of a text as a uint64 array."""
+    words = text.lower().split()
+    if not words:
+        return np.zeros(1, dtype=np.uint64)
+    size = min(size, len(words))
+    grams = {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+    return np.fromiter((_stable_hash(gram) for gram in grams), dtype=np.uint64, count=len(grams))
+
+
+def minhash_signature(shingle_hashes: np.ndarray) -> np.ndarray:
+    """Computes a MinHash signature with multiply-shift hashing (uint64 wrap-around is intended)."""
+    with np.errstate(over="ignore"):
+        hashed = (shingle_hashes[:, None] * _HASH_A[None, :] + _HASH_B[None, :]) >> np.uint64(32)
+    return hashed.min(axis=0)
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def find_contained(texts: List[str]) -> Dict[int, int]:
+    """Finds texts that sit entirely inside another text (after normalisation), exact duplicates included.
+
+    Texts are checked longest first against the texts kept so far, which are
+    joined into one string so each check is a single substring search.
+    Returns a mapping of contained index -> index of a text containing it.
+    """
+    normalized = [_normalize(text) for text in texts]
+    kept, starts = [], []
+    joined = ""
+    contained = {}
+    for i in sorted(range(len(texts)), key=lambda i: (-len(normalized[i]), i)):
+        position = joined.find(normalized[i])
+        if position >= 0 and kept:
+            contained[i] = kept[bisect.bisect_right(starts, position) - 1]
+            continue
+        kept.append(i)
+        starts.append(len(joined))
+        joined += normalized[i] + "\0"
+    return contained
+
+
+def find_near_duplicates(texts: List[str], threshold: float = DEFAULT_SIMILARITY_THRESHOLD,
+                         num_bands: int = NUM_BANDS, containment: bool = True) -> Dict[int, int]:
+    """Finds near-duplicate texts with MinHash and locality-sensitive hashing.
+
+    With containment, texts contained in another text are duplicates of it
+    (that check grows with the total text length, so corpus-wide scans may
+    turn it off). The rest are scanned in order; each one is compared only
+    with earlier kept texts that share an LSH bucket. Returns a mapping of
+    duplicate index -> index of the kept text it duplicates.
+    """
+    rows = NUM_PERMUTATIONS // num_bands
+    buckets = defaultdict(list)
+    signatures = {}
+    duplicates = find_contained(texts) if containment else {}
+
+    for i, text in enumerate(texts):
+        if i in duplicates:
+            continue
+
+        signature = minhash_signature(shingles(_normalize(text)))
+        band_keys = [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(num_bands)]
+
+        candidates = {kept for key in band_keys for kept in buckets.get(key, ())}
+        best_match, best_similarity = None, threshold
+        for kept in sorted(candidates):
+            similarity = float(np.mean(signatures[kept] == signature))
+            if similarity >= best_similarity:
+                best_match, best_similarity = kept, similarity
+
+        if best_match is not None:
+            duplicates[i] = best_match
+            continue
+
+        signatures[i] = signature
+        for key in band_keys:
+            buckets[key].append(i)
+
+    # A container may itself be a near-duplicate: point at the text that is kept
+    for i, kept in duplicates.items():
+        while kept in duplicates:
+            kept = duplicates[kept]
+        duplicates[i] = kept
+    return duplicates
@@ -0,0 +1,262 @@
+# orchestrator.py
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Input fingerprints of the last successful run of each stage
+STATE_FILE = "pipeline_state.json"
+
+try:
+    import resource  # Not available on Windows
+except ImportError:
+    resource = None
+
+
+def peak_memory_mb():
+    """Returns the peak resident memory of this process in MB (None if unknown)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_task(description, func, *args, **kwargs):
+    """Runs a library call in this process with timing and memory logging.
+
+    Returns (result, report); a failed task is logged and has result None.
+    """
+    logging.info(f"Starting: {description}")
+    start_time = time.perf_counter()
+    memory_before = peak_memory_mb()
+    report = {"name": description, "status": "ok"}
+    result = None
+
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        logging.error(f"Failed: {description} ({e})")
+        report["status"] = "failed"
+
+    report["seconds"] = time.perf_counter() - start_time
+    memory_after = peak_memory_mb()
+    if memory_after is not None:
+        report["peak_memory_mb"] = memory_after
+        report["memory_growth_mb"] = memory_after - memory_before
+
+    if report["status"] == "ok":
+        memory = f", peak memory {memory_after:.0f} MB" if memory_after is not None else ""
+        logging.info(f"Completed: {description} in {report['seconds']:.2f} seconds{memory}")
+    return result, report
+
+
+def stage(name, func, inputs=(), outputs=(), deps=(), params=None):
+    """Describes one pipeline stage: a callable with the files it reads and writes."""
+    return {
+        "name": name,
+        "func": func,
+        "inputs": list(inputs),
+        "outputs": list(outputs),
+        "deps": list(deps),
+        "params": params or {},
+    }
+
+
+def path_fingerprint(path):
+    """Size and modification time of a file, or of every supported file under a directory."""
+    if not os.path.exists(path):
+        return None
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    entries = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for filename in sorted(files):
+            file_path = os.path.join(root, filename)
+            stat = os.stat(file_path)
+            entries.append([os.path.relpath(file_path, path), stat.st_size, stat.st_mtime_ns])
+    return entries
+
+
+def stage_fingerprint(stage_def):
+    """Hashes a stage's input files together with its parameters."""
+    payload = {
+        "inputs": {path: path_fingerprint(path) for path in stage_def["inputs"]},
+        "params": stage_def["params"],
+    }
+    return hashlib.md5(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def topological_order(stages):
+    """Orders stages so every stage runs after its dependencies."""
+    by_name = {stage_def["name"]: stage_def for stage_def in stages}
+    ordered = []
+    visiting = set()
+    done = set()
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f"Pipeline has a dependency cycle through '{name}'")
+        if name not in by_name:
+            raise ValueError(f"Unknown pipeline stage '{name}'")
+        visiting.add(name)
+        for dep in by_name[name]["deps"]:
+            visit(dep)
+        visiting.discard(name)
+        done.add(name)
+        ordered.append(by_name[name])
+
+    for stage_def in stages:
+        visit(stage_def["name"])
+    return ordered
+
+
+def load_state(state_file=STATE_FILE):
+    """Loads the fingerprints recorded by previous runs."""
+    if not os.path.exists(state_file):
+        return {}
+    try:
+        with open(state_file, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except Exception as e:
+        logging.warning(f"Could not read pipeline state from {state_file}: {e}")
+        return {}
+
+
+def save_state(state, state_file=STATE_FILE):
+    """Writes the stage fingerprints atomically."""
+    tmp_path = state_file + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(state, file, indent=4)
+    os.replace(tmp_path, state_file)
+
+
+def run_pipeline(stages, force=False, state_file=STATE_FILE):
+    """Runs stages in dependency order inside this process.
+
+    Models, NLTK data and API clients loaded by one stage stay warm for the next.
+    A stage is skipped when its inputs and parameters match its last successful
+    run, its outputs still exist and none of its dependencies ran again. The run
+    stops at the first stage that fails or does not write its outputs.
+    Returns one report per stage with its status, time and memory.
+    """
+    state = load_state(state_file)
+    reran = set()
+    reports = []
+
+    for stage_def in topological_order(stages):
+        name = stage_def["name"]
+        fingerprint = stage_fingerprint(stage_def)
+        outputs_exist = all(os.path.exists(path) for path in stage_def["outputs"])
+
+        if (not force and outputs_exist and state.get(name) == fingerprint
+                and not reran.intersection(stage_def["deps"])):
+            logging.info(f"⏭️ Skipping {name}: inputs unchanged since the last run")
+            reports.append({"name": name, "status": "skipped", "seconds": 0.0})
+            continue
+
+        outputs_before = {path: path_fingerprint(path) for path in stage_def["outputs"]}
+        _, report = run_task(name, stage_def["func"])
+        reports.append(report)
+
+        # Most stages log and swallow their own errors, so check they wrote something
+        stale = [path for path in stage_def["outputs"]
+                 if path_fingerprint(path) in (None, outputs_before[path])]
+        if report["status"] == "ok" and stale:
+            logging.error(f"Failed: {name} did not write {', '.join(stale)}")
+            report["status"] = "failed"
+
+        if report["status"] != "ok":
+            state.pop(name, None)
+            save_state(state, state_file)
+            break
+
+        reran.add(name)
+        state[name] = fingerprint
+        save_state(state, state_file)
+
+    log_reports(reports)
+    return reports
+
+
+def log_reports(reports):
+    """Logs a one-line summary per stage."""
+    for report in reports:
+        memory = report.get("peak_memory_mb")
+        memory = f", peak memory {memory:.0f} MB" if memory is not None else ""
+        logging.info(f"  {report['name']}: {report['status']} ({report['seconds']:.2f} seconds{memory})")
+
+
+def rebuild_stages(use_advanced_pipeline=True, boundary_method=None, workers=1):
+    """Stages of a full rebuild: extract -> preprocess -> chunk -> embed."""
+    import extract_text
+    import preprocess_text
+    import semantic_chunking
+    import vectorize_store_faiss
+    from embedders import current_embedder_spec, manifest_path
+
+    boundary_method = boundary_method or semantic_chunking.BOUNDARY_METHOD
+
+    def embed():
+        chunks = vectorize_store_faiss.load_chunks(vectorize_store_faiss.PROCESSED_FILE)
+        return vectorize_store_faiss.store_embeddings_in_faiss(chunks)
+
+    return [
+        stage("extract", extract_text.extract_text_from_files,
+              inputs=[extract_text.DOCS_FOLDER], outputs=[extract_text.OUTPUT_FILE]),
+        stage("preprocess", preprocess_text.preprocess_text,
+              inputs=[preprocess_text.INPUT_FILE], outputs=[preprocess_text.OUTPUT_FILE],
+              deps=["extract"]),
+        stage("chunk",
+              lambda: semantic_chunking.process_text(use_advanced_pipeline, boundary_method, workers),
+              inputs=[semantic_chunking.INPUT_FILE], outputs=[semantic_chunking.OUTPUT_FILE],
+              deps=["preprocess"],
+              params={"use_advanced_pipeline": use_advanced_pipeline,
+                      "boundary_method": boundary_method, "workers": workers}),
+        stage("embed", embed,
+              inputs=[vectorize_store_faiss.PROCESSED_FILE],
+              outputs=[vectorize_store_faiss.FAISS_INDEX_FILE, vectorize_store_faiss.METADATA_FILE,
+                       manifest_path(vectorize_store_faiss.FAISS_INDEX_FILE)],
+              deps=["chunk"],
+              params={"embedder": current_embedder_spec()}),
+    ]
+
+
+def rebuild_index(use_advanced_pipeline=True, boundary_method=None, workers=1, force=False):
+    """Rebuilds the index in one process, skipping stages whose inputs did not change."""
+    return run_pipeline(rebuild_stages(use_advanced_pipeline, boundary_method, workers), force=force)
+
+
+def update_index():
+    """Discovers new documents anywhere under docs/ and adds them to the index."""
+    from vectorize_store_faiss import load_new_documents, incremental_update
+    added = incremental_update(load_new_documents())
+    logging.info(f"Discovered and added {added} chunks from new documents")
+    return added
+
+
+def add_client(client_id, client_dir=None):
+    """Adds a client's documents to the index as temporary data."""
+    from vectorize_store_faiss import load_client_chunks, store_client_embeddings
+    client_dir = client_dir or f"docs/clients/{client_id}"
+    client_chunks = load_client_chunks(client_dir, client_id)
+    client_ids = store_client_embeddings(client_chunks, client_id)
+    logging.info(f"Added {len(client_ids)} client chunks to the index")
+    return client_ids
+
+
+def remove_clients(client_ids):
+    """Removes the temporary data of one or more clients with a single index rewrite."""
+    from vectorize_store_faiss import remove_clients_data
+    removed = remove_clients_data(client_ids)
+    logging.info(f"Removed {removed} chunks for {', '.join(client_ids)}")
+    return removed
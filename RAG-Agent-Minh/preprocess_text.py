@@ -1,11 +1,9 @@
 import re
-import nltk
-from nltk.tokenize import sent_tokenize
 import logging
 import json
-
-# Download required NLTK model
-nltk.download("punkt")
+import unicodedata
+from collections import Counter
+from functools import lru_cache
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -14,11 +12,126 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(
 INPUT_FILE = "extracted_text.json"  # Extracted text in JSON format
 OUTPUT_FILE = "processed_text.json"  # Processed text output
 
-def clean_text(text):
-    """Cleans extracted text by removing excessive spaces while preserving meaningful content."""
-    text = re.sub(r"\s+", " ", text)  # Remove extra whitespaces
-    text = text.strip()
-    return text
+# Cleaning steps applied by clean_text (override per call with options=...)
+CLEANING_OPTIONS = {
+    "normalize_unicode": True,  # NFKC, drop invisible characters, straighten quotes
+    "strip_headers_footers": True,  # Lines repeated at the top/bottom of most PDF pages
+    "dehyphenate": True,  # "fertil-\nizer" -> "fertilizer"
+    "unwrap_lines": True,  # Join lines wrapped mid-sentence, keep headings and lists on their own line
+}
+
+# Page separator written by extract_text for PDFs
+PAGE_BREAK = "\f"
+
+# A line is treated as a running header/footer if it appears at the edge of this share of pages
+HEADER_FOOTER_MIN_SHARE = 0.5
+HEADER_FOOTER_MIN_PAGES = 3
+HEADER_FOOTER_EDGE_LINES = 2
+
+# Invisible characters dropped and typographic quotes straightened after NFKC
+_UNICODE_TRANSLATION = {
+    **{ord(char): None for char in "\u00ad\u200b\u200c\u200d\u2060\ufeff"},
+    **{ord(char): "'" for char in "\u2018\u2019\u201a\u201b"},
+    **{ord(char): '"' for char in "\u201c\u201d\u201e\u201f"},
+    ord("\r"): "\n",
+    ord(PAGE_BREAK): "\n",
+}
+_CONTROL_CHARS = re.compile(r"[\x00-\x08\x0b\x0e-\x1f\x7f]")
+
+_PAGE_NUMBER_LINE = re.compile(r"^(?:page\s+)?\d+(?:\s*(?:of|/)\s*\d+)?$", re.IGNORECASE)
+_DIGITS = re.compile(r"\d+")
+
+# Whitespace rules for the single pass, in priority order (name, pattern, replacement)
+_WHITESPACE_RULES = [
+    ("hyphen", r"(?<=\w)-[^\S\n]*\n[^\S\n]*(?=[a-z])", ""),
+    ("paragraph", r"[^\S\n]*\n(?:[^\S\n]*\n)+[^\S\n]*", "\n\n"),
+    ("wrap", r"(?<=[a-z,;])[^\S\n]*\n[^\S\n]*(?=[a-z(])", " "),
+    ("newline", r"[^\S\n]*\n[^\S\n]*", "\n"),
+    ("space", r"[^\S\n]+", " "),
+]
+
+_RULE_OPTIONS = {"hyphen": "dehyphenate", "wrap": "unwrap_lines"}
+
+
+@lru_cache(maxsize=None)
+def _whitespace_pattern(dehyphenate, unwrap_lines):
+    """Compiles the whitespace rules enabled by the options into one alternation."""
+    enabled = {"dehyphenate": dehyphenate, "unwrap_lines": unwrap_lines}
+    rules = [rule for rule in _WHITESPACE_RULES if enabled.get(_RULE_OPTIONS.get(rule[0]), True)]
+    pattern = re.compile("|".join(f"(?P<{name}>{regex})" for name, regex, _ in rules))
+    replacements = {name: replacement for name, _, replacement in rules}
+    return pattern, replacements
+
+
+def normalize_unicode(text):
+    """NFKC-normalises text (ligatures, full-width forms, non-breaking spaces) and drops invisible characters."""
+    text = unicodedata.normalize("NFKC", text.replace("\r\n", "\n"))
+    return _CONTROL_CHARS.sub("", text.translate(_UNICODE_TRANSLATION))
+
+
+def _line_key(line):
+    """Key used to spot repeated lines: case, spacing and page numbers ignored."""
+    return _DIGITS.sub("#", " ".join(line.lower().split()))
+
+
+def strip_headers_footers(text):
+    """Removes running headers, footers and page numbers from form-feed separated pages."""
+    pages = text.split(PAGE_BREAK)
+    if len(pages) < HEADER_FOOTER_MIN_PAGES:
+        return text
+
+    page_lines = [page.split("\n") for page in pages]
+
+    def edge_indices(lines):
+        content = [i for i, line in enumerate(lines) if line.strip()]
+        return set(content[:HEADER_FOOTER_EDGE_LINES] + content[-HEADER_FOOTER_EDGE_LINES:])
+
+    edges = [edge_indices(lines) for lines in page_lines]
+    key_counts = Counter()
+    for lines, indices in zip(page_lines, edges):
+        key_counts.update({_line_key(lines[i]) for i in indices})
+
+    min_pages = max(2, int(len(pages) * HEADER_FOOTER_MIN_SHARE))
+    repeated = {key for key, count in key_counts.items() if count >= min_pages}
+
+    cleaned_pages = []
+    for lines, indices in zip(page_lines, edges):
+        cleaned_pages.append("\n".join(
+            line for i, line in enumerate(lines)
+            if i not in indices or not (_line_key(line) in repeated or _PAGE_NUMBER_LINE.match(line.strip()))
+        ))
+    return PAGE_BREAK.join(cleaned_pages)
+
+
+def clean_text(text, options=None):
+    """Cleans extracted text while keeping the paragraph and heading structure.
+
+    Paragraph breaks are kept as a blank line and headings/list items stay on
+    their own line, so the heading and paragraph chunking stages can use them.
+    All whitespace rules run in one pass over the text with a precompiled pattern.
+    """
+    options = {**CLEANING_OPTIONS, **(options or {})}
+
+    if options["strip_headers_footers"] and PAGE_BREAK in text:
+        text = strip_headers_footers(text)
+    if options["normalize_unicode"]:
+        text = normalize_unicode(text)
+    else:
+        text = text.replace("\r\n", "\n").replace("\r", "\n").replace(PAGE_BREAK, "\n")
+
+    pattern, replacements = _whitespace_pattern(options["dehyphenate"], options["unwrap_lines"])
+    text = pattern.sub(lambda match: replacements[match.lastgroup], text)
+    return text.strip()
+
+def preprocess_document(doc):
+    """Returns a cleaned copy of an extracted document record."""
+    logging.info(f"Cleaning text from: {doc['filename']}")
+    return {
+        "filename": doc["filename"],
+        "file_type": doc["file_type"],
+        "metadata": doc["metadata"],
+        "text": clean_text(doc["text"])
+    }
 
 def preprocess_text():
     """Reads extracted text JSON, cleans it, and saves the processed output."""
@@ -34,18 +147,7 @@ def preprocess_text():
         processed_docs = []
         
         for doc in documents:
-            text = doc["text"]
-            doc_metadata = doc["metadata"]
-            
-            logging.info(f"Cleaning text from: {doc['filename']}")
-            cleaned_text = clean_text(text)
-            
-            processed_docs.append({
-                "filename": doc["filename"],
-                "file_type": doc["file_type"],
-                "metadata": doc_metadata,
-                "text": cleaned_text
-            })
+            processed_docs.append(preprocess_document(doc))
         
         # Save the processed documents
         with open(OUTPUT_FILE, "w", encoding="utf-8") as out_file:
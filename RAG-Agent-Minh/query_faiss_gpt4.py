@@ -1,8 +1,8 @@
-import faiss
 import numpy as np
 import openai
 import logging
 from reranking import hybrid_retrieval
+from embedders import open_index
 # OpenAI API Key (Hardcoded for now)
 openai.api_key = ""  # Replace with your actual API key
 
@@ -11,17 +11,14 @@ FAISS_INDEX_FILE = "faiss_index.bin"
 PROCESSED_FILE = "processed_chunks.txt"  # Load text chunks for reference
 
 def load_faiss_index():
-    """Loads the FAISS index from the saved file."""
-    index = faiss.read_index(FAISS_INDEX_FILE)
+    """Returns the memory-mapped index, opened once per process (fails fast on an embedder mismatch)."""
+    index, _ = open_index(FAISS_INDEX_FILE)
     return index
 
 def get_embedding(text):
-    """Generates an embedding for a given query using OpenAI."""
-    response = openai.embeddings.create(
-        model="text-embedding-ada-002",
-        input=text
-    )
-    return np.array(response.data[0].embedding, dtype=np.float32)
+    """Embeds a query with the embedder the open index was built with (see its manifest)."""
+    _, embedder = open_index(FAISS_INDEX_FILE)
+    return embedder.embed_query(text)
 
 def search_faiss(query, index, top_k=3):
     """Searches FAISS index for the most relevant chunk."""
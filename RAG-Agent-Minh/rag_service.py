@@ -0,0 +1,671 @@
+# rag_service.py
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import logging
+import argparse
+from collections import OrderedDict
+from contextlib import aclosing
+from datetime import datetime, timezone
+
+import numpy as np
+
+from context_builder import build_context, count_tokens, set_token_counter
+from request_batcher import MicroBatcher, BATCH_WINDOW_MS, MAX_BATCH_SIZE
+from singleflight import SingleFlight, request_key
+from semantic_cache import SemanticCache, context_fingerprint
+from embedders import (get_async_openai_client, load_index, index_generation, get_embedder, embedder_spec,
+                       check_index_dimension)
+from chunk_store import open_chunk_store
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Files loaded once at startup and kept in memory
+FAISS_INDEX_FILE = "faiss_index.bin"
+PROCESSED_FILE = "processed_chunks.json"
+METADATA_FILE = "faiss_metadata.json"
+
+CHAT_MODEL = "gpt-4"
+SYSTEM_PROMPT = "You are an expert in coffee farming."
+
+TOP_K = 3
+RERANK_CANDIDATES = 3  # Candidates fetched per result when reranking
+HISTORY_TURNS = 3  # Previous exchanges sent to the model for follow-up questions
+NUM_FOLLOW_UPS = 3
+# Reply to image-only messages; photos are diagnosed by the Streamlit app's Assistant, not here
+IMAGE_ONLY_REPLY = ("Image analysis isn't available in this chat yet. "
+                    "Please describe what you see on the plant and I'll search the knowledge base.")
+
+# Conversations are kept in memory, least recently used evicted first
+MAX_CONVERSATIONS = 1000
+
+STREAM_PATH = "/api/chat/message/stream"
+CORS_HEADERS = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-methods", b"GET, POST, OPTIONS"),
+    (b"access-control-allow-headers", b"content-type"),
+    (b"access-control-expose-headers", b"x-conversation-id"),
+]
+
+
+class OpenAIBackend:
+    """Model endpoints served by the OpenAI API.
+
+    Queries are embedded by the embedder the index was built with. Chat and
+    OpenAI embeddings share one client, so one connection pool.
+    Point OPENAI_BASE_URL at a local server to run against stubbed endpoints.
+    """
+
+    def __init__(self, embedder, chat_model=CHAT_MODEL):
+        self.client = get_async_openai_client()
+        self.embedder = embedder
+        self.chat_model = chat_model
+
+    @property
+    def dimension(self):
+        return self.embedder.dimension
+
+    async def embed(self, texts):
+        """Embeds a list of texts in one request, returning a float32 matrix."""
+        return await self.embedder.aembed(texts)
+
+    async def stream_chat(self, messages):
+        """Yields the answer text as the model generates it."""
+        stream = await self.client.chat.completions.create(model=self.chat_model, messages=messages, stream=True)
+        async for event in stream:
+            if event.choices and event.choices[0].delta.content:
+                yield event.choices[0].delta.content
+
+    async def complete_chat(self, messages):
+        """Returns a whole (non-streamed) completion."""
+        response = await self.client.chat.completions.create(model=self.chat_model, messages=messages)
+        return response.choices[0].message.content
+
+
+class StubBackend:
+    """Offline model endpoints for local testing: hashed embeddings and an echoing chat model."""
+
+    chat_model = "stub"
+
+    def __init__(self, dimension=3072, token_delay=0.01):
+        self.dimension = dimension
+        self.token_delay = token_delay
+
+    @staticmethod
+    def count_tokens(text):
+        """Rough count (about 4 characters per token) that needs no tiktoken download."""
+        return max(1, len(text) // 4)
+
+    async def embed(self, texts):
+        vectors = []
+        for text in texts:
+            seed = int.from_bytes(hashlib.md5(text.lower().encode()).digest()[:4], "little")
+            vectors.append(np.random.RandomState(seed).standard_normal(self.dimension))
+        return np.array(vectors, dtype=np.float32)
+
+    async def stream_chat(self, messages):
+        question = messages[-1]["content"].split("**User Question:**")[-1].split("**Context")[0].strip()
+        for word in f"Stub answer to: {question}".split(" "):
+            await asyncio.sleep(self.token_delay)
+            yield word + " "
+
+    async def complete_chat(self, messages):
+        return "\n".join(f"Stub follow-up question {i + 1}?" for i in range(NUM_FOLLOW_UPS))
+
+
+def load_resources(index_file=FAISS_INDEX_FILE, chunks_file=PROCESSED_FILE, metadata_file=METADATA_FILE,
+                   shards=None):
+    """Loads the FAISS index with its query embedder and opens the chunk store of texts and metadata.
+
+    With shard worker addresses, searches are scattered to the workers instead
+    of a local index, and the embedder comes from the shards' manifests. The
+    shards must have been built from the live index, or their ids would read
+    the wrong chunks.
+    """
+    if shards:
+        from sharded_search import ShardedIndex
+        index = ShardedIndex(shards)
+        embedder = get_embedder(embedder_spec(index.embedder)) if index.embedder else get_embedder()
+        check_index_dimension(index, embedder, f"The {len(index.clients)} shards")
+    else:
+        index, embedder = load_index(index_file, mmap=True)
+    chunk_store = open_chunk_store(chunks_file, metadata_file)
+    if shards:
+        try:
+            index.check_source(index_file, chunk_store)
+        except ValueError:
+            index.close()
+            raise
+    logging.info(f"✅ Loaded index with {index.ntotal} vectors and a store of {len(chunk_store)} chunks")
+    return index, embedder, chunk_store
+
+
+def build_prompt(user_query, context):
+    """The knowledge-base prompt used by the Streamlit UIs."""
+    return f"""
+    You are an expert in coffee farming. Answer the user's question using only the provided context.
+
+    **User Question:** {user_query}
+
+    **Context from Knowledge Base:**
+    {context}
+
+    **Answer:**
+    """
+
+
+def parse_follow_ups(text, limit=NUM_FOLLOW_UPS):
+    """Turns a numbered or bulleted list of questions into plain strings."""
+    questions = []
+    for line in text.splitlines():
+        line = line.strip().lstrip("-*•").strip()
+        line = line.split(". ", 1)[1] if line[:1].isdigit() and ". " in line[:4] else line
+        if line.endswith("?"):
+            questions.append(line)
+    return questions[:limit]
+
+
+def sse_event(payload):
+    """Encodes one server-sent event in the format streamService.js parses."""
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+class RAGService:
+    """Conversation state and warm retrieval resources shared by every request."""
+
+    def __init__(self, backend=None, use_reranking=False, top_k=TOP_K,
+                 index_file=FAISS_INDEX_FILE, chunks_file=PROCESSED_FILE, metadata_file=METADATA_FILE,
+                 batch_window_ms=BATCH_WINDOW_MS, max_batch_size=MAX_BATCH_SIZE, shards=None):
+        self.backend = backend
+        self.batch_window_ms = batch_window_ms
+        self.max_batch_size = max_batch_size
+        self.embed_batcher = None
+        self.search_batcher = None
+        # Identical questions asked at the same time share retrieval and, when stateless, the answer
+        self.coalescer = SingleFlight("rag")
+        # Answers to first messages, reused for similar questions that retrieve the same chunks
+        self.answer_cache = None
+        self.index_generation = None
+        self.use_reranking = use_reranking
+        self.top_k = top_k
+        self.files = (index_file, chunks_file, metadata_file)
+        # Shard worker addresses; searched in place of the local index when set
+        self.shards = shards
+        self.index = None
+        self.chunk_store = None
+        self.conversations = OrderedDict()
+        self._conversation_locks = {}
+        self.started_at = None
+        self._start_task = None
+        self._reload_task = None
+        self._failed_generation = None
+
+    async def start(self):
+        """Loads the index, chunks and models once, before the first request."""
+        if self._start_task is None:
+            self._start_task = asyncio.create_task(self._load())
+        await self._start_task
+
+    async def _load(self):
+        generation = index_generation(self.files[0])
+        # load_index fails fast if the index was built with vectors of another size
+        index, embedder, self.chunk_store = await asyncio.to_thread(load_resources, *self.files, self.shards)
+        if self.backend is None:
+            self.backend = OpenAIBackend(embedder)
+        elif self.backend.dimension != index.d:
+            raise ValueError(f"{self.files[0]} holds {index.d}-d vectors but the backend embeds {self.backend.dimension}-d")
+        # Concurrent queries share one embedding request and one multi-row FAISS search
+        self.embed_batcher = MicroBatcher(self.backend.embed, self.max_batch_size, self.batch_window_ms, "embedding")
+        self.search_batcher = MicroBatcher(self._search_batch, self.max_batch_size, self.batch_window_ms, "search")
+        if self.use_reranking:
+            from model_loader import get_cross_encoder
+            await asyncio.to_thread(get_cross_encoder)
+        self.answer_cache = SemanticCache(index.d, name="rag_service")
+        self.index_generation = generation
+        self.index = index
+        self.started_at = time.time()
+
+    def refresh(self):
+        """Starts loading the index again if its file was replaced (by a rebuild or a migration).
+
+        Requests keep using the loaded index until the new one is ready, so
+        switching generations needs no restart. Shard workers whose shards were
+        rebuilt also trigger a reload, which only succeeds once they match the live index.
+        """
+        generation = index_generation(self.files[0])
+        stale_shards = self.shards and self.index is not None and self.index.stale
+        if generation in (self.index_generation, self._failed_generation) and not stale_shards:
+            return
+        if self._reload_task is None or self._reload_task.done():
+            self._reload_task = asyncio.create_task(self._reload(generation))
+
+    async def _reload(self, generation):
+        index = None
+        try:
+            index, embedder, chunk_store = await asyncio.to_thread(load_resources, *self.files, self.shards)
+            if isinstance(self.backend, OpenAIBackend):
+                self.backend.embedder = embedder
+            elif self.backend.dimension != index.d:
+                raise ValueError(f"{self.files[0]} holds {index.d}-d vectors but the backend embeds {self.backend.dimension}-d")
+        except Exception as e:
+            logging.error(f"❌ Could not load the new index, still serving the previous one: {e}")
+            if self.shards and index is not None:
+                index.close()
+            self._failed_generation = generation
+            return
+
+        if index.d != self.index.d:
+            self.answer_cache = SemanticCache(index.d, name="rag_service")
+        previous = self.index
+        self.index, self.chunk_store = index, chunk_store
+        self.index_generation = generation
+        if self.shards:
+            # Requests still searching the previous shard clients finish; retried ones use the new clients
+            previous.close()
+        logging.info(f"✅ Switched to the new index ({index.ntotal} vectors)")
+
+    async def stop(self):
+        """Lets batches already sent to the model endpoints finish."""
+        for batcher in (self.embed_batcher, self.search_batcher):
+            if batcher is not None:
+                await batcher.close()
+        if self.shards and self.index is not None:
+            self.index.close()
+
+    # Conversations
+
+    def get_conversation(self, conversation_id):
+        conversation = self.conversations.get(conversation_id)
+        if conversation is not None:
+            self.conversations.move_to_end(conversation_id)
+        return conversation
+
+    def _open_conversation(self, conversation_id, request):
+        conversation = self.get_conversation(conversation_id) if conversation_id else None
+        if conversation is None:
+            conversation_id = conversation_id or str(uuid.uuid4())
+            conversation = {
+                "conversation_id": conversation_id,
+                "user_profile_id": request.get("user_profile_id"),
+                "farm_id": request.get("farm_id"),
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "messages": []
+            }
+            self.conversations[conversation_id] = conversation
+            while len(self.conversations) > MAX_CONVERSATIONS:
+                evicted_id, _ = self.conversations.popitem(last=False)
+                self._conversation_locks.pop(evicted_id, None)
+        return conversation
+
+    def _conversation_lock(self, conversation_id):
+        return self._conversation_locks.setdefault(conversation_id, asyncio.Lock())
+
+    # Retrieval
+
+    async def embed_query(self, query):
+        return await self.embed_batcher.submit(query)
+
+    async def _search_batch(self, requests):
+        """Runs one multi-row FAISS search per index for (query vector, k, index) requests, off the event loop."""
+        results = [(np.array([], dtype=np.int64), np.array([], dtype=np.float32))] * len(requests)
+        # Requests made before and after a switch search the index they were made against
+        groups = {}
+        for row, (vector, _, index) in enumerate(requests):
+            # Vectors embedded before a switch to an index of another size get no results and are retried
+            if np.size(vector) == index.d:
+                groups.setdefault(id(index), (index, []))[1].append(row)
+        for index, rows in groups.values():
+            k = max(requests[row][1] for row in rows)
+            matrix = np.vstack([np.asarray(requests[row][0], dtype=np.float32).reshape(1, -1) for row in rows])
+            distances, indices = await asyncio.to_thread(index.search, matrix, k)
+            for position, row in enumerate(rows):
+                request_k = requests[row][1]
+                results[row] = (indices[position][:request_k], distances[position][:request_k])
+        return results
+
+    async def search(self, query_vector, k, index=None):
+        """Nearest neighbours for one query vector in index (the live one by default), batched with concurrent searches."""
+        return await self.search_batcher.submit((query_vector, k, self.index if index is None else index))
+
+    def _request_key(self, query, **params):
+        return request_key(query, top_k=self.top_k, reranking=self.use_reranking, **params)
+
+    async def retrieve(self, query):
+        """Returns the query vector and the top chunks as {id, text, metadata, distance} dicts.
+
+        Concurrent requests for the same normalised query share one embedding,
+        search and rerank. The returned list is shared, so callers must not modify it.
+        """
+        return await self.coalescer.do("retrieve:" + self._request_key(query), lambda: self._retrieve(query))
+
+    async def _retrieve(self, query):
+        k = self.top_k * (RERANK_CANDIDATES if self.use_reranking else 1)
+        for attempt in range(2):
+            # The index and its chunks are switched together, so this pair always matches
+            generation, index, chunk_store = self.index_generation, self.index, self.chunk_store
+            query_vector = await self.embed_query(query)
+            indices, distances = await self.search(query_vector, k, index)
+            if self.index_generation == generation:
+                break
+            # The index was switched mid-request: embed and search again, once, with the new one.
+            # If it switches again, the ids are still read from the chunks of the index searched.
+
+        results = [
+            {"id": int(idx), **chunk_store.get(idx), "distance": float(distance)}
+            for idx, distance in zip(indices, distances) if 0 <= idx < len(chunk_store)
+        ]
+        if self.use_reranking and len(results) > 1:
+            from reranking import hybrid_retrieval
+            results = await asyncio.to_thread(hybrid_retrieval, query, results, self.top_k)
+        return query_vector, results[:self.top_k]
+
+    def build_messages(self, conversation, query, results):
+        history = []
+        for message in conversation["messages"][-2 * HISTORY_TURNS:]:
+            history.append({"role": message["role"], "content": message["content"]})
+
+        packed = build_context(
+            [result["text"] for result in results],
+            [result["metadata"] for result in results],
+            format_chunk=lambda i, chunk, metadata: ("\n\n" if i else "") + chunk,
+            format_citation=lambda i, metadata: "",
+            reserved_tokens=count_tokens(SYSTEM_PROMPT) + count_tokens(query)
+            + sum(count_tokens(message["content"]) for message in history)
+        )
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}, *history,
+                    {"role": "user", "content": build_prompt(query, packed["context"])}]
+        return messages, packed
+
+    def answer_stream(self, conversation, query, messages):
+        """Streams the model's answer.
+
+        A first message depends only on the query and retrieved context, so
+        concurrent identical first messages share one generation. Messages with
+        history are specific to their conversation and are never shared.
+        """
+        if conversation["messages"]:
+            return self.backend.stream_chat(messages)
+        model = getattr(self.backend, "chat_model", CHAT_MODEL)
+        return self.coalescer.stream("answer:" + self._request_key(query, model=model),
+                                     lambda: self.backend.stream_chat(messages))
+
+    async def follow_up_questions(self, query, answer):
+        answer_hash = hashlib.md5(answer.encode()).hexdigest()
+        return await self.coalescer.do("follow_up:" + self._request_key(query, answer=answer_hash),
+                                       lambda: self._follow_up_questions(query, answer))
+
+    async def _follow_up_questions(self, query, answer):
+        prompt = (f"A farmer asked: {query}\n\nThe answer was:\n{answer}\n\n"
+                  f"Suggest {NUM_FOLLOW_UPS} short follow-up questions the farmer might ask next, one per line.")
+        try:
+            text = await self.backend.complete_chat([{"role": "system", "content": SYSTEM_PROMPT},
+                                                     {"role": "user", "content": prompt}])
+            return parse_follow_ups(text)
+        except Exception as e:
+            logging.warning(f"Could not generate follow-up questions: {e}")
+            return []
+
+    # Streaming
+
+    async def stream_answer(self, request, disconnected):
+        """Yields the SSE events for one chat message.
+
+        Stops generating (and paying for tokens) as soon as the client disconnects.
+        """
+        conversation = self._open_conversation(request.get("conversation_id"), request)
+        conversation_id = conversation["conversation_id"]
+        query = str(request.get("message") or "").strip()
+        timings = {}
+        start_time = time.perf_counter()
+
+        yield sse_event({"type": "info", "conversation_id": conversation_id})
+        if not query:
+            # The web client sends photos on their own, with an image_url and no message
+            now = datetime.now(timezone.utc).isoformat()
+            conversation["messages"].append({"role": "user", "content": "", "timestamp": now,
+                                             "image_url": request.get("image_url")})
+            conversation["messages"].append({"role": "assistant", "content": IMAGE_ONLY_REPLY, "timestamp": now})
+            yield sse_event({"type": "text_chunk", "text_chunk": IMAGE_ONLY_REPLY})
+            yield sse_event({"type": "complete", "complete": True,
+                             "metadata": {"conversation_id": conversation_id, "image_analysis": False}})
+            return
+        yield sse_event({"type": "text_chunk", "text_chunk": "Searching knowledge base...", "is_loading": True})
+
+        async with self._conversation_lock(conversation_id):
+            answer_parts = []
+            cached = None
+            loading_cleared = False
+            try:
+                query_vector, results = await self.retrieve(query)
+                timings["retrieval_seconds"] = time.perf_counter() - start_time
+                # Only first messages are cached: later ones depend on the conversation history
+                fingerprint = None
+                if not conversation["messages"]:
+                    fingerprint = context_fingerprint([result["id"] for result in results])
+                    cached = self.answer_cache.lookup(query_vector, fingerprint, self.index_generation)
+
+                yield sse_event({"type": "clear_loading", "clear_loading": True})
+                loading_cleared = True
+                if cached:
+                    answer_parts.append(cached["answer"])
+                    yield sse_event({"type": "text_chunk", "text_chunk": cached["answer"]})
+                else:
+                    messages, packed = self.build_messages(conversation, query, results)
+                    async with aclosing(self.answer_stream(conversation, query, messages)) as deltas:
+                        async for delta in deltas:
+                            if disconnected.is_set():
+                                logging.info(f"Client left conversation {conversation_id}, stopping generation")
+                                return
+                            if not answer_parts:
+                                timings["first_token_seconds"] = time.perf_counter() - start_time
+                            answer_parts.append(delta)
+                            yield sse_event({"type": "text_chunk", "text_chunk": delta})
+            except Exception as e:
+                logging.error(f"❌ Error answering in conversation {conversation_id}: {e}")
+                if not loading_cleared:
+                    yield sse_event({"type": "clear_loading", "clear_loading": True})
+                yield sse_event({"type": "text_chunk", "text_chunk": "Sorry, something went wrong while answering."})
+                yield sse_event({"type": "complete", "complete": True, "metadata": {"error": str(e)}})
+                return
+
+            answer = "".join(answer_parts)
+            now = datetime.now(timezone.utc).isoformat()
+            conversation["messages"].append({"role": "user", "content": query, "timestamp": now,
+                                             "image_url": request.get("image_url")})
+            conversation["messages"].append({"role": "assistant", "content": answer, "timestamp": now})
+
+        if cached:
+            yield sse_event({"type": "sources", "sources": cached["sources"]})
+            if cached["follow_ups"]:
+                yield sse_event({"type": "follow_up_questions", "follow_up_questions": cached["follow_ups"]})
+            timings["total_seconds"] = time.perf_counter() - start_time
+            yield sse_event({"type": "complete", "complete": True, "metadata": {
+                **cached["metadata"],
+                "conversation_id": conversation_id,
+                "cached": True,
+                "similarity": round(cached["similarity"], 4),
+                **{name: round(value, 3) for name, value in timings.items()}
+            }})
+            return
+
+        selected = [results[i] for i in packed["selected"]]
+        sources = [
+            {"id": result["id"], "metadata": result["metadata"], "distance": result["distance"],
+             "text_preview": result["text"][:200]}
+            for result in selected
+        ]
+        yield sse_event({"type": "sources", "sources": sources})
+
+        follow_ups = await self.follow_up_questions(query, answer)
+        if follow_ups:
+            yield sse_event({"type": "follow_up_questions", "follow_up_questions": follow_ups})
+
+        metadata = {
+            "model": getattr(self.backend, "chat_model", CHAT_MODEL),
+            "reranking": self.use_reranking,
+            "sources": len(selected),
+            "context_tokens": packed["token_count"]
+        }
+        if fingerprint is not None and answer:
+            self.answer_cache.store(query_vector, fingerprint, answer, self.index_generation,
+                                    sources=sources, follow_ups=follow_ups, metadata=metadata)
+
+        timings["total_seconds"] = time.perf_counter() - start_time
+        yield sse_event({"type": "complete", "complete": True, "metadata": {
+            "conversation_id": conversation_id,
+            **metadata,
+            **{name: round(value, 3) for name, value in timings.items()}
+        }})
+
+
+async def _read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def _send_json(send, status, payload):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), *CORS_HEADERS]})
+    await send({"type": "http.response.body", "body": body})
+
+
+def create_app(service):
+    """Builds the ASGI application around a RAGService."""
+
+    async def stream_message(receive, send):
+        body = await _read_body(receive)
+        if body is None:
+            return
+        try:
+            request = json.loads(body or b"{}")
+        except json.JSONDecodeError:
+            await _send_json(send, 400, {"error": "Request body must be JSON"})
+            return
+        if not isinstance(request, dict) or not (str(request.get("message") or "").strip() or request.get("image_url")):
+            await _send_json(send, 400, {"error": "message or image_url is required"})
+            return
+
+        disconnected = asyncio.Event()
+
+        async def watch_disconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        watcher = asyncio.create_task(watch_disconnect())
+        events = service.stream_answer(request, disconnected)
+        try:
+            first_event = await events.__anext__()
+            conversation_id = json.loads(first_event[len(b"data: "):])["conversation_id"]
+            await send({"type": "http.response.start", "status": 200, "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+                (b"x-conversation-id", conversation_id.encode()),
+                *CORS_HEADERS,
+            ]})
+            await send({"type": "http.response.body", "body": first_event, "more_body": True})
+            async for event in events:
+                await send({"type": "http.response.body", "body": event, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        except OSError:
+            disconnected.set()  # Client went away mid-stream
+        finally:
+            await events.aclose()
+            watcher.cancel()
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    try:
+                        await service.start()
+                    except Exception as e:
+                        await send({"type": "lifespan.startup.failed", "message": str(e)})
+                        return
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await service.stop()
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+
+        if scope["type"] != "http":
+            return
+
+        method = scope["method"]
+        path = scope["path"].rstrip("/") or "/"
+
+        if method == "OPTIONS":
+            await send({"type": "http.response.start", "status": 204, "headers": CORS_HEADERS})
+            await send({"type": "http.response.body", "body": b""})
+        elif path == "/health" and method == "GET":
+            await _send_json(send, 200, {
+                "status": "ok" if service.index is not None else "starting",
+                "vectors": service.index.ntotal if service.index is not None else 0,
+                "conversations": len(service.conversations),
+                "batching": {batcher.name: batcher.metrics()
+                             for batcher in (service.embed_batcher, service.search_batcher) if batcher},
+                "index_generation": service.index_generation,
+                "coalescing": service.coalescer.metrics(),
+                "semantic_cache": service.answer_cache.metrics() if service.answer_cache else {},
+                "shards": service.index.metrics() if service.shards and service.index is not None else {},
+                "uptime_seconds": round(time.time() - service.started_at, 1) if service.started_at else 0,
+            })
+        elif path == STREAM_PATH and method == "POST":
+            await service.start()  # No-op once warm; covers servers without lifespan support
+            service.refresh()
+            await stream_message(receive, send)
+        elif path.startswith("/conversations/") and method == "GET":
+            conversation = service.get_conversation(path[len("/conversations/"):])
+            if conversation is None:
+                await _send_json(send, 404, {"error": "Conversation not found"})
+            else:
+                await _send_json(send, 200, conversation)
+        else:
+            await _send_json(send, 404, {"error": f"No route for {method} {path}"})
+
+    return app
+
+
+def serve(host="0.0.0.0", port=8000, use_reranking=False, stub=False,
+          batch_window_ms=BATCH_WINDOW_MS, max_batch_size=MAX_BATCH_SIZE, shards=None):
+    """Runs the service with uvicorn (pip install uvicorn)."""
+    try:
+        import uvicorn
+    except ImportError:
+        logging.error("❌ uvicorn is required to serve the API: pip install uvicorn")
+        sys.exit(1)
+    backend = StubBackend() if stub else None
+    if stub:
+        set_token_counter(backend.count_tokens)
+    service = RAGService(backend, use_reranking=use_reranking,
+                         batch_window_ms=batch_window_ms, max_batch_size=max_batch_size, shards=shards)
+    uvicorn.run(create_app(service), host=host, port=port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Streaming chat API for the RAG web client")
+    parser.add_argument("--host", default="0.0.0.0", help="Interface to bind")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")), help="Port to listen on")
+    parser.add_argument("--use-reranking", action="store_true", help="Rerank retrieved chunks with the cross-encoder")
+    parser.add_argument("--stub", action="store_true", help="Use offline stub model endpoints (no OpenAI calls)")
+    parser.add_argument("--batch-window-ms", type=float, default=BATCH_WINDOW_MS,
+                        help="How long concurrent queries are collected into one embedding/search batch")
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE,
+                        help="Largest number of queries embedded or searched together")
+    parser.add_argument("--shards", help="Comma-separated host:port shard workers to search instead of the local index")
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.use_reranking, args.stub, args.batch_window_ms, args.max_batch_size, args.shards)
@@ -1,15 +1,16 @@
 import os
-import json
-import faiss
 import numpy as np
 import openai
 import requests
 import streamlit as st
 import logging
 import sys
-from embedding_cache import get_cached_embedding, cache_embedding
+from chunk_store import open_chunk_store
+from embedders import open_index, index_generation
 from reranking import hybrid_retrieval
-import tiktoken
+from context_builder import build_context, count_tokens
+from singleflight import get_group, request_key, normalize_query
+from semantic_cache import get_semantic_cache, context_fingerprint, weather_bucket
 # OpenAI API Key
 openai.api_key = ""
 
@@ -46,61 +47,37 @@ def get_weather(city):
         return None
 
 def load_faiss_index():
-    """Loads the FAISS index from the saved file."""
-    return faiss.read_index(FAISS_INDEX_FILE)
+    """Returns the memory-mapped index, opened once per process (fails fast on an embedder mismatch)."""
+    index, _ = open_index(FAISS_INDEX_FILE)
+    return index
 
 def get_embedding(text):
-    """Generates an embedding for a given query using OpenAI with caching."""
-    # Check cache first
-    cached_embedding = get_cached_embedding(text)
-    if cached_embedding is not None:
-        return cached_embedding
-    
-    # Generate new embedding if not in cache
-    response = openai.embeddings.create(
-        model="text-embedding-3-large",
-        input=text
-    )
-    embedding = np.array(response.data[0].embedding, dtype=np.float32)
-    
-    # Cache the embedding for future use
-    cache_embedding(text, embedding)
-    
-    return embedding
+    """Embeds a query with the embedder the open index was built with (see its manifest)."""
+    _, embedder = open_index(FAISS_INDEX_FILE)
+    return embedder.embed_query(text)
 
-def search_faiss(query, index, top_k=3, use_reranking=use_reranking):
+def search_faiss(query, index, top_k=3, use_reranking=use_reranking, query_embedding=None):
     """Searches FAISS index for the most relevant chunk with optional reranking."""
-    query_embedding = get_embedding(query)
+    if query_embedding is None:
+        query_embedding = get_embedding(query)
     query_embedding = np.expand_dims(query_embedding, axis=0)  # Reshape for FAISS
     distances, indices = index.search(query_embedding, top_k * (3 if use_reranking else 1))
     
     return indices[0], distances[0]
 
 def load_chunks():
-    """Loads text chunks and metadata from JSON file."""
+    """Opens the chunk store; only the retrieved rows are read from it."""
     try:
-        with open(PROCESSED_FILE, "r", encoding="utf-8") as file:
-            chunks = json.load(file)
-
-        with open(METADATA_FILE, "r", encoding="utf-8") as meta_file:
-            metadata_mapping = json.load(meta_file)
-
-        logging.info(f"✅ Loaded {len(chunks)} chunks and metadata.")
-
-        return chunks, metadata_mapping  # Returns both text chunks and metadata
+        return open_chunk_store(PROCESSED_FILE, METADATA_FILE)
     except Exception as e:
         logging.error(f"❌ Error loading chunks or metadata: {e}")
-        return [], {}
+        return None
 
-def generate_response(user_query, retrieved_chunks, metadata_list, weather_info):
+def generate_response(user_query, retrieved_chunks, metadata_list, weather_info, scores=None):
     """Generates a final AI response using GPT-4 with retrieved knowledge & weather data."""
-    encoding = tiktoken.get_encoding("cl100k_base")  # GPT-4 encoding
-    
-    # Start with system message tokens (estimated)
-    token_count = len(encoding.encode("You are an expert in coffee farming."))
-    
-    # Add query tokens
-    token_count += len(encoding.encode(user_query))
+    # Start with system message and query tokens
+    token_count = count_tokens("You are an expert in coffee farming.")
+    token_count += count_tokens(user_query)
     
     # Add weather info tokens
     weather_prompt = f"""
@@ -111,33 +88,19 @@ def generate_response(user_query, retrieved_chunks, metadata_list, weather_info)
     
     Consider the weather while answering.
     """
-    token_count += len(encoding.encode(weather_prompt))
+    token_count += count_tokens(weather_prompt)
     
-    # Prepare context and sources
-    context = ""
-    source_citations = ""
-    max_tokens = 6000  # Set a limit well below the 10,000 TPM limit
-    
-    # Calculate tokens and add chunks until we approach the limit
-    for i, chunk in enumerate(retrieved_chunks):
-        metadata = metadata_list[i]
-        chunk_text = f"\n\n🔹 **Source: {metadata['filename']} ({metadata['file_type']})**\n{chunk}"
-        citation = f"- **Source {i+1}:** {metadata['filename']} ({metadata['file_type']}), Extracted on {metadata['extracted_date']}\n"
-        
-        # Calculate tokens for this chunk
-        chunk_tokens = len(encoding.encode(chunk_text))
-        citation_tokens = len(encoding.encode(citation))
-        
-        # Check if adding this chunk would exceed our limit
-        if token_count + chunk_tokens + citation_tokens > max_tokens:
-            # Add a note that we're truncating content
-            context += "\n\n[Note: Additional relevant content was found but truncated to stay within limits]"
-            break
-            
-        # Add this chunk and citation
-        context += chunk_text
-        source_citations += citation
-        token_count += chunk_tokens + citation_tokens
+    # Pack chunks and citations into the token budget (6000, well below the 10,000 TPM limit)
+    packed = build_context(
+        retrieved_chunks,
+        metadata_list,
+        format_chunk=lambda i, chunk, metadata: f"\n\n🔹 **Source: {metadata['filename']} ({metadata['file_type']})**\n{chunk}",
+        format_citation=lambda i, metadata: f"- **Source {i+1}:** {metadata['filename']} ({metadata['file_type']}), Extracted on {metadata['extracted_date']}\n",
+        reserved_tokens=token_count,
+        scores=scores
+    )
+    context = packed["context"]
+    source_citations = packed["citations"]
     
     # Construct the final prompt
     prompt = f"""
@@ -157,9 +120,7 @@ def generate_response(user_query, retrieved_chunks, metadata_list, weather_info)
     **Answer:**
     """
     
-    # Final token check
-    final_token_count = len(encoding.encode(prompt))
-    logging.info(f"Final prompt token count: {final_token_count}")
+    logging.info(f"Estimated prompt token count: {packed['token_count']}")
     
     # Generate response
     response = openai.chat.completions.create(
@@ -170,9 +131,16 @@ def generate_response(user_query, retrieved_chunks, metadata_list, weather_info)
     return response.choices[0].message.content
 
 def query_rag_system(user_query, city):
+    """Answers a query, sharing the work with sessions asking the same question at the same time."""
+    key = request_key(user_query, city=normalize_query(city or ""), use_reranking=use_reranking)
+    return get_group("rag_ui").do(key, lambda: _query_rag_system(user_query, city))
+
+def _query_rag_system(user_query, city):
     """Queries FAISS, retrieves relevant text, and generates a response with GPT-4."""
     index = load_faiss_index()
-    chunks, metadata_mapping = load_chunks()
+    chunk_store = load_chunks()
+    if chunk_store is None:
+        return None, None, "⚠ Could not load the document chunks."
 
     # Get weather data
     weather_info = get_weather(city)
@@ -180,19 +148,22 @@ def query_rag_system(user_query, city):
         return None, None, "⚠ Could not retrieve weather data. Please check the city name."
 
     # Get initial search results - retrieve more candidates than needed
-    indices, distances = search_faiss(user_query, index, top_k=5, use_reranking=use_reranking)
+    query_embedding = np.asarray(get_embedding(user_query), dtype=np.float32)
+    indices, distances = search_faiss(user_query, index, top_k=5, use_reranking=use_reranking,
+                                      query_embedding=query_embedding)
     
     # Prepare results
+    all_ids = []
     all_chunks = []
     all_metadata = []
     all_distances = []
     
     for idx, dist in zip(indices, distances):
-        if idx >= 0:  # Valid index
-            chunk_data = chunks[idx]
-            metadata = metadata_mapping[str(idx)]
+        if 0 <= idx < len(chunk_store):  # Valid index
+            chunk_data = chunk_store.get(idx)
+            all_ids.append(int(idx))
             all_chunks.append(chunk_data["text"])
-            all_metadata.append(metadata)
+            all_metadata.append(chunk_data["metadata"])
             all_distances.append(dist)
     
     # Apply reranking if enabled
@@ -201,22 +172,36 @@ def query_rag_system(user_query, city):
         rerank_chunks = [{"text": text, "original_idx": i} for i, text in enumerate(all_chunks)]
         reranked_chunks = hybrid_retrieval(user_query, rerank_chunks, len(all_chunks))
         
+        reranked_ids = []
         reranked_text = []
         reranked_metadata = []
         for chunk in reranked_chunks:
             original_idx = chunk["original_idx"]
+            reranked_ids.append(all_ids[original_idx])
             reranked_text.append(all_chunks[original_idx])
             reranked_metadata.append(all_metadata[original_idx])
         
+        all_ids = reranked_ids
         all_chunks = reranked_text
         all_metadata = reranked_metadata
     
     # Limit to top 3 chunks to avoid token issues
+    all_ids = all_ids[:3]
     all_chunks = all_chunks[:3]
     all_metadata = all_metadata[:3]
     
+    # Reuse the answer to a near-identical question asked with the same context and weather
+    answer_cache = get_semantic_cache("rag_ui", index.d)
+    fingerprint = context_fingerprint(all_ids, weather_bucket(weather_info))
+    generation = index_generation(FAISS_INDEX_FILE)
+    cached = answer_cache.lookup(query_embedding, fingerprint, generation)
+    if cached:
+        logging.info(f"Answered from the semantic cache (similarity {cached['similarity']:.3f})")
+        return all_chunks, all_metadata, cached["answer"]
+    
     # Generate the response
     ai_response = generate_response(user_query, all_chunks, all_metadata, weather_info)
+    answer_cache.store(query_embedding, fingerprint, ai_response, generation)
     
     return all_chunks, all_metadata, ai_response
 
@@ -274,6 +259,10 @@ if st.sidebar.button("Show Cache Statistics"):
     st.sidebar.write(f"Total cache size: {stats['total_size_mb']:.2f} MB")
     for model, model_stats in stats['models'].items():
         st.sidebar.write(f"Model {model}: {model_stats['file_count']} files, {model_stats['size_mb']:.2f} MB")
+    from semantic_cache import semantic_cache_metrics
+    answer_stats = semantic_cache_metrics("rag_ui")
+    if answer_stats:
+        st.sidebar.write(f"Cached answers: {answer_stats['entries']}, hit rate {answer_stats['hit_rate']:.0%}")
 
 # Add cache clear button
 if st.sidebar.button("Clear Embedding Cache"):
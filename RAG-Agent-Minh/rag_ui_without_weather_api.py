@@ -1,13 +1,14 @@
 import os
-import faiss
 import numpy as np
 import openai
 import streamlit as st
-import json
 import logging
 import sys
-from embedding_cache import get_cached_embedding, cache_embedding
+from chunk_store import open_chunk_store
+from embedders import open_index
 from reranking import hybrid_retrieval
+from context_builder import build_context, count_tokens
+from singleflight import get_group, request_key
 
 # OpenAI API Key
 openai.api_key = ""
@@ -19,28 +20,14 @@ METADATA_FILE = "faiss_metadata.json"
 use_reranking = "--use-reranking" in sys.argv
 
 def load_faiss_index():
-    """Loads the FAISS index from the saved file."""
-    index = faiss.read_index(FAISS_INDEX_FILE)
+    """Returns the memory-mapped index, opened once per process (fails fast on an embedder mismatch)."""
+    index, _ = open_index(FAISS_INDEX_FILE)
     return index
 
 def get_embedding(text):
-    """Generates an embedding for a given query using OpenAI with caching."""
-    # Check cache first
-    cached_embedding = get_cached_embedding(text)
-    if cached_embedding is not None:
-        return cached_embedding
-    
-    # Generate new embedding if not in cache
-    response = openai.embeddings.create(
-        model="text-embedding-3-large", 
-        input=text
-    )
-    embedding = np.array(response.data[0].embedding, dtype=np.float32)
-    
-    # Cache the embedding for future use
-    cache_embedding(text, embedding)
-    
-    return embedding
+    """Embeds a query with the embedder the open index was built with (see its manifest)."""
+    _, embedder = open_index(FAISS_INDEX_FILE)
+    return embedder.embed_query(text)
 
 def search_faiss(query, index, top_k=3, use_reranking=use_reranking):
     """Searches FAISS index for the most relevant chunk with optional reranking."""
@@ -51,24 +38,27 @@ def search_faiss(query, index, top_k=3, use_reranking=use_reranking):
     return indices[0], distances[0]
 
 def load_chunks():
-    """Loads text chunks and metadata from JSON file."""
+    """Opens the chunk store; only the retrieved rows are read from it."""
     try:
-        with open(PROCESSED_FILE, "r", encoding="utf-8") as file:
-            chunks = json.load(file)
-
-        with open(METADATA_FILE, "r", encoding="utf-8") as meta_file:
-            metadata_mapping = json.load(meta_file)
-
-        logging.info(f"✅ Loaded {len(chunks)} chunks and metadata.")
-
-        return chunks, metadata_mapping
+        return open_chunk_store(PROCESSED_FILE, METADATA_FILE)
     except Exception as e:
         logging.error(f"❌ Error loading chunks or metadata: {e}")
-        return [], {}
+        return None
 
-def generate_response(user_query, retrieved_chunks):
+def generate_response(user_query, retrieved_chunks, metadata_list=None):
     """Generates a final AI response using GPT-4 with retrieved knowledge."""
-    context = "\n\n".join(retrieved_chunks)
+    if metadata_list is None:
+        metadata_list = [{} for _ in retrieved_chunks]
+
+    # Pack chunks into the token budget
+    packed = build_context(
+        retrieved_chunks,
+        metadata_list,
+        format_chunk=lambda i, chunk, metadata: ("\n\n" if i else "") + chunk,
+        format_citation=lambda i, metadata: "",
+        reserved_tokens=count_tokens("You are an expert in coffee farming.") + count_tokens(user_query)
+    )
+    context = packed["context"]
     prompt = f"""
     You are an expert in coffee farming. Answer the user's question using only the provided context.
     
@@ -87,19 +77,28 @@ def generate_response(user_query, retrieved_chunks):
     return response.choices[0].message.content
 
 def query_rag_system(user_query):
+    """Answers a query, sharing the work with sessions asking the same question at the same time."""
+    key = request_key(user_query, use_reranking=use_reranking)
+    return get_group("rag_ui_without_weather_api").do(key, lambda: _query_rag_system(user_query))
+
+def _query_rag_system(user_query):
     """Queries FAISS, retrieves relevant text, and generates a response with GPT-4."""
     index = load_faiss_index()
-    chunks, metadata_mapping = load_chunks()
+    chunk_store = load_chunks()
+    if chunk_store is None:
+        return [], "⚠ Could not load the document chunks."
     
     indices, distances = search_faiss(user_query, index, top_k=3, use_reranking=use_reranking)
     
     # Prepare results
     all_chunks = []
+    all_metadata = []
     
     for idx in indices:
-        if idx >= 0:  # Valid index
-            chunk_data = chunks[idx]
+        if 0 <= idx < len(chunk_store):  # Valid index
+            chunk_data = chunk_store.get(idx)
             all_chunks.append(chunk_data["text"])
+            all_metadata.append(chunk_data["metadata"])
     
     # Apply reranking if enabled
     if use_reranking and len(all_chunks) > 1:
@@ -111,13 +110,16 @@ def query_rag_system(user_query):
         
         # Reorganize chunks based on reranking
         reranked_text = []
+        reranked_metadata = []
         for chunk in reranked_chunks:
             original_idx = chunk["original_idx"]
             reranked_text.append(all_chunks[original_idx])
+            reranked_metadata.append(all_metadata[original_idx])
         
         all_chunks = reranked_text
+        all_metadata = reranked_metadata
     
-    ai_response = generate_response(user_query, all_chunks)
+    ai_response = generate_response(user_query, all_chunks, all_metadata)
 
     return all_chunks, ai_response
 
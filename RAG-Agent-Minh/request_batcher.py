@@ -0,0 +1,91 @@
+# request_batcher.py
+import asyncio
+import logging
+
+# Defaults: a few milliseconds is negligible next to an embedding call but lets concurrent requests share one
+BATCH_WINDOW_MS = 5.0
+MAX_BATCH_SIZE = 32
+
+
+class MicroBatcher:
+    """Collects concurrent requests and runs them through one batched call.
+
+    The first request opens a batch; it is dispatched after window_ms or as
+    soon as max_batch_size requests have joined. batch_fn receives the list of
+    items and must return one result per item, in order. A new batch starts
+    collecting while the previous one is still running, so under low load a
+    request waits at most window_ms extra.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=MAX_BATCH_SIZE, window_ms=BATCH_WINDOW_MS, name="batch"):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.window = max(0.0, window_ms) / 1000
+        self.name = name
+        self.stats = {"batches": 0, "items": 0, "largest_batch": 0}
+        self._queue = None
+        self._collector = None
+        self._in_flight = set()
+
+    async def submit(self, item):
+        """Queues one item and waits for its result from the batched call."""
+        if self._collector is None or self._collector.done():
+            # Created lazily so the queue belongs to the running event loop
+            self._queue = asyncio.Queue()
+            self._collector = asyncio.create_task(self._collect())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((item, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            task = asyncio.create_task(self._dispatch(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _dispatch(self, batch):
+        items = [item for item, _ in batch]
+        self.stats["batches"] += 1
+        self.stats["items"] += len(items)
+        self.stats["largest_batch"] = max(self.stats["largest_batch"], len(items))
+        try:
+            results = await self.batch_fn(items)
+            if len(results) != len(items):
+                raise RuntimeError(f"{self.name} returned {len(results)} results for {len(items)} items")
+        except Exception as e:
+            logging.error(f"❌ Batched {self.name} of {len(items)} items failed: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():  # The caller may have been cancelled
+                future.set_result(result)
+
+    def metrics(self):
+        """Batch counts and the average batch size."""
+        batches = self.stats["batches"]
+        return {**self.stats, "average_batch": round(self.stats["items"] / batches, 2) if batches else 0.0}
+
+    async def close(self):
+        """Stops collecting; batches already dispatched finish normally."""
+        if self._collector is not None:
+            self._collector.cancel()
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
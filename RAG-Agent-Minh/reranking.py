@@ -21,12 +21,12 @@ def rerank_chunks(query, chunks, top_k=5):
         # Ensure required packages are installed
         install_required_packages()
         
-        from sentence_transformers import CrossEncoder
+        from model_loader import get_cross_encoder
         
         start_time = time.time()
         
-        # Initialize cross-encoder model
-        model = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2')
+        # Cross-encoder model is loaded once per process
+        model = get_cross_encoder('cross-encoder/ms-marco-MiniLM-L-6-v2')
         
         # Prepare pairs of query and chunks
         pairs = []
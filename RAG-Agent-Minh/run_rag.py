@@ -8,7 +8,7 @@ from datetime import datetime
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 def run_process(command, description):
-    """Run a process with logging."""
+    """Run an external process with logging (only used for the Streamlit UI)."""
     logging.info(f"Starting: {description}")
     start_time = time.time()
     result = os.system(command)
@@ -22,40 +22,76 @@ def run_process(command, description):
 def main():
     parser = argparse.ArgumentParser(description="RAG System Management")
     parser.add_argument("--rebuild", action="store_true", help="Rebuild the entire index")
+    parser.add_argument("--stream", action="store_true",
+                        help="With --rebuild: stream documents through every stage in one process, resuming after a failure")
+    parser.add_argument("--force", action="store_true",
+                        help="With --rebuild: run every stage even if its inputs are unchanged")
+    parser.add_argument("--workers", type=int, default=1, help="With --rebuild: processes used for chunking")
     parser.add_argument("--update", action="store_true", help="Update index with new data")
     parser.add_argument("--add-client", help="Add client-specific data with given client ID")
     parser.add_argument("--client-dir", help="Directory containing client files")
-    parser.add_argument("--remove-client", help="Remove client data with given client ID")
+    parser.add_argument("--remove-client", help="Remove client data for a client ID (or a comma-separated list of IDs)")
     parser.add_argument("--maintenance", action="store_true", help="Run system maintenance")
     parser.add_argument("--serve", action="store_true", help="Start the RAG UI")
+    parser.add_argument("--api", action="store_true", help="Start the streaming chat API for the web client")
+    parser.add_argument("--port", type=int, default=8000, help="With --api: port to listen on")
+    parser.add_argument("--stub-models", action="store_true", help="With --api: use offline stub model endpoints")
     parser.add_argument("--weather-api", action="store_true", help="Use weather API in UI")
     parser.add_argument("--clear-cache", action="store_true", help="Clear embedding cache")
     parser.add_argument("--model", help="Specific model cache to clear")
     parser.add_argument("--no-rerank", action="store_true", help="Disable reranking in retrieval")
+    parser.add_argument("--embedder",
+                        help="Embedder as backend:model, e.g. openai:text-embedding-3-large or "
+                             "local:BAAI/bge-small-en-v1.5 (backends: openai, local, local-onnx, local-int8)")
     # Add to run_rag.py argument parser
+    parser.add_argument("--migrate-embedder",
+                        help="Re-embed the corpus with this embedder (backend:model) into a shadow index and "
+                             "switch to it if recall holds up; the live index keeps serving meanwhile")
+    parser.add_argument("--migration-budget", type=int, default=None,
+                        help="With --migrate-embedder: embedding tokens per minute (0 for no limit)")
+    parser.add_argument("--rollback-index", action="store_true",
+                        help="Switch back to the index generation that was live before the last migration")
+    parser.add_argument("--build-shards", action="store_true", help="Split the index into shards for sharded search")
+    parser.add_argument("--shard-by", choices=["topic", "hash"], default="topic",
+                        help="With --build-shards: one shard per topic, or --num-shards hash buckets")
+    parser.add_argument("--num-shards", type=int, default=4, help="With --build-shards --shard-by hash: shard count")
+    parser.add_argument("--serve-shards", action="store_true",
+                        help="Start a local worker process per shard (with --api: and search through them)")
+    parser.add_argument("--shards", help="With --api: comma-separated host:port shard workers to search")
     parser.add_argument("--fix-chunks", action="store_true", help="Fix any oversized chunks in the processed chunks")
+    parser.add_argument("--benchmark-imports", action="store_true", help="Check that pipeline modules import quickly")
     args = parser.parse_args()
     
-    if args.rebuild:
-        run_process("python extract_text.py", "Extract text")
-        run_process("python preprocess_text.py", "Preprocess text")
-        run_process("python semantic_chunking.py --chunking-method advanced", "Create semantic chunks")
-        run_process("python vectorize_store_faiss.py --rebuild", "Rebuild vector database")
+    if args.embedder:
+        # Set in the environment so the Streamlit UI started below picks it up too
+        from embedders import EMBEDDER_ENV
+        os.environ[EMBEDDER_ENV] = args.embedder
+    
+    # Pipeline stages run in this process so models, clients and parsed files stay warm
+    import orchestrator
+    
+    if args.rebuild and args.stream:
+        from streaming_pipeline import run_streaming_rebuild
+        orchestrator.run_task("Streaming rebuild of vector database", run_streaming_rebuild)
+        
+    elif args.rebuild:
+        orchestrator.rebuild_index(use_advanced_pipeline=True, workers=args.workers, force=args.force)
         
     elif args.update:
-        run_process("python vectorize_store_faiss.py --discover", "Discover and update with new documents")
+        orchestrator.run_task("Discover and update with new documents", orchestrator.update_index)
         
     elif args.add_client:
-        client_dir = args.client_dir or f"docs/clients/{args.add_client}"
-        run_process(f"python vectorize_store_faiss.py --add-client {args.add_client} --client-dir {client_dir}",
-                   f"Add client data for {args.add_client}")
+        orchestrator.run_task(f"Add client data for {args.add_client}",
+                              orchestrator.add_client, args.add_client, args.client_dir)
         
     elif args.remove_client:
-        run_process(f"python vectorize_store_faiss.py --remove-client {args.remove_client}",
-                   f"Remove client data for {args.remove_client}")
+        client_ids = [client_id.strip() for client_id in args.remove_client.split(",") if client_id.strip()]
+        orchestrator.run_task(f"Remove client data for {', '.join(client_ids)}",
+                              orchestrator.remove_clients, client_ids)
         
     elif args.maintenance:
-        run_process("python maintenance.py", "Run system maintenance")
+        from maintenance import perform_maintenance
+        orchestrator.run_task("Run system maintenance", perform_maintenance)
         
     elif args.serve:
         rerank_flag = "" if args.no_rerank else "--use-reranking"
@@ -63,16 +99,42 @@ def main():
             run_process(f"streamlit run rag_ui.py {rerank_flag}", "Start RAG UI with weather API")
         else:
             run_process(f"streamlit run rag_ui_without_weather_api.py {rerank_flag}", "Start RAG UI without weather API")
+    elif args.api:
+        from rag_service import serve
+        shards = args.shards
+        if args.serve_shards:
+            from sharded_search import launch_local_shards
+            _, shards = launch_local_shards()
+        serve(port=args.port, use_reranking=not args.no_rerank, stub=args.stub_models, shards=shards)
+    elif args.build_shards:
+        from sharded_search import build_shards
+        orchestrator.run_task(f"Build index shards by {args.shard_by}", build_shards,
+                              by=args.shard_by, num_shards=args.num_shards)
+    elif args.serve_shards:
+        from sharded_search import launch_local_shards
+        processes, _ = launch_local_shards()
+        for process in processes:
+            process.join()
     elif args.clear_cache:
-        model = args.model
-        if model:
-            run_process(f"python -c \"from embedding_cache import clear_cache; clear_cache('{model}')\"", 
-                    f"Clear cache for model {model}")
+        from embedding_cache import clear_cache
+        if args.model:
+            orchestrator.run_task(f"Clear cache for model {args.model}", clear_cache, args.model)
         else:
-            run_process("python -c \"from embedding_cache import clear_cache; clear_cache()\"", 
-                    "Clear all embedding caches")
+            orchestrator.run_task("Clear all embedding caches", clear_cache)
+    elif args.migrate_embedder:
+        from embedding_migration import run_migration, TOKENS_PER_MINUTE
+        budget = TOKENS_PER_MINUTE if args.migration_budget is None else args.migration_budget
+        orchestrator.run_task(f"Migrate index to {args.migrate_embedder}",
+                              run_migration, args.migrate_embedder, tokens_per_minute=budget)
+    elif args.rollback_index:
+        from embedding_migration import rollback_index
+        orchestrator.run_task("Roll back to the previous index generation", rollback_index)
     elif args.fix_chunks:
-        run_process("python fix_chunks.py", "Fix oversized chunks")
+        from fix_chunks import fix_oversized_chunks
+        orchestrator.run_task("Fix oversized chunks", fix_oversized_chunks)
+    elif args.benchmark_imports:
+        from benchmark_imports import run_benchmark
+        orchestrator.run_task("Benchmark module import time", run_benchmark)
     else:
         parser.print_help()
 
@@ -0,0 +1,169 @@
+# semantic_cache.py
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import faiss
+import numpy as np
+
+# Cosine similarity above which two questions are treated as the same question
+SIMILARITY_THRESHOLD = 0.95
+TTL_SECONDS = 24 * 3600
+MAX_ENTRIES = 2000
+
+# Neighbours checked per lookup: a close question may have been asked with a different context
+CANDIDATES = 5
+
+
+def context_fingerprint(chunk_ids, *extra):
+    """Fingerprint of what an answer was generated from: the retrieved chunk ids in order, plus extras."""
+    payload = "|".join([",".join(str(int(chunk_id)) for chunk_id in chunk_ids), *(str(value) for value in extra)])
+    return hashlib.md5(payload.encode()).hexdigest()
+
+
+def weather_bucket(weather_info):
+    """Coarse weather so answers are reused across small temperature/humidity changes."""
+    if not weather_info:
+        return "no-weather"
+    temperature = int(float(weather_info["temperature"]) // 5 * 5)
+    humidity = int(float(weather_info["humidity"]) // 20 * 20)
+    return f"{weather_info.get('city', '').lower()}|{temperature}C|{humidity}%|{weather_info['condition'].lower()}"
+
+
+class SemanticCache:
+    """Answer cache looked up by query embedding similarity.
+
+    Query vectors live in a small inner-product FAISS index (vectors are
+    normalised, so scores are cosine similarities). A hit needs a similar
+    enough query and the same context fingerprint. Entries expire after
+    ttl_seconds, the least recently used are evicted beyond max_entries, and
+    everything is dropped when the main index generation changes.
+    """
+
+    def __init__(self, dimension, threshold=SIMILARITY_THRESHOLD, ttl_seconds=TTL_SECONDS,
+                 max_entries=MAX_ENTRIES, name="semantic_cache"):
+        self.dimension = dimension
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.name = name
+        self.index = faiss.IndexIDMap(faiss.IndexFlatIP(dimension))
+        self.entries = OrderedDict()  # id -> entry, least recently used first
+        self.generation = None
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32).reshape(1, -1).copy()
+        faiss.normalize_L2(vector)
+        return vector
+
+    def _remove(self, ids):
+        if ids:
+            self.index.remove_ids(np.asarray(ids, dtype=np.int64))
+            for entry_id in ids:
+                self.entries.pop(entry_id, None)
+
+    def _check_generation(self, generation):
+        if generation is not None and generation != self.generation:
+            if self.entries:
+                logging.info(f"Index generation changed, dropping {len(self.entries)} cached answers")
+                self.stats["invalidations"] += 1
+            self._remove(list(self.entries))
+            self.generation = generation
+
+    def lookup(self, query_vector, fingerprint, generation=None):
+        """Returns the cached entry for a similar query with the same context, or None."""
+        with self._lock:
+            self._check_generation(generation)
+            if not self.entries:
+                self.stats["misses"] += 1
+                return None
+
+            scores, ids = self.index.search(self._normalize(query_vector), min(CANDIDATES, len(self.entries)))
+            now = time.time()
+            expired = []
+            hit = None
+            for score, entry_id in zip(scores[0], ids[0]):
+                if entry_id < 0 or score < self.threshold:
+                    break
+                entry = self.entries[int(entry_id)]
+                if now - entry["created_at"] > self.ttl_seconds:
+                    expired.append(int(entry_id))
+                elif entry["fingerprint"] == fingerprint:
+                    hit = {**entry, "similarity": float(score)}
+                    self.entries.move_to_end(int(entry_id))
+                    break
+            self._remove(expired)
+
+            self.stats["hits" if hit else "misses"] += 1
+            return hit
+
+    def store(self, query_vector, fingerprint, answer, generation=None, **payload):
+        """Caches an answer with anything else needed to replay it (sources, follow-ups...).
+
+        Nothing is added if the cache already answers this query and context:
+        concurrent requests sharing one answer would otherwise each store a
+        copy and crowd the neighbours checked per lookup.
+        """
+        with self._lock:
+            self._check_generation(generation)
+
+            now = time.time()
+            expired = [entry_id for entry_id, entry in self.entries.items()
+                       if now - entry["created_at"] > self.ttl_seconds]
+            self._remove(expired)
+
+            if self.entries:
+                scores, ids = self.index.search(self._normalize(query_vector), min(CANDIDATES, len(self.entries)))
+                for score, entry_id in zip(scores[0], ids[0]):
+                    if entry_id < 0 or score < self.threshold:
+                        break
+                    if self.entries[int(entry_id)]["fingerprint"] == fingerprint:
+                        self.entries.move_to_end(int(entry_id))
+                        return
+
+            overflow = len(self.entries) + 1 - self.max_entries
+            if overflow > 0:
+                self._remove(list(self.entries)[:overflow])
+                self.stats["evictions"] += overflow
+
+            entry_id = self._next_id
+            self._next_id += 1
+            self.index.add_with_ids(self._normalize(query_vector), np.array([entry_id], dtype=np.int64))
+            self.entries[entry_id] = {"fingerprint": fingerprint, "answer": answer, "created_at": now, **payload}
+
+    def clear(self):
+        with self._lock:
+            self._remove(list(self.entries))
+
+    def metrics(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self.entries),
+            "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else 0.0
+        }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_semantic_cache(name, dimension, **options):
+    """Returns the process-wide cache for a name (Streamlit re-runs scripts, so it must live here)."""
+    with _caches_lock:
+        cache = _caches.get(name)
+        if cache is None or cache.dimension != dimension:
+            cache = _caches[name] = SemanticCache(dimension, name=name, **options)
+        return cache
+
+
+def semantic_cache_metrics(name):
+    """Metrics of a named cache, or None if nothing has been cached under that name yet."""
+    cache = _caches.get(name)
+    return cache.metrics() if cache else None
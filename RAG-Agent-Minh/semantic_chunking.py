@@ -1,108 +1,218 @@
 import os
-import nltk
 import numpy as np
 import json
-from sentence_transformers import SentenceTransformer
 import logging
 import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from advanced_chunking import optimized_chunking_pipeline
+from chunk_splitter import split_oversized_chunks
+from chunk_stats import empty_chunk_stats, extend_chunk_stats, save_chunk_stats, CHUNK_STATS_FILE
+from jsonl_utils import append_jsonl, write_json_array_from_jsonl
+from model_loader import get_sentence_model, sent_tokenize
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
-# Disable TensorFlow unnecessary logs
-os.environ["TF_ENABLE_ONEDNN_OPTS"] = "0"
-os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
-
-# Download NLTK tokenizer
-nltk.download("punkt", quiet=True)
-
-# Load Sentence Transformer Model
-model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+# Sentence Transformer model is loaded lazily, only by the standard chunking path
 
 # Input & Output Files
 INPUT_FILE = "processed_text.json"
 OUTPUT_FILE = "processed_chunks.json"
+OUTPUT_JSONL_FILE = "processed_chunks.jsonl"  # Append-only stream written while chunking
 SIMILARITY_LOG_FILE = "similarity_log.txt"
 
 # Threshold for splitting chunks
 SIMILARITY_THRESHOLD = 0.7
 
-def semantic_chunking(text, metadata, use_advanced_pipeline=True):
+# Boundary detection: "threshold" (fixed cutoff), "percentile" (lowest N% of
+# adjacent similarities per document) or "window" (dips below the local mean)
+BOUNDARY_METHOD = "threshold"
+BOUNDARY_PERCENTILE = 10
+BOUNDARY_WINDOW = 5
+
+# Sentences encoded per model batch
+ENCODE_BATCH_SIZE = 256
+
+def encode_sentences(sentence_lists):
+    """Encodes the sentences of many documents in large batches.
+
+    Embeddings are L2-normalised once, so cosine similarity is a plain dot product.
+    Returns one embedding matrix per document.
+    """
+    all_sentences = [sentence for sentences in sentence_lists for sentence in sentences]
+    if not all_sentences:
+        return [np.zeros((0, 0), dtype=np.float32) for _ in sentence_lists]
+
+    embeddings = get_sentence_model().encode(
+        all_sentences,
+        batch_size=ENCODE_BATCH_SIZE,
+        convert_to_numpy=True,
+        normalize_embeddings=True
+    )
+    offsets = np.cumsum([len(sentences) for sentences in sentence_lists])[:-1]
+    return np.split(embeddings, offsets)
+
+def adjacent_similarities(embeddings):
+    """Cosine similarity of each sentence with the next one (embeddings must be normalised)."""
+    if len(embeddings) < 2:
+        return np.zeros(0, dtype=np.float32)
+    return np.einsum("ij,ij->i", embeddings[:-1], embeddings[1:])
+
+def find_boundaries(similarities, method=BOUNDARY_METHOD, threshold=SIMILARITY_THRESHOLD,
+                    percentile=BOUNDARY_PERCENTILE, window=BOUNDARY_WINDOW):
+    """Returns a boolean array, True where a new chunk starts after sentence pair i."""
+    if len(similarities) == 0:
+        return np.zeros(0, dtype=bool)
+
+    if method == "percentile":
+        return similarities < np.percentile(similarities, percentile)
+
+    if method == "window":
+        # Local mean and standard deviation over a centred window
+        kernel = np.ones(window) / window
+        padded = np.pad(similarities, window // 2, mode="edge")
+        local_mean = np.convolve(padded, kernel, mode="valid")[:len(similarities)]
+        local_sq = np.convolve(padded ** 2, kernel, mode="valid")[:len(similarities)]
+        local_std = np.sqrt(np.maximum(local_sq - local_mean ** 2, 0))
+        return similarities < local_mean - local_std
+
+    return similarities < threshold
+
+def standard_chunking(documents, boundary_method=BOUNDARY_METHOD, log_file=SIMILARITY_LOG_FILE):
+    """Similarity-based chunking for a batch of (text, metadata) documents.
+
+    Returns one list of chunks per document and writes the similarity log
+    (skipped when log_file is None).
+    """
+    sentence_lists = [sent_tokenize(text) for text, _ in documents]
+    embedding_lists = encode_sentences(sentence_lists)
+
+    results = []
+    log_entries = []
+    for (_, metadata), sentences, embeddings in zip(documents, sentence_lists, embedding_lists):
+        if not sentences:
+            results.append([])
+            continue
+
+        similarities = adjacent_similarities(embeddings)
+        boundaries = find_boundaries(similarities, method=boundary_method)
+
+        log_entries.append(f"=== {metadata.get('filename', 'Unknown')} ===")
+        for i, (similarity, is_boundary) in enumerate(zip(similarities, boundaries), start=1):
+            log_entries.append(f"Sentence {i} -> {i+1}: Similarity = {similarity:.2f}")
+            if is_boundary:
+                log_entries.append("--- New Chunk Started ---")
+
+        starts = np.concatenate(([0], np.flatnonzero(boundaries) + 1, [len(sentences)]))
+        results.append([
+            {
+                "text": " ".join(sentences[start:end]),
+                "metadata": metadata  # Attach metadata to chunk
+            }
+            for start, end in zip(starts[:-1], starts[1:])
+        ])
+        logging.info(f"Standard chunking split {metadata.get('filename', 'Unknown')} into {len(results[-1])} chunks")
+
+    if log_file:
+        with open(log_file, "w", encoding="utf-8") as file:
+            file.write("\n".join(log_entries))
+
+    return results
+
+def semantic_chunking(text, metadata, use_advanced_pipeline=True, boundary_method=BOUNDARY_METHOD):
     """Splits text into semantically meaningful chunks using either advanced pipeline or standard approach."""
     
     # If advanced pipeline is enabled, use it
     if use_advanced_pipeline:
         logging.info(f"Using advanced multi-stage chunking pipeline for {metadata.get('filename', 'Unknown')}")
-        return optimized_chunking_pipeline(text, metadata)
+        return split_oversized_chunks(optimized_chunking_pipeline(text, metadata))
     
     # Otherwise, use the original semantic chunking method
     logging.info(f"Using standard semantic chunking for {metadata.get('filename', 'Unknown')}")
-    sentences = nltk.sent_tokenize(text)
-
-    # Compute embeddings for each sentence
-    embeddings = model.encode(sentences, convert_to_numpy=True)
-
-    chunks = []
-    current_chunk = [sentences[0]]
-    similarity_scores = []
-    log_entries = []
-
-    for i in range(1, len(sentences)):
-        similarity = np.dot(embeddings[i - 1], embeddings[i]) / (
-            np.linalg.norm(embeddings[i - 1]) * np.linalg.norm(embeddings[i])
-        )
-        similarity_scores.append(similarity)
-        log_entry = f"Sentence {i} -> {i+1}: Similarity = {similarity:.2f}"
-        log_entries.append(log_entry)
-
-        if similarity < SIMILARITY_THRESHOLD:
-            chunks.append({
-                "text": " ".join(current_chunk),
-                "metadata": metadata  # Attach metadata to chunk
-            })
-            current_chunk = [sentences[i]]
-            logging.info(f"New chunk started at sentence {i+1} due to similarity {similarity:.2f}")
-            log_entries.append("--- New Chunk Started ---")
+    return split_oversized_chunks(standard_chunking([(text, metadata)], boundary_method)[0])
+
+def create_semantic_chunks(text, use_advanced_pipeline=True):
+    """Chunks a single piece of text and returns the chunk texts."""
+    return [chunk["text"] for chunk in semantic_chunking(text, {}, use_advanced_pipeline)]
+
+def document_metadata(doc):
+    """Builds the chunk metadata for a processed document."""
+    return {
+        "filename": doc["filename"],
+        "file_type": doc["file_type"],
+        "extracted_date": doc["metadata"].get("extracted_date", "Unknown"),
+        "source": doc["metadata"].get("source", "Unknown"),
+    }
+
+def _chunk_document(text, metadata, use_advanced_pipeline, boundary_method):
+    """Process pool worker: chunks a single document and splits chunks too large to embed."""
+    if use_advanced_pipeline:
+        return split_oversized_chunks(optimized_chunking_pipeline(text, metadata))
+    # Workers would overwrite each other's similarity log, so skip it
+    return split_oversized_chunks(standard_chunking([(text, metadata)], boundary_method, log_file=None)[0])
+
+def iter_document_chunks(doc_inputs, use_advanced_pipeline=True, boundary_method=BOUNDARY_METHOD, workers=1):
+    """Yields the chunks of each (text, metadata) document, always in input order.
+
+    With more than one worker, documents are chunked in a process pool. At most
+    two documents per worker are in flight, so memory stays bounded no matter
+    how large the corpus is.
+    """
+    if workers <= 1:
+        if use_advanced_pipeline:
+            for text, metadata in doc_inputs:
+                yield semantic_chunking(text, metadata, use_advanced_pipeline)
         else:
-            current_chunk.append(sentences[i])
-
-    if current_chunk:
-        chunks.append({
-            "text": " ".join(current_chunk),
-            "metadata": metadata
-        })
-
-    with open(SIMILARITY_LOG_FILE, "w", encoding="utf-8") as log_file:
-        log_file.write("\n".join(log_entries))
-
-    return chunks
-
-def process_text(use_advanced_pipeline=True):
-    """Reads input JSON, applies semantic chunking, and saves processed chunks as JSON."""
+            # Encode the sentences of all documents together in large batches
+            for chunks in standard_chunking(list(doc_inputs), boundary_method):
+                yield split_oversized_chunks(chunks)
+        return
+
+    inputs = iter(doc_inputs)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        def submit_next():
+            doc = next(inputs, None)
+            if doc is not None:
+                text, metadata = doc
+                pending.append(executor.submit(_chunk_document, text, metadata, use_advanced_pipeline, boundary_method))
+
+        for _ in range(workers * 2):
+            submit_next()
+
+        while pending:
+            chunks = pending.popleft().result()
+            submit_next()
+            yield chunks
+
+def process_text(use_advanced_pipeline=True, boundary_method=BOUNDARY_METHOD, workers=1):
+    """Reads input JSON, applies semantic chunking, and saves processed chunks as JSON.
+
+    Chunks are streamed to processed_chunks.jsonl as each document finishes, then
+    copied line by line into processed_chunks.json for the index build and UIs.
+    """
     try:
         with open(INPUT_FILE, "r", encoding="utf-8") as file:
             documents = json.load(file)
 
         chunking_method = "advanced multi-stage pipeline" if use_advanced_pipeline else "standard semantic chunking"
-        logging.info(f"Applying {chunking_method}...")
-
-        all_chunks = []
-        for doc in documents:
-            text = doc["text"]
-            metadata = {
-                "filename": doc["filename"],
-                "file_type": doc["file_type"],
-                "extracted_date": doc["metadata"].get("extracted_date", "Unknown"),
-                "source": doc["metadata"].get("source", "Unknown"),
-            }
-            chunks = semantic_chunking(text, metadata, use_advanced_pipeline)
-            all_chunks.extend(chunks)
+        logging.info(f"Applying {chunking_method} with {workers} worker(s)...")
+
+        doc_inputs = ((doc["text"], document_metadata(doc)) for doc in documents)
+
+        # Token counts, hashes and lengths for downstream stages
+        stats = empty_chunk_stats()
+        with open(OUTPUT_JSONL_FILE, "w", encoding="utf-8") as jsonl_file:
+            for chunks in iter_document_chunks(doc_inputs, use_advanced_pipeline, boundary_method, workers):
+                append_jsonl(jsonl_file, chunks)
+                extend_chunk_stats(stats, chunks)
 
-        with open(OUTPUT_FILE, "w", encoding="utf-8") as file:
-            json.dump(all_chunks, file, indent=4, ensure_ascii=False)
+        total_chunks = write_json_array_from_jsonl(OUTPUT_JSONL_FILE, OUTPUT_FILE)
+        logging.info(f"Processed {total_chunks} chunks saved to {OUTPUT_FILE}")
 
-        logging.info(f"Processed {len(all_chunks)} chunks saved to {OUTPUT_FILE}")
+        save_chunk_stats(stats, CHUNK_STATS_FILE)
 
     except Exception as e:
         logging.error(f"Error processing text: {e}")
@@ -112,9 +222,14 @@ if __name__ == "__main__":
     parser.add_argument("--chunking-method", choices=["standard", "advanced"], 
                         default="advanced", 
                         help="Chunking method to use (standard = similarity-based, advanced = multi-stage pipeline)")
+    parser.add_argument("--boundary-method", choices=["threshold", "percentile", "window"],
+                        default=BOUNDARY_METHOD,
+                        help="How the standard method detects chunk boundaries from sentence similarities")
+    parser.add_argument("--workers", type=int, default=1,
+                        help=f"Chunk documents in parallel with this many processes (this machine has {os.cpu_count()} cores)")
     
     args = parser.parse_args()
     use_advanced_pipeline = (args.chunking_method == "advanced")
     
     # Process text with the selected chunking method
-    process_text(use_advanced_pipeline)
\ No newline at end of file
+    process_text(use_advanced_pipeline, args.boundary_method, args.workers)
\ No newline at end of file
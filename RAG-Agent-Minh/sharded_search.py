@@ -0,0 +1,423 @@
+# sharded_search.py
+import os
+import re
+import json
+import time
+import heapq
+import hashlib
+import socket
+import logging
+import argparse
+import threading
+import multiprocessing
+from multiprocessing.connection import Listener, Connection, answer_challenge, deliver_challenge
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import faiss
+import numpy as np
+
+from embedders import (load_index, read_index, save_index_manifest, load_index_manifest, manifest_path,
+                       index_generation, write_index)
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+FAISS_INDEX_FILE = "faiss_index.bin"
+METADATA_FILE = "faiss_metadata.json"
+
+SHARD_DIR = "shards"
+SHARD_MAP_FILE = os.path.join(SHARD_DIR, "shard_map.json")
+NUM_SHARDS = 4  # With --shard-by hash
+SHARD_BASE_PORT = 7100
+
+# A shard that has not answered by then is left out of the merged results
+SHARD_TIMEOUT_SECONDS = 2.0
+# Requests in flight to one shard at a time
+SHARD_CONNECTIONS = 4
+
+# Messages are pickled, so every worker and client must share this key
+SHARD_AUTHKEY_ENV = "RAG_SHARD_AUTHKEY"
+DEFAULT_AUTHKEY = b"rag-shards-local"
+
+# Vectors copied from the live index into the shards per step
+BUILD_BATCH_SIZE = 10000
+
+
+def shard_authkey():
+    key = os.getenv(SHARD_AUTHKEY_ENV)
+    return key.encode() if key else DEFAULT_AUTHKEY
+
+
+def parse_shard_addresses(addresses):
+    """"host:port,host:port" -> [(host, port), ...]"""
+    parsed = []
+    for address in addresses.split(",") if isinstance(addresses, str) else addresses:
+        if isinstance(address, str):
+            host, _, port = address.strip().rpartition(":")
+            address = (host or "127.0.0.1", int(port))
+        parsed.append(tuple(address))
+    return parsed
+
+
+def shard_key(vector_id, metadata, by="topic", num_shards=NUM_SHARDS):
+    """Name of the shard a vector belongs to: its topic, or a hash bucket of its content."""
+    if by == "topic":
+        return re.sub(r"[^A-Za-z0-9_-]+", "_", metadata.get("topic") or "Unknown")
+    key = str(metadata.get("content_hash") or vector_id)
+    return f"hash{int(hashlib.md5(key.encode()).hexdigest(), 16) % num_shards:02d}"
+
+
+def build_shards(index_file=FAISS_INDEX_FILE, metadata_file=METADATA_FILE, by="topic",
+                 num_shards=NUM_SHARDS, shard_dir=SHARD_DIR):
+    """Splits the live index into shard indexes that keep the global vector ids.
+
+    Each shard is an HNSW index wrapped in an IndexIDMap, so its results are
+    ids into the chunk store like the live index's. Vectors are copied in
+    batches, and the shard map records which files serve which shards.
+    """
+    from vectorize_store_faiss import create_hnsw_index
+
+    index, embedder = load_index(index_file)
+    metadata_mapping = {}
+    if os.path.exists(metadata_file):
+        with open(metadata_file, "r", encoding="utf-8") as file:
+            metadata_mapping = json.load(file)
+    keys = np.array([shard_key(vector_id, metadata_mapping.get(str(vector_id), {}), by, num_shards)
+                     for vector_id in range(index.ntotal)])
+    names = sorted(set(keys.tolist()))
+    shards = {name: faiss.IndexIDMap(create_hnsw_index(index.d)) for name in names}
+
+    for start in range(0, index.ntotal, BUILD_BATCH_SIZE):
+        count = min(BUILD_BATCH_SIZE, index.ntotal - start)
+        vectors = index.reconstruct_n(start, count)
+        ids = np.arange(start, start + count, dtype=np.int64)
+        for name in names:
+            mask = keys[start:start + count] == name
+            if mask.any():
+                shards[name].add_with_ids(np.ascontiguousarray(vectors[mask]), ids[mask])
+
+    os.makedirs(shard_dir, exist_ok=True)
+    source = {"source": index_file, "source_generation": index_generation(index_file), "source_vectors": index.ntotal}
+    shard_map = {"by": by, **source, "dimension": index.d, "vectors": index.ntotal, "shards": []}
+    for name in names:
+        shard_file = os.path.join(shard_dir, f"shard_{name}.bin")
+        write_index(shards[name], shard_file)
+        # Workers report which build of the live index their shard was cut from
+        manifest = {**save_index_manifest(shard_file, embedder), **source}
+        with open(manifest_path(shard_file), "w", encoding="utf-8") as file:
+            json.dump(manifest, file, indent=4)
+        shard_map["shards"].append({"name": name, "file": shard_file, "vectors": shards[name].ntotal})
+        logging.info(f"✅ Shard {name}: {shards[name].ntotal} vectors in {shard_file}")
+
+    with open(os.path.join(shard_dir, os.path.basename(SHARD_MAP_FILE)), "w", encoding="utf-8") as file:
+        json.dump(shard_map, file, indent=4)
+    return shard_map
+
+
+def _handle_connection(connection, shard):
+    with connection:
+        while True:
+            try:
+                request = connection.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                index, manifest = shard["open"]()
+                if request[0] == "search":
+                    _, queries, k = request
+                    distances, ids = index.search(np.ascontiguousarray(queries, dtype=np.float32), k)
+                    # Clients drop results from a shard rebuilt since they connected
+                    connection.send(("ok", distances, ids, manifest.get("source_generation")))
+                elif request[0] == "info":
+                    connection.send(("ok", {"file": shard["file"], "vectors": index.ntotal, "dimension": index.d,
+                                            "metric_type": int(index.metric_type),
+                                            "generation": index_generation(shard["file"]),
+                                            "embedder": manifest.get("embedder"),
+                                            "source_generation": manifest.get("source_generation"),
+                                            "source_vectors": manifest.get("source_vectors")}))
+                else:
+                    connection.send(("error", f"Unknown request {request[0]!r}"))
+            except Exception as e:
+                connection.send(("error", str(e)))
+
+
+def serve_shard(shard_file, address, authkey=None):
+    """Serves searches on one shard index over a multiprocessing connection, until killed.
+
+    The shard is memory-mapped and reopened when its file is replaced.
+    Each client connection gets its own thread.
+    """
+    lock = threading.Lock()
+    opened = {}
+
+    def open_shard():
+        generation = index_generation(shard_file)
+        with lock:
+            if opened.get("generation") != generation:
+                opened["index"] = read_index(shard_file, mmap=True)
+                opened["generation"] = generation
+            # The manifest is written just after the shard, so it is read again until it matches
+            if (opened.get("manifest") or {}).get("index_generation") != generation:
+                opened["manifest"] = load_index_manifest(shard_file) or {}
+            return opened["index"], opened["manifest"]
+
+    authkey = authkey or shard_authkey()
+    if authkey == DEFAULT_AUTHKEY and address[0] not in ("127.0.0.1", "localhost"):
+        logging.warning(f"⚠ Serving {shard_file} on {address[0]} with the default key, set {SHARD_AUTHKEY_ENV}")
+    shard = {"file": shard_file, "open": open_shard}
+    open_shard()
+    with Listener(tuple(address), authkey=authkey) as listener:
+        logging.info(f"✅ Serving {shard_file} on {address[0]}:{address[1]}")
+        while True:
+            try:
+                connection = listener.accept()
+            except Exception as e:  # A client with the wrong key, or one that hung up during the handshake
+                logging.warning(f"⚠ Rejected a shard connection: {e}")
+                continue
+            threading.Thread(target=_handle_connection, args=(connection, shard), daemon=True).start()
+
+
+class ShardClient:
+    """Pool of connections to one shard worker, one request in flight per connection.
+
+    Every request has a deadline, which also bounds connecting and waiting
+    for a free connection: a slow or unreachable shard costs each search at
+    most the timeout, and never holds up requests to other shards.
+    """
+
+    def __init__(self, address, authkey=None, max_connections=SHARD_CONNECTIONS):
+        self.address = tuple(address)
+        self.authkey = authkey or shard_authkey()
+        self.max_connections = max_connections
+        self.stats = {"searches": 0, "timeouts": 0, "errors": 0, "last_ms": None}
+        self.executor = ThreadPoolExecutor(max_workers=max_connections,
+                                           thread_name_prefix=f"shard-{self.address[1]}")
+        self._idle = []
+        self._idle_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self.closed = False
+
+    def _timeout_error(self, what):
+        return TimeoutError(f"Shard {self.address[0]}:{self.address[1]} {what}")
+
+    def _connect(self, deadline):
+        """Connects and authenticates like multiprocessing.connection.Client, within the deadline."""
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise self._timeout_error("was not reached before the deadline")
+        sock = socket.create_connection(self.address, timeout=remaining)
+        sock.setblocking(True)
+        connection = Connection(sock.detach())
+        try:
+            # The worker sends the first challenge; a frozen worker must not hang the handshake
+            if not connection.poll(max(0.0, deadline - time.time())):
+                raise self._timeout_error("accepted the connection but did not authenticate it")
+            answer_challenge(connection, self.authkey)
+            deliver_challenge(connection, self.authkey)
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    def request(self, message, timeout=SHARD_TIMEOUT_SECONDS, deadline=None):
+        deadline = deadline or time.time() + timeout
+        if not self._slots.acquire(timeout=max(0.0, deadline - time.time())):
+            raise self._timeout_error(f"is busy with {self.max_connections} requests")
+        connection = None
+        try:
+            with self._idle_lock:
+                connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                connection = self._connect(deadline)
+            connection.send(message)
+            if not connection.poll(max(0.0, deadline - time.time())):
+                raise self._timeout_error(f"did not answer in {timeout}s")
+            status, *payload = connection.recv()
+        except BaseException:
+            # A late reply would answer the next request, so the connection is dropped
+            if connection is not None:
+                connection.close()
+                connection = None
+            raise
+        finally:
+            if connection is not None:
+                with self._idle_lock:
+                    if self.closed:
+                        connection.close()
+                    else:
+                        self._idle.append(connection)
+            self._slots.release()
+        if status != "ok":
+            raise RuntimeError(f"Shard {self.address[0]}:{self.address[1]} failed: {payload[0]}")
+        return payload
+
+    def info(self, timeout=SHARD_TIMEOUT_SECONDS):
+        return self.request(("info",), timeout)[0]
+
+    def search(self, queries, k, timeout=SHARD_TIMEOUT_SECONDS, deadline=None):
+        start_time = time.time()
+        distances, ids, source_generation = self.request(("search", queries, k), timeout, deadline)
+        self.stats["last_ms"] = round((time.time() - start_time) * 1000, 1)
+        return distances, ids, source_generation
+
+    def close(self):
+        """Closes pooled connections and stops the client's threads; requests in flight still finish."""
+        with self._idle_lock:
+            self.closed = True
+            for connection in self._idle:
+                connection.close()
+            self._idle = []
+        self.executor.shutdown(wait=False)
+
+
+class ShardedIndex:
+    """Scatter-gather search over shard workers, used in place of a FAISS index.
+
+    A search is sent to every shard in parallel; the per-query top k is
+    merged from the shards that answer within the timeout. A slow or
+    failed shard makes the results partial, not the request fail.
+    """
+
+    def __init__(self, addresses, timeout=SHARD_TIMEOUT_SECONDS, authkey=None):
+        self.clients = [ShardClient(address, authkey) for address in parse_shard_addresses(addresses)]
+        self.timeout = timeout
+        self.partial_searches = 0
+        self.closed = False
+        # Set when a worker answers from a shard rebuilt since this index was opened
+        self.stale = False
+        try:
+            self.shards = [client.info(timeout) for client in self.clients]
+        except BaseException:
+            self.close()
+            raise
+        dimensions = {shard["dimension"] for shard in self.shards}
+        if len(dimensions) != 1:
+            raise ValueError(f"Shards hold vectors of different sizes: {sorted(dimensions)}")
+        self.d = dimensions.pop()
+        self.metric_type = self.shards[0]["metric_type"]
+        self.embedder = self.shards[0]["embedder"]
+        self.ntotal = sum(shard["vectors"] for shard in self.shards)
+        sources = {(shard.get("source_generation"), shard.get("source_vectors")) for shard in self.shards}
+        if len(sources) != 1:
+            self.close()
+            raise ValueError("Shards were built from different builds of the index, rebuild them with --build-shards")
+        self.source_generation, source_vectors = sources.pop()
+        if source_vectors is not None and source_vectors != self.ntotal:
+            self.close()
+            raise ValueError(f"Shards hold {self.ntotal} of the {source_vectors} vectors they were built from, "
+                             "a shard worker is missing")
+
+    def check_source(self, index_file, chunk_store):
+        """Raises ValueError if the shards were not built from the live index, so their ids would read the wrong chunks.
+
+        The live index file is only compared when it exists here; the vector
+        count is always compared with the chunk store the ids are read from.
+        """
+        live_generation = index_generation(index_file)
+        if live_generation is not None and self.source_generation not in (None, live_generation):
+            raise ValueError(f"The shards were built from an older {index_file}, rebuild them with --build-shards")
+        if self.ntotal != len(chunk_store):
+            raise ValueError(f"The shards hold {self.ntotal} vectors but the chunk store has {len(chunk_store)} rows, "
+                             "rebuild them with --build-shards")
+
+    def close(self):
+        """Stops the shard clients. Searches still running finish; later ones return no results."""
+        self.closed = True
+        for client in self.clients:
+            client.close()
+
+    def _search_shard(self, client, queries, k, deadline):
+        client.stats["searches"] += 1
+        try:
+            if time.time() >= deadline:
+                raise client._timeout_error("was still queued at the deadline")
+            distances, ids, source_generation = client.search(queries, k, self.timeout, deadline)
+            if source_generation != self.source_generation:
+                # Its ids belong to another build of the index than the chunk store being served
+                self.stale = True
+                raise RuntimeError("its shard was rebuilt from another index, reload the service's index")
+            return distances, ids
+        except TimeoutError as e:
+            client.stats["timeouts"] += 1
+            logging.warning(f"⚠ {e}")
+        except Exception as e:
+            client.stats["errors"] += 1
+            logging.warning(f"⚠ Shard {client.address[0]}:{client.address[1]} search failed: {e!r}")
+        return None
+
+    def search(self, queries, k):
+        """Same contract as faiss Index.search: (distances, ids), padded with -1 ids."""
+        queries = np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, self.d)
+        deadline = time.time() + self.timeout
+        # Each shard has its own threads, so a slow shard's backlog cannot delay the others.
+        # A closed index (replaced by a reload) has none left and searches nothing.
+        try:
+            futures = [] if self.closed else [client.executor.submit(self._search_shard, client, queries, k, deadline)
+                                              for client in self.clients]
+        except RuntimeError:  # Closed while submitting
+            futures = []
+        done, _ = wait(futures, timeout=self.timeout + 0.5)
+        answers = [future.result() for future in futures if future in done and future.result() is not None]
+        if len(answers) < len(self.clients):
+            self.partial_searches += 1
+
+        # Lower is closer for L2, higher for inner product
+        pick = heapq.nlargest if self.metric_type == faiss.METRIC_INNER_PRODUCT else heapq.nsmallest
+        empty = -np.inf if self.metric_type == faiss.METRIC_INNER_PRODUCT else np.inf
+        distances = np.full((len(queries), k), empty, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for row in range(len(queries)):
+            candidates = [(float(distance), int(vector_id)) for shard_distances, shard_ids in answers
+                          for distance, vector_id in zip(shard_distances[row], shard_ids[row]) if vector_id >= 0]
+            for position, (distance, vector_id) in enumerate(pick(k, candidates)):
+                distances[row, position] = distance
+                ids[row, position] = vector_id
+        return distances, ids
+
+    def metrics(self):
+        return {
+            "partial_searches": self.partial_searches,
+            "shards": {f"{client.address[0]}:{client.address[1]}": {**client.stats, "vectors": shard["vectors"]}
+                       for client, shard in zip(self.clients, self.shards)}
+        }
+
+
+def launch_local_shards(shard_map_file=SHARD_MAP_FILE, host="127.0.0.1", base_port=SHARD_BASE_PORT,
+                        authkey=None, start_timeout=30):
+    """Starts one worker process per shard in the map on consecutive ports. Returns (processes, addresses)."""
+    with open(shard_map_file, "r", encoding="utf-8") as file:
+        shard_map = json.load(file)
+    processes, addresses = [], []
+    for offset, shard in enumerate(shard_map["shards"]):
+        address = (host, base_port + offset)
+        process = multiprocessing.Process(target=serve_shard, args=(shard["file"], address, authkey),
+                                          name=f"shard-{shard['name']}", daemon=True)
+        process.start()
+        processes.append(process)
+        addresses.append(address)
+
+    # Wait until every worker accepts connections
+    deadline = time.time() + start_timeout
+    for address, process in zip(addresses, processes):
+        while True:
+            client = ShardClient(address, authkey)
+            try:
+                client.info()
+                client.close()
+                break
+            except (OSError, EOFError):
+                if not process.is_alive() or time.time() > deadline:
+                    raise RuntimeError(f"Shard worker {process.name} did not start on {address[0]}:{address[1]}")
+                time.sleep(0.1)
+    logging.info(f"✅ Started {len(processes)} shard workers: "
+                 f"{','.join(f'{host}:{port}' for host, port in addresses)}")
+    return processes, addresses
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve one index shard to a sharded RAG service")
+    parser.add_argument("shard_file", help="Shard index written by --build-shards")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to bind")
+    parser.add_argument("--port", type=int, default=SHARD_BASE_PORT, help="Port to listen on")
+    args = parser.parse_args()
+
+    serve_shard(args.shard_file, (args.host, args.port))
@@ -0,0 +1,190 @@
+# singleflight.py
+import re
+import json
+import asyncio
+import logging
+import threading
+import unicodedata
+
+_space_re = re.compile(r"\s+")
+_trailing_punctuation_re = re.compile(r"[\s?!.]+$")
+
+
+def normalize_query(query):
+    """Folds case, unicode forms, spacing and trailing punctuation so duplicate questions share a key."""
+    query = unicodedata.normalize("NFKC", query).lower()
+    return _trailing_punctuation_re.sub("", _space_re.sub(" ", query).strip())
+
+
+def request_key(query, **params):
+    """Key for a request: the normalised query plus every parameter that changes its result."""
+    return json.dumps([normalize_query(query), params], sort_keys=True, default=str)
+
+
+class SingleFlight:
+    """Coalesces concurrent identical async calls into one shared computation.
+
+    The first caller for a key runs the work; callers arriving while it is in
+    flight await the same result (or exception). Nothing is cached afterwards.
+    """
+
+    def __init__(self, name="singleflight"):
+        self.name = name
+        self.stats = {"leaders": 0, "coalesced": 0}
+        self._calls = {}
+        self._streams = {}
+
+    async def do(self, key, work):
+        """Returns await work(), shared with concurrent callers using the same key."""
+        task = self._calls.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["leaders"] += 1
+            # The work runs as its own task so one caller cancelling does not cancel the others
+            task = asyncio.ensure_future(work())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(task)
+
+    def stream(self, key, make_stream):
+        """Returns an async iterator over make_stream(), shared with concurrent callers.
+
+        Late joiners first replay what has already been produced, then follow live.
+        """
+        shared = self._streams.get(key)
+        if shared is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["leaders"] += 1
+            shared = SharedStream(make_stream(), on_done=lambda: self._streams.pop(key, None))
+            self._streams[key] = shared
+        return shared.subscribe()
+
+    def metrics(self):
+        """Leader and coalesced call counts and the hit rate."""
+        total = self.stats["leaders"] + self.stats["coalesced"]
+        return {
+            **self.stats,
+            "in_flight": len(self._calls) + len(self._streams),
+            "coalesced_rate": round(self.stats["coalesced"] / total, 3) if total else 0.0
+        }
+
+
+class SharedStream:
+    """Fans one async iterator out to several subscribers.
+
+    The source is consumed by a background task. If every subscriber leaves
+    before it finishes, the source is cancelled so no one pays for unread output.
+    """
+
+    def __init__(self, source, on_done=None):
+        self.parts = []
+        self.finished = False
+        self.error = None
+        self._subscribers = 0
+        self._changed = asyncio.Event()
+        self._on_done = on_done
+        self._task = asyncio.ensure_future(self._pump(source))
+
+    async def _pump(self, source):
+        try:
+            async for part in source:
+                self.parts.append(part)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = RuntimeError("Stream was cancelled")
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished = True
+            self._notify()
+            if self._on_done:
+                self._on_done()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self):
+        self._subscribers += 1
+        position = 0
+        try:
+            while True:
+                changed = self._changed
+                while position < len(self.parts):
+                    yield self.parts[position]
+                    position += 1
+                if self.finished:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await changed.wait()
+        finally:
+            self._subscribers -= 1
+            if self._subscribers == 0 and not self.finished:
+                logging.info("All subscribers left a shared stream, cancelling it")
+                self._task.cancel()
+
+
+class ThreadSingleFlight:
+    """SingleFlight for threaded callers, such as concurrent Streamlit sessions."""
+
+    def __init__(self, name="singleflight"):
+        self.name = name
+        self.stats = {"leaders": 0, "coalesced": 0}
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, work):
+        """Returns work(), shared with threads that call with the same key while it runs."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+                self.stats["leaders"] += 1
+            else:
+                self.stats["coalesced"] += 1
+
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = work()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call["done"].set()
+
+    def metrics(self):
+        total = self.stats["leaders"] + self.stats["coalesced"]
+        return {
+            **self.stats,
+            "in_flight": len(self._calls),
+            "coalesced_rate": round(self.stats["coalesced"] / total, 3) if total else 0.0
+        }
+
+
+_groups = {}
+_groups_lock = threading.Lock()
+
+
+def get_group(name):
+    """Returns the process-wide ThreadSingleFlight for a name.
+
+    Streamlit re-executes its scripts on every interaction, so the group has to
+    live in an imported module to be shared between sessions.
+    """
+    with _groups_lock:
+        if name not in _groups:
+            _groups[name] = ThreadSingleFlight(name)
+        return _groups[name]
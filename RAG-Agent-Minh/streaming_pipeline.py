@@ -0,0 +1,228 @@
+# streaming_pipeline.py
+import os
+import time
+import logging
+import argparse
+from datetime import datetime
+
+import numpy as np
+
+from extract_text import iter_directory, DOCS_FOLDER
+from preprocess_text import preprocess_document
+from semantic_chunking import semantic_chunking, document_metadata, OUTPUT_FILE as CHUNKS_FILE
+from chunk_stats import compute_chunk_stats, save_chunk_stats, content_hash
+from context_builder import chunk_token_count
+from vectorize_store_faiss import embed_texts, create_hnsw_index, FAISS_INDEX_FILE, METADATA_FILE
+from embedders import get_embedder, save_index_manifest, write_index
+from chunk_store import write_chunk_store, store_path
+from jsonl_utils import (append_jsonl, iter_jsonl, truncate_jsonl,
+                         write_json_array_from_jsonl, write_json_object_from_jsonl)
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Work files for an in-progress rebuild. The live index, chunks and metadata
+# files are only replaced once the whole corpus has been indexed. Vectors are
+# appended as raw float32 rows, so a checkpoint costs only what it adds.
+PARTIAL_VECTORS_FILE = "faiss_index.partial.f32"
+PARTIAL_CHUNKS_FILE = "processed_chunks.partial.jsonl"
+PARTIAL_METADATA_FILE = "faiss_metadata.partial.jsonl"
+CHECKPOINT_FILE = "pipeline_checkpoint.jsonl"
+
+# Documents embedded between two checkpoints
+CHECKPOINT_EVERY = 5
+
+# Checkpointed vectors added back to the index per step when resuming
+RESUME_BATCH_SIZE = 10000
+
+
+def iter_documents(docs_folder=DOCS_FOLDER, skip=None):
+    """Extract and clean stage: yields cleaned documents one at a time."""
+    for doc in iter_directory(docs_folder, skip=skip):
+        yield preprocess_document(doc)
+
+
+def iter_chunked_documents(documents, use_advanced_pipeline=True):
+    """Chunk stage: yields (document, chunks) pairs."""
+    for doc in documents:
+        metadata = document_metadata(doc)
+        yield doc, semantic_chunking(doc["text"], metadata, use_advanced_pipeline)
+
+
+def iter_embedded_documents(chunked_documents):
+    """Embed stage: yields (document, chunks, vectors) with one vector per kept chunk.
+
+    Each document is embedded in one batched call. If it fails the error is
+    raised, so the rebuild stops and resumes from its last checkpoint instead
+    of checkpointing (and publishing) the corpus without that document.
+    """
+    for doc, chunks in chunked_documents:
+        token_counts = [chunk_token_count(chunk["text"], chunk["metadata"]) for chunk in chunks]
+        try:
+            vectors = embed_texts([chunk["text"] for chunk in chunks], token_counts) if chunks else []
+        except Exception as e:
+            logging.error(f"❌ Failed to embed {doc['filename']}, stopping the rebuild (rerun to resume): {e}")
+            raise
+        for chunk, token_count in zip(chunks, token_counts):
+            chunk["metadata"] = {**chunk["metadata"], "token_count": token_count}
+        yield doc, chunks, vectors
+
+
+def load_checkpoint():
+    """Returns the checkpoint records of a previous, unfinished run."""
+    if not os.path.exists(CHECKPOINT_FILE):
+        return []
+    return list(iter_jsonl(CHECKPOINT_FILE))
+
+
+def discard_partial_state():
+    for path in (PARTIAL_VECTORS_FILE, PARTIAL_CHUNKS_FILE, PARTIAL_METADATA_FILE, CHECKPOINT_FILE):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def restore_partial_state(checkpoints):
+    """Rebuilds the partial index from the checkpointed vectors and trims work files back to the last checkpoint.
+
+    Work files are written in the order chunks -> metadata -> vectors -> checkpoint,
+    so anything past the last checkpoint is an interrupted write and is discarded.
+    Returns (index, ntotal), or None if the work files cannot be resumed.
+    """
+    index = create_hnsw_index()
+    ntotal = checkpoints[-1]["ntotal"] if checkpoints else 0
+    if checkpoints and checkpoints[-1].get("dimension") != index.d:
+        logging.warning("Checkpointed vectors were made by another embedder (or an older pipeline), starting over.")
+        return None
+    row_bytes = index.d * np.dtype(np.float32).itemsize
+    vector_rows = os.path.getsize(PARTIAL_VECTORS_FILE) // row_bytes if os.path.exists(PARTIAL_VECTORS_FILE) else 0
+    if vector_rows < ntotal:
+        logging.warning(f"Only {vector_rows} of {ntotal} checkpointed vectors were found, starting over.")
+        return None
+
+    truncate_jsonl(PARTIAL_CHUNKS_FILE, ntotal)
+    truncate_jsonl(PARTIAL_METADATA_FILE, ntotal)
+    if os.path.exists(PARTIAL_VECTORS_FILE):
+        with open(PARTIAL_VECTORS_FILE, "r+b") as file:
+            file.truncate(ntotal * row_bytes)
+    if ntotal:
+        vectors = np.memmap(PARTIAL_VECTORS_FILE, dtype=np.float32, mode="r", shape=(ntotal, index.d))
+        for start in range(0, ntotal, RESUME_BATCH_SIZE):
+            index.add(np.ascontiguousarray(vectors[start:start + RESUME_BATCH_SIZE]))
+    return index, ntotal
+
+
+def write_checkpoint(index, pending, checkpoint_file):
+    """Appends pending chunks, metadata and vectors, then records the checkpoint."""
+    with open(PARTIAL_CHUNKS_FILE, "a", encoding="utf-8") as chunks_file:
+        append_jsonl(chunks_file, [chunk for entry in pending for chunk in entry["chunks"]])
+    with open(PARTIAL_METADATA_FILE, "a", encoding="utf-8") as metadata_file:
+        append_jsonl(metadata_file, [record for entry in pending for record in entry["metadata"]])
+    with open(PARTIAL_VECTORS_FILE, "ab") as vectors_file:
+        for entry in pending:
+            if len(entry["vectors"]):
+                vectors_file.write(np.ascontiguousarray(entry["vectors"], dtype=np.float32).tobytes())
+        vectors_file.flush()
+        os.fsync(vectors_file.fileno())
+
+    append_jsonl(checkpoint_file, [
+        {"document": entry["document"], "chunks": len(entry["chunks"]), "ntotal": entry["ntotal"],
+         "dimension": index.d}
+        for entry in pending
+    ])
+
+
+def finalize(index):
+    """Publishes the finished rebuild as the live index, chunks and metadata files.
+
+    The index is written once, here, rather than at every checkpoint.
+    """
+    write_json_array_from_jsonl(PARTIAL_CHUNKS_FILE, CHUNKS_FILE)
+    write_json_object_from_jsonl(PARTIAL_METADATA_FILE, METADATA_FILE, key_field="id", value_field="metadata")
+    save_chunk_stats(compute_chunk_stats(iter_jsonl(PARTIAL_CHUNKS_FILE)))
+    write_chunk_store(((chunk["text"], record["metadata"]) for chunk, record
+                       in zip(iter_jsonl(PARTIAL_CHUNKS_FILE), iter_jsonl(PARTIAL_METADATA_FILE))),
+                      store_path(CHUNKS_FILE))
+    write_index(index, FAISS_INDEX_FILE)
+    save_index_manifest(FAISS_INDEX_FILE, get_embedder())
+    discard_partial_state()
+
+
+def run_streaming_rebuild(docs_folder=DOCS_FOLDER, resume=True, checkpoint_every=CHECKPOINT_EVERY,
+                          use_advanced_pipeline=True):
+    """Rebuilds the index by streaming documents through extract -> clean -> chunk -> embed.
+
+    Only one document is in flight at a time and its vectors are checkpointed every
+    few documents, so a failed rebuild resumes after the last checkpoint
+    (with resume=False any previous progress is discarded).
+    """
+    start_time = time.time()
+
+    if not resume:
+        discard_partial_state()
+
+    checkpoints = load_checkpoint()
+    restored = restore_partial_state(checkpoints)
+    if restored is None:
+        discard_partial_state()
+        checkpoints = []
+        restored = restore_partial_state(checkpoints)
+    index, ntotal = restored
+    done = {record["document"] for record in checkpoints}
+    if done:
+        logging.info(f"Resuming rebuild: {len(done)} documents ({ntotal} vectors) already indexed")
+
+    documents = iter_documents(docs_folder, skip=done)
+    pending = []
+    first_chunk_logged = False
+
+    with open(CHECKPOINT_FILE, "a", encoding="utf-8") as checkpoint_file:
+        for doc, chunks, vectors in iter_embedded_documents(iter_chunked_documents(documents, use_advanced_pipeline)):
+            metadata_records = []
+            if len(vectors):
+                vectors = np.asarray(vectors, dtype=np.float32)
+                index.add(vectors)
+                for chunk in chunks:
+                    metadata_records.append({
+                        "id": ntotal,
+                        "metadata": {
+                            **chunk["metadata"],
+                            "ingestion_date": datetime.now().strftime("%Y-%m-%d"),
+                            "content_hash": content_hash(chunk["text"]),
+                            "text_preview": chunk["text"][:200]
+                        }
+                    })
+                    ntotal += 1
+
+            pending.append({"document": doc["filename"], "chunks": chunks, "metadata": metadata_records,
+                            "vectors": vectors, "ntotal": ntotal})
+            logging.info(f"Embedded {len(chunks)} chunks from {doc['filename']} ({ntotal} vectors total)")
+
+            if len(pending) >= checkpoint_every or not first_chunk_logged:
+                write_checkpoint(index, pending, checkpoint_file)
+                pending = []
+                if not first_chunk_logged and ntotal:
+                    logging.info(f"First chunks indexed after {time.time() - start_time:.2f} seconds")
+                    first_chunk_logged = True
+
+        if pending:
+            write_checkpoint(index, pending, checkpoint_file)
+
+    if ntotal == 0:
+        logging.error("❌ No chunks were embedded, keeping the existing index.")
+        return 0
+
+    finalize(index)
+    logging.info(f"✅ Streaming rebuild indexed {ntotal} vectors in {time.time() - start_time:.2f} seconds")
+    return ntotal
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the index by streaming documents through every stage")
+    parser.add_argument("--restart", action="store_true", help="Discard progress from an interrupted rebuild")
+    parser.add_argument("--checkpoint-every", type=int, default=CHECKPOINT_EVERY,
+                        help="Number of documents embedded between checkpoints")
+    parser.add_argument("--chunking-method", choices=["standard", "advanced"], default="advanced",
+                        help="Chunking method to use")
+    args = parser.parse_args()
+
+    run_streaming_rebuild(resume=not args.restart, checkpoint_every=args.checkpoint_every,
+                          use_advanced_pipeline=(args.chunking_method == "advanced"))
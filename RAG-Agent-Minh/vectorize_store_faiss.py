@@ -6,10 +6,12 @@ import faiss
 import numpy as np
 import logging
 from dotenv import load_dotenv
-from openai import OpenAIError, RateLimitError
 from datetime import datetime, timedelta
-from embedding_cache import get_cached_embedding, cache_embedding
-import tiktoken
+from embedders import get_embedder, resolve_embedder, save_index_manifest, refresh_index_manifest, write_index
+from context_builder import get_encoding
+from chunk_stats import load_chunk_stats, compute_chunk_stats, save_chunk_stats
+from chunk_splitter import slice_text, split_oversized_chunks, MAX_CHUNK_TOKENS
+from chunk_store import write_chunk_store, extend_chunk_store, filter_chunk_store, chunk_rows, store_path
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -33,97 +35,34 @@ PROCESSED_FILE = "processed_chunks.json"  # Updated to JSON format
 FAISS_INDEX_FILE = "faiss_index.bin"
 METADATA_FILE = "faiss_metadata.json"  # Store metadata mapping
 
-def get_embedding(text, max_retries=5, max_tokens=8000):
+def fit_embedding_input(text, max_tokens=8000, token_count=None):
     """
-    Generates OpenAI embedding with retries for rate limits, caching, and handling of large texts.
-    Splits text into smaller parts if it exceeds the token limit.
+    Chunks are split to fit the model when they are created (see chunk_splitter), so
+    text that is still too long here, such as a huge query, is truncated.
+    Pass token_count (from chunk_stats.json) to skip tokenising texts that fit.
     """
-    # Check if text is very long - split and average embeddings if needed
-    import tiktoken
-    encoding = tiktoken.get_encoding("cl100k_base")  # OpenAI's encoding for text-embedding-3-large
-    tokens = encoding.encode(text)
-    
-    if len(tokens) > max_tokens:
-        logging.info(f"Text has {len(tokens)} tokens which exceeds {max_tokens}. Splitting and averaging embeddings.")
-        
-        # Split text into smaller parts
-        parts = []
-        current_part = []
-        current_tokens = 0
-        
-        for token in tokens:
-            if current_tokens < max_tokens:
-                current_part.append(token)
-                current_tokens += 1
-            else:
-                parts.append(encoding.decode(current_part))
-                current_part = [token]
-                current_tokens = 1
-        
-        # Add the last part if not empty
-        if current_part:
-            parts.append(encoding.decode(current_part))
-        
-        # Generate embeddings for each part and average them
-        embeddings = []
-        for part in parts:
-            part_embedding = _get_single_embedding(part, max_retries)
-            if part_embedding:
-                embeddings.append(part_embedding)
-        
-        if embeddings:
-            # Convert to numpy for easier averaging
-            np_embeddings = np.array(embeddings)
-            # Calculate average embedding
-            avg_embedding = np.mean(np_embeddings, axis=0).tolist()
-            # Cache the averaged embedding
-            cache_embedding(text, avg_embedding)
-            return avg_embedding
-        else:
-            logging.error("❌ Failed to get embeddings for text parts.")
-            return None
-    
-    # For normal-sized texts, use the regular approach
-    return _get_single_embedding(text, max_retries)
+    if token_count is not None and token_count <= max_tokens:
+        return text
 
-def _get_single_embedding(text, max_retries=5):
-    """Helper function to get embedding for a single piece of text."""
-    # Check cache first
-    cached_embedding = get_cached_embedding(text)
-    if cached_embedding:
-        return cached_embedding
-    
-    # Continue with regular API call if not cached
-    retries = 0
-    while retries < max_retries:
-        try:
-            response = openai.embeddings.create(
-                model="text-embedding-3-large",
-                input=text
-            )
-            embedding = response.data[0].embedding
-            
-            # Cache the new embedding
-            cache_embedding(text, embedding)
-            
-            return embedding
-
-        except RateLimitError:
-            wait_time = 2 ** retries  # Exponential backoff
-            logging.warning(f"⚠ Rate limit hit. Retrying in {wait_time} seconds...")
-            time.sleep(wait_time)
-            retries += 1
-
-        except OpenAIError as e:
-            logging.error(f"❌ OpenAI API error: {e}")
-            break
+    tokens = get_encoding().encode(text, disallowed_special=())  # Cached cl100k_base encoding
+    if len(tokens) > max_tokens:
+        logging.warning(f"Text has {len(tokens)} tokens which exceeds {max_tokens}. Embedding only the first {max_tokens}.")
+        text = slice_text(text, max_tokens, tokens)[0]
+    return text
 
-        except Exception as e:
-            logging.error(f"❌ Unexpected error: {e}")
-            break
+def get_embedding(text, max_tokens=8000, token_count=None, embedder=None):
+    """Embeds one document (with the configured embedder by default); returns None if it fails."""
+    try:
+        embedder = embedder or get_embedder()
+        return embedder.embed([fit_embedding_input(text, max_tokens, token_count)])[0].tolist()
+    except Exception as e:
+        logging.error(f"❌ Failed to get embedding: {e}")
+        return None
 
-    logging.error("❌ Failed to get embedding after multiple retries.")
-    return None
+def embed_texts(texts, token_counts=None):
+    """Embeds many documents in batched calls; returns a float32 matrix."""
+    token_counts = token_counts or [None] * len(texts)
+    return get_embedder().embed([fit_embedding_input(text, token_count=count) for text, count in zip(texts, token_counts)])
 
 def load_chunks(file_path):
     """Loads text chunks and metadata from the processed JSON file."""
@@ -139,6 +78,13 @@ def load_chunks(file_path):
         logging.error(f"❌ Error loading chunks from file: {e}")
         return []
 
+def create_hnsw_index(dimension=None):
+    """Creates the HNSW index used for full builds, sized for the configured embedder."""
+    index = faiss.IndexHNSWFlat(dimension or get_embedder().dimension, 32)  # 32 neighbors per node
+    index.hnsw.efConstruction = 128  # Higher for better accuracy, but slower build
+    index.hnsw.efSearch = 128  # Can be adjusted during search time
+    return index
+
 def store_embeddings_in_faiss(chunks):
     """Generates embeddings and stores them in FAISS with metadata."""
     if not chunks:
@@ -151,16 +97,26 @@ def store_embeddings_in_faiss(chunks):
     logging.info(f"🚀 Embedding process started at: {start_timestamp}")
 
     # Use HNSW index for better performance
-    dimension = 3072  # text-embedding-3-large dimension
-    index = faiss.IndexHNSWFlat(dimension, 32)  # 32 neighbors per node
-    index.hnsw.efConstruction = 128  # Higher for better accuracy, but slower build
-    index.hnsw.efSearch = 128  # Can be adjusted during search time
+    index = create_hnsw_index()
     
     metadata_mapping = {}  # Track chunk ID to metadata mapping
     
     vectors = []
     chunk_ids = []
 
+    # Per-chunk token counts and hashes precomputed at chunking time
+    chunk_stats = load_chunk_stats(chunks=chunks) or compute_chunk_stats(chunks)
+
+    # Chunk files written before oversized chunks were split at chunking time
+    if max(chunk_stats["token_count"], default=0) > MAX_CHUNK_TOKENS:
+        logging.warning(f"⚠ Some chunks exceed {MAX_CHUNK_TOKENS} tokens. Splitting them into separate vectors.")
+        chunks = split_oversized_chunks(chunks)
+        chunk_stats = compute_chunk_stats(chunks)
+        # Vector ids are positions in the chunks file, so rewrite it to match the index
+        with open(PROCESSED_FILE, "w", encoding="utf-8") as file:
+            json.dump(chunks, file, indent=2, ensure_ascii=False)
+        save_chunk_stats(chunk_stats)
+
     # Process chunks in batches to avoid memory issues
     batch_size = 100
     total_chunks = len(chunks)
@@ -171,7 +127,7 @@ def store_embeddings_in_faiss(chunks):
         end_idx = min(start_idx + batch_size, total_chunks)
         batch_chunks = chunks[start_idx:end_idx]
         
-        batch_vectors = []
+        texts = []
         
         for i, chunk in enumerate(batch_chunks):
             chunk_id = start_idx + i
@@ -181,29 +137,35 @@ def store_embeddings_in_faiss(chunks):
             else:
                 text = chunk
                 metadata = {}
-
-            embedding = get_embedding(text)
-            if embedding:
-                batch_vectors.append(embedding)
-                chunk_ids.append(chunk_id)
-                
-                # Store metadata with rich information
-                metadata_mapping[str(chunk_id)] = {
-                    **metadata,
-                    "ingestion_date": datetime.now().strftime("%Y-%m-%d"),
-                    "text_preview": text[:200]
-                }
+            texts.append(text)
+            chunk_ids.append(chunk_id)
+            
+            # Store metadata with rich information
+            metadata_mapping[str(chunk_id)] = {
+                **metadata,
+                "ingestion_date": datetime.now().strftime("%Y-%m-%d"),
+                "token_count": chunk_stats["token_count"][chunk_id],
+                "content_hash": chunk_stats["content_hash"][chunk_id],
+                "text_preview": text[:200]
+            }
         
-        if batch_vectors:
-            vectors_np = np.array(batch_vectors, dtype=np.float32)
-            index.add(vectors_np)
-            logging.info(f"✅ Added batch {batch_idx+1}/{batches} with {len(batch_vectors)} vectors")
+        # One embedding call per batch; a failure aborts the build so vector ids stay aligned with chunks
+        try:
+            vectors_np = embed_texts(texts, chunk_stats["token_count"][start_idx:end_idx])
+        except Exception as e:
+            logging.error(f"❌ Embedding batch {batch_idx+1}/{batches} failed, index not written: {e}")
+            raise
+        index.add(vectors_np)
+        logging.info(f"✅ Added batch {batch_idx+1}/{batches} with {len(texts)} vectors")
     
-    # Save the index and metadata
-    faiss.write_index(index, FAISS_INDEX_FILE)
+    # Save the index, the embedder that built it, and metadata
+    write_index(index, FAISS_INDEX_FILE)
+    save_index_manifest(FAISS_INDEX_FILE, get_embedder())
     
     with open(METADATA_FILE, "w", encoding="utf-8") as meta_file:
         json.dump(metadata_mapping, meta_file, indent=4, ensure_ascii=False)
+    # Compact per-vector texts for serving, which reads only the retrieved rows
+    write_chunk_store(chunk_rows(chunks, metadata_mapping), store_path(PROCESSED_FILE))
     
     end_time = time.time()
     elapsed = end_time - start_time
@@ -225,15 +187,18 @@ def incremental_update(new_chunks):
         next_id = max(map(int, metadata_mapping.keys())) + 1
     
     # Load existing FAISS index if it exists
-    dimension = 3072  # text-embedding-3-large dimension
     if os.path.exists(FAISS_INDEX_FILE):
         index = faiss.read_index(FAISS_INDEX_FILE)
+        # New vectors must come from the embedder that built the index
+        embedder = resolve_embedder(FAISS_INDEX_FILE, index)
     else:
-        index = faiss.IndexFlatL2(dimension)
+        embedder = get_embedder()
+        index = faiss.IndexFlatL2(embedder.dimension)
     
     # Process new chunks
     vectors = []
     new_chunk_ids = []
+    new_rows = []
     
     for i, chunk in enumerate(new_chunks):
         text = chunk["text"]
@@ -247,7 +212,7 @@ def incremental_update(new_chunks):
         elif "/Pepper/" in filepath or "\\Pepper\\" in filepath:
             topic = "Pepper"
         
-        embedding = get_embedding(text)
+        embedding = get_embedding(text, embedder=embedder)
         if embedding:
             vectors.append(embedding)
             chunk_id = next_id + i
@@ -261,16 +226,20 @@ def incremental_update(new_chunks):
                 "ingestion_date": datetime.now().strftime("%Y-%m-%d"),
                 "text_preview": text[:200]
             }
+            new_rows.append((text, metadata_mapping[str(chunk_id)]))
     
     # Add new vectors to the index
     if vectors:
         vectors_np = np.array(vectors, dtype=np.float32)
+        first_id = index.ntotal
         index.add(vectors_np)
-        faiss.write_index(index, FAISS_INDEX_FILE)
+        write_index(index, FAISS_INDEX_FILE)
+        save_index_manifest(FAISS_INDEX_FILE, embedder)
         
         # Save updated metadata
         with open(METADATA_FILE, "w", encoding="utf-8") as meta_file:
             json.dump(metadata_mapping, meta_file, indent=4, ensure_ascii=False)
+        extend_chunk_store(new_rows, first_id, PROCESSED_FILE, METADATA_FILE)
         
         return len(vectors)
     
@@ -290,21 +259,24 @@ def store_client_embeddings(client_chunks, client_id):
         next_id = max(map(int, metadata_mapping.keys())) + 1
     
     # Load existing FAISS index
-    dimension = 3072
     if os.path.exists(FAISS_INDEX_FILE):
         index = faiss.read_index(FAISS_INDEX_FILE)
+        # New vectors must come from the embedder that built the index
+        embedder = resolve_embedder(FAISS_INDEX_FILE, index)
     else:
-        index = faiss.IndexFlatL2(dimension)
+        embedder = get_embedder()
+        index = faiss.IndexFlatL2(embedder.dimension)
     
     # Process client chunks
     vectors = []
     client_chunk_ids = []
+    new_rows = []
     
     for i, chunk in enumerate(client_chunks):
         text = chunk["text"]
         metadata = chunk["metadata"]
         
-        embedding = get_embedding(text)
+        embedding = get_embedding(text, embedder=embedder)
         if embedding:
             vectors.append(embedding)
             chunk_id = next_id + i
@@ -320,16 +292,20 @@ def store_client_embeddings(client_chunks, client_id):
                 "expiry_date": (datetime.now() + timedelta(days=30)).strftime("%Y-%m-%d"), # Example: 30-day access
                 "text_preview": text[:200]
             }
+            new_rows.append((text, metadata_mapping[str(chunk_id)]))
     
     # Add new vectors to the index
     if vectors:
         vectors_np = np.array(vectors, dtype=np.float32)
+        first_id = index.ntotal
         index.add(vectors_np)
-        faiss.write_index(index, FAISS_INDEX_FILE)
+        write_index(index, FAISS_INDEX_FILE)
+        save_index_manifest(FAISS_INDEX_FILE, embedder)
         
         # Save updated metadata
         with open(METADATA_FILE, "w", encoding="utf-8") as meta_file:
             json.dump(metadata_mapping, meta_file, indent=4, ensure_ascii=False)
+        extend_chunk_store(new_rows, first_id, PROCESSED_FILE, METADATA_FILE)
         
         return client_chunk_ids  # Return IDs for later removal
     
@@ -337,8 +313,13 @@ def store_client_embeddings(client_chunks, client_id):
 
 def remove_client_data(client_id):
     """Removes temporary client data from the system."""
-    # This is more complex, as FAISS doesn't directly support removing vectors
-    # A complete solution would require rebuilding the index without those vectors
+    return remove_clients_data([client_id])
+
+def remove_clients_data(client_ids):
+    """Removes temporary data for several clients with a single index rewrite."""
+    # FAISS doesn't directly support removing vectors, so the index is rebuilt
+    # without them. Batching clients means the index is rewritten only once.
+    client_ids = set(client_ids)
     
     # 1. Identify vectors to remove
     metadata_mapping = {}
@@ -346,43 +327,44 @@ def remove_client_data(client_id):
         with open(METADATA_FILE, "r", encoding="utf-8") as meta_file:
             metadata_mapping = json.load(meta_file)
     
-    # Find IDs to remove
-    ids_to_remove = []
-    updated_metadata = {}
-    
-    for chunk_id, metadata in metadata_mapping.items():
-        if metadata.get("client_id") == client_id and metadata.get("temporary", False):
-            ids_to_remove.append(int(chunk_id))
-        else:
-            updated_metadata[chunk_id] = metadata
+    ids_to_remove = {
+        int(chunk_id) for chunk_id, metadata in metadata_mapping.items()
+        if metadata.get("client_id") in client_ids and metadata.get("temporary", False)
+    }
     
     if not ids_to_remove:
         return 0  # Nothing to remove
     
     # 2. Load all vectors that should remain
-    dimension = 3072
     old_index = faiss.read_index(FAISS_INDEX_FILE)
-    new_index = faiss.IndexFlatL2(dimension)
+    new_index = faiss.IndexFlatL2(old_index.d)
     
     # This is efficient only for small to medium indices
     # For very large indices, consider alternative approaches
     all_vectors = old_index.reconstruct_n(0, old_index.ntotal)
+    keep_mask = np.ones(old_index.ntotal, dtype=bool)
+    keep_mask[[i for i in ids_to_remove if i < old_index.ntotal]] = False
     
     # 3. Add back only vectors we want to keep
-    keep_vectors = []
-    for i in range(old_index.ntotal):
-        if i not in ids_to_remove:
-            keep_vectors.append(all_vectors[i])
-    
-    if keep_vectors:
-        keep_vectors_np = np.array(keep_vectors, dtype=np.float32)
-        new_index.add(keep_vectors_np)
+    if keep_mask.any():
+        new_index.add(np.ascontiguousarray(all_vectors[keep_mask], dtype=np.float32))
+    
+    # Vector ids shift down after removal, so renumber the metadata to match
+    new_ids = np.cumsum(keep_mask) - 1
+    updated_metadata = {
+        str(int(new_ids[int(chunk_id)])): metadata
+        for chunk_id, metadata in metadata_mapping.items()
+        if int(chunk_id) < old_index.ntotal and keep_mask[int(chunk_id)]
+    }
     
     # 4. Save updated index and metadata
-    faiss.write_index(new_index, FAISS_INDEX_FILE)
+    write_index(new_index, FAISS_INDEX_FILE)
+    refresh_index_manifest(FAISS_INDEX_FILE)
     with open(METADATA_FILE, "w", encoding="utf-8") as meta_file:
         json.dump(updated_metadata, meta_file, indent=4, ensure_ascii=False)
+    filter_chunk_store(keep_mask, store_path(PROCESSED_FILE))
     
+    logging.info(f"✅ Removed {len(ids_to_remove)} vectors for {len(client_ids)} client(s) in one index rewrite")
     return len(ids_to_remove)
 
 def discover_documents(base_dir="docs", exclude_dirs=["clients", "new", "processed"]):
@@ -443,7 +425,7 @@ def detect_new_documents(documents, last_update_time=None):
 
 def load_new_documents():
     from extract_text import extract_text_from_file
-    from preprocess_text import preprocess_text
+    from preprocess_text import clean_text
     from semantic_chunking import create_semantic_chunks
     """Combined function to discover and process new documents."""
     # First discover all documents
@@ -461,7 +443,7 @@ def load_new_documents():
             extracted_text = extract_text_from_file(doc["path"])
             
             # Preprocess text
-            processed_text = preprocess_text(extracted_text)
+            processed_text = clean_text(extracted_text)
             
             # Create semantic chunks
             chunks = create_semantic_chunks(processed_text)
@@ -488,7 +470,7 @@ def load_new_documents():
 def load_client_chunks(client_files_dir=None, client_id=None):
     """Loads client-specific documents for temporary embedding."""
     from extract_text import extract_text_from_file
-    from preprocess_text import preprocess_text
+    from preprocess_text import clean_text
     from semantic_chunking import create_semantic_chunks
     
     # Determine the client directory path
@@ -511,7 +493,7 @@ def load_client_chunks(client_files_dir=None, client_id=None):
                 extracted_text = extract_text_from_file(file_path)
                 
                 # Preprocess text
-                processed_text = preprocess_text(extracted_text)
+                processed_text = clean_text(extracted_text)
                 # Classify document
                 document_classification = categorize_client_document(file_path, processed_text)
                 # Create semantic chunks
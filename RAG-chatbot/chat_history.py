@@ -0,0 +1,113 @@
+import html
+import itertools
+from collections import deque
+
+# Number of messages kept in session state per conversation
+MAX_MESSAGES = 50
+
+# Number of assistant turns fed back into follow-up prompts
+RECENT_ASSISTANT_TURNS = 3
+
+_attachment_ids = itertools.count()
+
+
+class ChatHistory:
+    """Bounded chat history stored in st.session_state.
+
+    Messages live in a ring buffer so long sessions stay the same size. Large
+    payloads (image thumbnails) are kept in a separate attachment store and
+    referenced by id, and the last few assistant turns are tracked separately
+    so follow-up prompts don't have to rescan the whole conversation. Each
+    message's HTML is rendered once and cached on the message.
+    """
+
+    def __init__(self, max_messages=MAX_MESSAGES, recent_assistant_turns=RECENT_ASSISTANT_TURNS):
+        self.messages = deque()
+        self.max_messages = max_messages
+        self.attachments = {}
+        self.recent_assistant = deque(maxlen=recent_assistant_turns)
+        self.dropped_count = 0
+
+    def append(self, message):
+        """Adds a message, moving image payloads to the attachment store."""
+        message = dict(message)
+        if message.get("type") == "image":
+            attachment_id = next(_attachment_ids)
+            self.attachments[attachment_id] = {
+                "data": message.pop("content"),
+                "mime": message.pop("mime", "image/png")
+            }
+            message["attachment_id"] = attachment_id
+            message["content"] = ""
+
+        self.messages.append(message)
+        if message["role"] == "assistant" and message.get("type") == "text":
+            self.recent_assistant.append(message["content"])
+
+        while len(self.messages) > self.max_messages:
+            evicted = self.messages.popleft()
+            self.attachments.pop(evicted.get("attachment_id"), None)
+            self.dropped_count += 1
+
+    def recent_assistant_messages(self):
+        """Returns the last few assistant text responses, oldest first."""
+        return list(self.recent_assistant)
+
+    def attachment(self, message):
+        """Returns the attachment dict for an image message, or None if it was evicted."""
+        return self.attachments.get(message.get("attachment_id"))
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __len__(self):
+        return len(self.messages)
+
+
+def render_message_html(message, history):
+    """Returns the cached chat bubble HTML for a message, rendering it on first use."""
+    if "html" in message:
+        return message["html"]
+
+    is_user = message["role"] == "user"
+    row_class = "row-reverse" if is_user else ""
+    chat_bubble_class = "human-bubble" if is_user else "ai-bubble"
+    icon_class = "chat-icon-user" if is_user else "chat-icon-ai"
+
+    if message["type"] == "image":
+        attachment = history.attachment(message)
+        if attachment is None:
+            return ""
+        message_content = f'<img src="data:{attachment["mime"]};base64,{attachment["data"]}" width="150">'
+    else:
+        message_content = message["content"]
+
+    message["html"] = f"""
+    <div class="chat-row {row_class}">
+        <div class="chat-icon {icon_class}"></div>
+        <div class="chat-bubble {chat_bubble_class}">
+            {message_content}
+        </div>
+    </div>
+    """
+    return message["html"]
+
+
+def avatar_css(user_avatar_base64, ai_avatar_base64):
+    """Returns CSS that defines the avatar images once per page instead of once per message."""
+    return f"""
+    .chat-icon {{ width: 32px; height: 32px; flex-shrink: 0; background-size: cover; }}
+    .chat-icon-user {{ background-image: url("data:image/png;base64,{user_avatar_base64}"); }}
+    .chat-icon-ai {{ background-image: url("data:image/png;base64,{ai_avatar_base64}"); }}
+    """
+
+
+def render_history_html(history):
+    """Renders the whole visible history as one HTML block."""
+    parts = []
+    if history.dropped_count:
+        parts.append(
+            f'<div class="chat-row"><em>{html.escape(str(history.dropped_count))} earlier messages not shown</em></div>'
+        )
+    parts.extend(render_message_html(message, history) for message in history)
+    return "\n".join(parts)
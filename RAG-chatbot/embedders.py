@@ -0,0 +1,366 @@
+# embedders.py
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+
+try:
+    from embedding_cache import get_cached_embedding, cache_embedding
+except ImportError:  # Apps shipped without the on-disk embedding cache
+    get_cached_embedding = cache_embedding = None
+
+# Which embedder builds and queries the index, as "backend:model"
+EMBEDDER_ENV = "RAG_EMBEDDER"
+DEFAULT_EMBEDDER = "openai:text-embedding-3-large"
+# Without RAG_EMBEDDER, rebuilds keep using the embedder this index was built with
+LIVE_INDEX_FILE = "faiss_index.bin"
+DEFAULT_LOCAL_MODEL = "BAAI/bge-small-en-v1.5"
+
+OPENAI_DIMENSIONS = {
+    "text-embedding-3-large": 3072,
+    "text-embedding-3-small": 1536,
+    "text-embedding-ada-002": 1536,
+}
+
+# BGE models expect this instruction in front of queries (not documents)
+BGE_QUERY_PREFIX = "Represent this sentence for searching relevant passages: "
+
+# Dynamically quantised ONNX weights shipped in sentence-transformers model repos
+ONNX_INT8_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+
+# Local backends and the sentence-transformers runtime each one uses
+LOCAL_RUNTIMES = {
+    "local": ("torch", None),
+    "local-onnx": ("onnx", None),
+    "local-int8": ("onnx", ONNX_INT8_FILE),
+}
+
+
+@lru_cache(maxsize=None)
+def get_async_openai_client():
+    """One AsyncOpenAI client (and connection pool) for the whole process."""
+    from openai import AsyncOpenAI
+    return AsyncOpenAI()
+
+
+class OpenAIEmbedder:
+    """Embeddings from the OpenAI API, cached on disk per model.
+
+    Sync calls go through the openai module's default client and async calls
+    through get_async_openai_client(), so every embedder shares their pools.
+    """
+
+    normalized = True  # OpenAI embeddings are unit length
+
+    def __init__(self, model="text-embedding-3-large", batch_size=100, max_retries=5, use_cache=True):
+        self.backend = "openai"
+        self.model = model
+        self.dimension = OPENAI_DIMENSIONS.get(model)
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.use_cache = use_cache and get_cached_embedding is not None
+
+    def _create(self, texts):
+        import openai
+        for retry in range(self.max_retries):
+            try:
+                return openai.embeddings.create(model=self.model, input=texts)
+            except openai.RateLimitError:
+                wait_time = 2 ** retry  # Exponential backoff
+                logging.warning(f"⚠ Rate limit hit. Retrying in {wait_time} seconds...")
+                time.sleep(wait_time)
+        raise RuntimeError(f"Embedding request still rate limited after {self.max_retries} retries")
+
+    def _cached(self, texts):
+        vectors = [get_cached_embedding(text, self.model) if self.use_cache else None for text in texts]
+        return vectors, [i for i, vector in enumerate(vectors) if vector is None]
+
+    def _fill(self, texts, vectors, batch, response):
+        for i, item in zip(batch, response.data):
+            vectors[i] = item.embedding
+            if self.use_cache:
+                cache_embedding(texts[i], item.embedding, self.model)
+
+    def _matrix(self, vectors):
+        matrix = np.array(vectors, dtype=np.float32).reshape(len(vectors), -1)
+        self.dimension = self.dimension or matrix.shape[1]
+        return matrix
+
+    def embed(self, texts):
+        """Embeds documents; returns a float32 matrix with one row per text."""
+        texts = list(texts)
+        vectors, missing = self._cached(texts)
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            self._fill(texts, vectors, batch, self._create([texts[i] for i in batch]))
+        return self._matrix(vectors)
+
+    async def aembed(self, texts):
+        """embed() for the event loop, on the shared async client (which retries rate limits itself)."""
+        texts = list(texts)
+        vectors, missing = self._cached(texts)
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            response = await get_async_openai_client().embeddings.create(
+                model=self.model, input=[texts[i] for i in batch])
+            self._fill(texts, vectors, batch, response)
+        return self._matrix(vectors)
+
+    def embed_queries(self, texts):
+        return self.embed(texts)
+
+    def embed_query(self, text):
+        return self.embed_queries([text])[0]
+
+    def describe(self):
+        return {"backend": self.backend, "model": self.model, "dimension": self.dimension,
+                "normalized": self.normalized}
+
+
+class LocalEmbedder:
+    """A sentence-transformers model on the local CPU: no network round trip and no API cost.
+
+    backend "local" runs the model with torch, "local-onnx" with ONNX Runtime
+    and "local-int8" with its int8-quantised ONNX weights.
+    """
+
+    normalized = True
+
+    def __init__(self, model=DEFAULT_LOCAL_MODEL, backend="local", batch_size=32, query_prefix=None):
+        if backend not in LOCAL_RUNTIMES:
+            raise ValueError(f"Unknown local embedder backend '{backend}'")
+        self.backend = backend
+        self.model = model
+        self.batch_size = batch_size
+        if query_prefix is None:
+            query_prefix = BGE_QUERY_PREFIX if "bge-" in model.lower() else ""
+        self.query_prefix = query_prefix
+
+    def _model(self):
+        from model_loader import get_sentence_model
+        runtime, onnx_file = LOCAL_RUNTIMES[self.backend]
+        return get_sentence_model(self.model, runtime, onnx_file)
+
+    @property
+    def dimension(self):
+        return self._model().get_sentence_embedding_dimension()
+
+    def embed(self, texts):
+        """Embeds documents; returns a float32 matrix of unit-length rows."""
+        vectors = self._model().encode(list(texts), batch_size=self.batch_size,
+                                       normalize_embeddings=True, convert_to_numpy=True)
+        return np.asarray(vectors, dtype=np.float32)
+
+    async def aembed(self, texts):
+        """embed() off the event loop; the model is CPU bound."""
+        return await asyncio.to_thread(self.embed, list(texts))
+
+    def embed_queries(self, texts):
+        return self.embed([self.query_prefix + text for text in texts])
+
+    def embed_query(self, text):
+        return self.embed_queries([text])[0]
+
+    def describe(self):
+        return {"backend": self.backend, "model": self.model, "dimension": self.dimension,
+                "normalized": self.normalized}
+
+
+def embedder_spec(description):
+    """The "backend:model" spec for an embedder description (as stored in a manifest)."""
+    return f"{description['backend']}:{description['model']}"
+
+
+def parse_embedder_spec(spec):
+    """Splits "backend:model" into (backend, model); a bare model name means OpenAI."""
+    backend, _, model = spec.partition(":")
+    if not model:
+        return "openai", backend
+    return backend, model
+
+
+def create_embedder(spec):
+    backend, model = parse_embedder_spec(spec)
+    if backend == "openai":
+        return OpenAIEmbedder(model)
+    return LocalEmbedder(model, backend)
+
+
+def current_embedder_spec():
+    """The configured embedder: the RAG_EMBEDDER environment variable, else the live index's, else the default.
+
+    Falling back to the live index's manifest keeps rebuilds on the model an
+    embedder migration switched to, instead of re-embedding with the default.
+    """
+    if os.getenv(EMBEDDER_ENV):
+        return os.getenv(EMBEDDER_ENV)
+    manifest = load_index_manifest(LIVE_INDEX_FILE)
+    return embedder_spec(manifest["embedder"]) if manifest else DEFAULT_EMBEDDER
+
+
+_embedders = {}
+_embedders_lock = threading.Lock()
+
+
+def get_embedder(spec=None):
+    """Returns the process-wide embedder for a spec (the configured one by default).
+
+    Streamlit re-executes its scripts on every interaction, so embedders (and
+    the models they load) live here to be shared between reruns and sessions.
+    """
+    spec = spec or current_embedder_spec()
+    with _embedders_lock:
+        if spec not in _embedders:
+            _embedders[spec] = create_embedder(spec)
+        return _embedders[spec]
+
+
+# Index manifests
+
+def index_generation(index_file):
+    """Identifies the build of an index file; changes whenever the file is rewritten.
+
+    Size and mtime survive os.replace, so a file keeps its generation when it is switched in.
+    """
+    if not os.path.exists(index_file):
+        return None
+    stat = os.stat(index_file)
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def manifest_path(index_file):
+    return os.path.splitext(index_file)[0] + ".manifest.json"
+
+
+def save_index_manifest(index_file, embedder):
+    """Records which embedder built an index, next to the index file. Call it after writing the index."""
+    manifest = {
+        "embedder": embedder.describe(),
+        "index_generation": index_generation(index_file),
+        "built_at": datetime.now().isoformat(timespec="seconds")
+    }
+    with open(manifest_path(index_file), "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=4)
+    return manifest
+
+
+def refresh_index_manifest(index_file):
+    """Points an existing manifest at a rewritten index file built with the same embedder."""
+    manifest = load_index_manifest(index_file)
+    if manifest is not None:
+        manifest["index_generation"] = index_generation(index_file)
+        with open(manifest_path(index_file), "w", encoding="utf-8") as file:
+            json.dump(manifest, file, indent=4)
+
+
+def load_index_manifest(index_file):
+    """Returns the manifest written when the index was built, or None for older indexes."""
+    path = manifest_path(index_file)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def check_index_dimension(index, embedder, index_file):
+    """Raises ValueError if the embedder's vectors cannot be searched in the index."""
+    if embedder.dimension is not None and index.d != embedder.dimension:
+        raise ValueError(
+            f"{index_file} holds {index.d}-d vectors but {embedder_spec(embedder.describe())} "
+            f"produces {embedder.dimension}-d vectors. Rebuild the index or use the embedder it was built with."
+        )
+
+
+def resolve_embedder(index_file, index=None):
+    """Returns the shared embedder an index was built with, according to its manifest.
+
+    Indexes built before manifests existed fall back to the configured
+    embedder. Pass the loaded index to check its dimension.
+    """
+    manifest = load_index_manifest(index_file)
+    if manifest is None:
+        embedder = get_embedder()
+    else:
+        spec = embedder_spec(manifest["embedder"])
+        if os.getenv(EMBEDDER_ENV) and os.getenv(EMBEDDER_ENV) != spec:
+            logging.warning(f"⚠ {index_file} was built with {spec}, using it for queries instead of {os.getenv(EMBEDDER_ENV)}")
+        embedder = get_embedder(spec)
+        if manifest["embedder"].get("dimension") and embedder.dimension != manifest["embedder"]["dimension"]:
+            raise ValueError(f"{spec} produces {embedder.dimension}-d vectors but {index_file} was built "
+                             f"with {manifest['embedder']['dimension']}-d vectors")
+    if index is not None:
+        check_index_dimension(index, embedder, index_file)
+    return embedder
+
+
+# Index files
+
+def read_index(index_file, mmap=False):
+    """Reads a FAISS index; with mmap=True it is memory-mapped and read-only.
+
+    A mapped index is not deserialised: its vectors stay in the page cache,
+    shared by every process that maps the same file.
+    """
+    import faiss
+    if not mmap:
+        return faiss.read_index(index_file)
+    # Mapping the vectors in place needs IO_FLAG_MMAP_IFC; plain IO_FLAG_MMAP still copies them
+    flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+    try:
+        return faiss.read_index(index_file, flags)
+    except RuntimeError as e:
+        logging.warning(f"⚠ Could not memory-map {index_file}, loading a private copy: {e}")
+        return faiss.read_index(index_file)
+
+
+def write_index(index, index_file):
+    """Writes an index next to index_file and moves it into place.
+
+    Serving processes map the live file, so it is replaced, never rewritten in place.
+    """
+    import faiss
+    faiss.write_index(index, index_file + ".tmp")
+    os.replace(index_file + ".tmp", index_file)
+
+
+def load_index(index_file, retries=3, mmap=False):
+    """Reads a FAISS index and resolves its query embedder, failing fast if they do not match.
+
+    The index and its manifest are replaced one after the other when a new
+    generation is switched in, so a read that lands in between is retried.
+    """
+    for attempt in range(retries):
+        generation = index_generation(index_file)
+        index = read_index(index_file, mmap)
+        manifest = load_index_manifest(index_file)
+        if manifest is None or manifest.get("index_generation") in (None, generation):
+            break
+        time.sleep(0.05 * (attempt + 1))
+    else:
+        logging.warning(f"⚠ {manifest_path(index_file)} describes another version of {index_file}")
+    return index, resolve_embedder(index_file, index)
+
+
+_open_indexes = {}
+_open_indexes_lock = threading.Lock()
+
+
+def open_index(index_file):
+    """Returns the memory-mapped index and its embedder, opened once per process.
+
+    The index is reopened only when its file is replaced, so Streamlit reruns
+    and sessions share one mapping, and worker processes share its pages.
+    """
+    generation = index_generation(index_file)
+    with _open_indexes_lock:
+        opened = _open_indexes.get(index_file)
+        if opened is None or opened[0] != generation:
+            index, embedder = load_index(index_file, mmap=True)
+            opened = _open_indexes[index_file] = (generation, index, embedder)
+    return opened[1], opened[2]
@@ -0,0 +1,99 @@
+import base64
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageOps
+
+# Target resolution for images sent to the vision assistant
+MAX_UPLOAD_SIDE = 1024
+UPLOAD_QUALITY = 85
+
+# Thumbnails are what gets stored in chat history and rendered inline
+THUMBNAIL_SIDE = 256
+THUMBNAIL_QUALITY = 70
+
+# Diagnosis cache size (entries are small: a file id and a text response)
+MAX_CACHED_IMAGES = 256
+
+_diagnosis_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def content_hash(image_bytes):
+    """Returns a stable hash of the raw image bytes, used to detect re-uploads."""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def _open_image(image_bytes):
+    """Opens image bytes and applies the EXIF orientation so phone photos are upright."""
+    image = Image.open(io.BytesIO(image_bytes))
+    image = ImageOps.exif_transpose(image)
+    return image
+
+
+def _encode(image, max_side, quality):
+    """Downsizes an image to fit within max_side and re-encodes it.
+
+    Images with transparency are kept as PNG, everything else becomes JPEG.
+    Returns the encoded bytes together with the matching file name and MIME type.
+    """
+    image = image.copy()
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+    if has_alpha:
+        image.save(buffer, format="PNG", optimize=True)
+        return buffer.getvalue(), "image.png", "image/png"
+
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue(), "image.jpg", "image/jpeg"
+
+
+def preprocess_image(image_bytes, max_side=MAX_UPLOAD_SIDE, quality=UPLOAD_QUALITY):
+    """Prepares an uploaded image for the vision assistant and for chat display.
+
+    Returns a dict with the content hash of the original bytes, the resized upload
+    payload (bytes, file name, MIME type) and a base64 thumbnail for the chat history.
+    """
+    image = _open_image(image_bytes)
+
+    upload_bytes, upload_name, upload_mime = _encode(image, max_side, quality)
+    # Never upload something larger than what the user gave us
+    if len(upload_bytes) >= len(image_bytes) and max(image.size) <= max_side:
+        upload_bytes = image_bytes
+        upload_mime = Image.MIME.get(image.format, upload_mime)
+        upload_name = f"image.{(image.format or 'png').lower()}"
+
+    thumb_bytes, _, thumb_mime = _encode(image, THUMBNAIL_SIDE, THUMBNAIL_QUALITY)
+
+    return {
+        "hash": content_hash(image_bytes),
+        "upload_bytes": upload_bytes,
+        "upload_name": upload_name,
+        "upload_mime": upload_mime,
+        "thumbnail": base64.b64encode(thumb_bytes).decode("utf-8"),
+        "thumbnail_mime": thumb_mime,
+    }
+
+
+def get_cached_diagnosis(image_hash):
+    """Returns the cached {"file_id", "diagnosis"} entry for an image hash, or None."""
+    with _cache_lock:
+        entry = _diagnosis_cache.get(image_hash)
+        if entry is not None:
+            _diagnosis_cache.move_to_end(image_hash)
+        return entry
+
+
+def cache_diagnosis(image_hash, file_id, diagnosis):
+    """Remembers the uploaded file id and diagnosis for an image hash (LRU bounded)."""
+    with _cache_lock:
+        _diagnosis_cache[image_hash] = {"file_id": file_id, "diagnosis": diagnosis}
+        _diagnosis_cache.move_to_end(image_hash)
+        while len(_diagnosis_cache) > MAX_CACHED_IMAGES:
+            _diagnosis_cache.popitem(last=False)
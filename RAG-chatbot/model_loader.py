@@ -0,0 +1,77 @@
+import os
+import logging
+import threading
+from functools import lru_cache
+
+# Disable TensorFlow unnecessary logs (sentence-transformers may pull it in)
+os.environ.setdefault("TF_ENABLE_ONEDNN_OPTS", "0")
+os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "3")
+
+# Where each NLTK resource lives inside nltk_data
+NLTK_RESOURCE_PATHS = {
+    "punkt": "tokenizers/punkt",
+    "punkt_tab": "tokenizers/punkt_tab",
+    "stopwords": "corpora/stopwords",
+}
+
+DEFAULT_SENTENCE_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+_nltk_lock = threading.Lock()
+_nltk_ready = set()
+
+
+def ensure_nltk_resource(name):
+    """Makes sure an NLTK resource is available, downloading it at most once per process."""
+    if name in _nltk_ready:
+        return
+
+    with _nltk_lock:
+        if name in _nltk_ready:
+            return
+
+        import nltk
+        try:
+            nltk.data.find(NLTK_RESOURCE_PATHS.get(name, name))
+        except LookupError:
+            logging.info(f"Downloading NLTK resource '{name}'...")
+            nltk.download(name, quiet=True)
+        _nltk_ready.add(name)
+
+
+def sent_tokenize(text):
+    """nltk.sent_tokenize with the punkt model loaded on first use."""
+    ensure_nltk_resource("punkt")
+    ensure_nltk_resource("punkt_tab")  # Needed by NLTK 3.8.2 and later
+    import nltk
+    return nltk.sent_tokenize(text)
+
+
+@lru_cache(maxsize=None)
+def get_stopwords(language="english"):
+    """Returns the NLTK stopword list for a language as a frozenset."""
+    ensure_nltk_resource("stopwords")
+    from nltk.corpus import stopwords
+    return frozenset(stopwords.words(language))
+
+
+@lru_cache(maxsize=None)
+def get_sentence_model(model_name=DEFAULT_SENTENCE_MODEL, runtime="torch", onnx_file=None):
+    """Loads a SentenceTransformer model on first use and keeps it for the process.
+
+    runtime="onnx" runs it with ONNX Runtime; onnx_file picks a specific
+    (e.g. quantised) weights file from the model repo.
+    """
+    from sentence_transformers import SentenceTransformer
+    logging.info(f"Loading sentence transformer model {model_name} ({runtime})...")
+    if runtime == "torch":
+        return SentenceTransformer(model_name)
+    model_kwargs = {"file_name": onnx_file} if onnx_file else None
+    return SentenceTransformer(model_name, backend=runtime, model_kwargs=model_kwargs)
+
+
+@lru_cache(maxsize=None)
+def get_cross_encoder(model_name="cross-encoder/ms-marco-MiniLM-L-6-v2"):
+    """Loads a CrossEncoder reranking model on first use and keeps it for the process."""
+    from sentence_transformers import CrossEncoder
+    logging.info(f"Loading cross-encoder model {model_name}...")
+    return CrossEncoder(model_name)
@@ -1,16 +1,19 @@
 import streamlit as st
 import openai
 import os
-import json
-import faiss
 import numpy as np
 import requests
 from dotenv import load_dotenv
 from supabase_config import supabase  # Import global Supabase client
+from image_pipeline import preprocess_image, get_cached_diagnosis, cache_diagnosis
+from chat_history import ChatHistory, avatar_css, render_history_html
+from context_builder import build_context, count_tokens
+from embedders import open_index
+from chunk_store import open_chunk_store
 from PIL import Image
 import io
+import time
 import base64
-from io import BytesIO
 
 
 # Load environment variables
@@ -27,6 +30,8 @@ METADATA_FILE = "faiss_metadata.json"
 
 # OpenAI Assistant ID for disease detection
 ASSISTANT_ID = "asst_EB0lfLqWCH5dDBLSLsMCbTCt"
+# Seconds between checks on an Assistant run
+RUN_POLL_SECONDS = 0.5
 
 # Set OpenAI API key
 openai.api_key = OPENAI_API_KEY
@@ -37,12 +42,6 @@ def load_base64_icon(image_path):
     with open(image_path, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode("utf-8")
 
-def image_to_base64(image):
-    """Convert an image file to a base64-encoded string for embedding in HTML."""
-    image_bytes = BytesIO(image.getvalue())  # Convert image to bytes
-    encoded = base64.b64encode(image_bytes.read()).decode("utf-8")  # Encode to Base64
-    return encoded
-
 # ✅ Load avatar images
 user_avatar_base64 = load_base64_icon("static/user_icon.png")
 ai_avatar_base64 = load_base64_icon("static/ai_icon.png")
@@ -53,7 +52,10 @@ def load_css():
     
     if os.path.exists(css_path):
         with open(css_path, "r") as f:
-            st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
+            st.markdown(
+                f"<style>{f.read()}{avatar_css(user_avatar_base64, ai_avatar_base64)}</style>",
+                unsafe_allow_html=True
+            )
     else:
         st.warning("⚠️ styles.css not found in static/ folder!")
 
@@ -109,17 +111,15 @@ def get_weather(city):
 
 
 def load_faiss_index():
-    """Loads the FAISS index from the saved file."""
-    return faiss.read_index(FAISS_INDEX_FILE)
+    """Returns the memory-mapped index, opened once per process (fails fast on an embedder mismatch)."""
+    index, _ = open_index(FAISS_INDEX_FILE)
+    return index
 
 
 def get_embedding(text):
-    """Generates an embedding for a given query using OpenAI."""
-    response = openai.embeddings.create(
-        model="text-embedding-ada-002",
-        input=text
-    )
-    return np.array(response.data[0].embedding, dtype=np.float32)
+    """Embeds a query with the embedder the open index was built with (see its manifest)."""
+    _, embedder = open_index(FAISS_INDEX_FILE)
+    return embedder.embed_query(text)
 
 
 def search_faiss(query, index, top_k=3):
@@ -130,23 +130,18 @@ def search_faiss(query, index, top_k=3):
     return indices[0], distances[0]
 
 def load_chunks():
-    """Loads text chunks and metadata from JSON files."""
+    """Opens the chunk store; only the retrieved rows are read from it. Stops the page if it cannot be opened."""
     try:
-        with open(PROCESSED_FILE, "r", encoding="utf-8") as file:
-            chunks = json.load(file)
-
-        with open(METADATA_FILE, "r", encoding="utf-8") as meta_file:
-            metadata_mapping = json.load(meta_file)
-
-        return chunks, metadata_mapping  # Returns both text chunks and metadata
+        return open_chunk_store(PROCESSED_FILE, METADATA_FILE)
     except Exception as e:
-        return [], {}
+        st.error(f"⚠ Could not load the knowledge base chunks: {e}")
+        st.stop()
 
 
 def query_rag_system(user_query, city):
     """Queries FAISS, retrieves relevant text, and generates a response with GPT-4."""
     index = load_faiss_index()
-    chunks, metadata_mapping = load_chunks()
+    chunk_store = load_chunks()
 
     # Get weather data
     weather_info = get_weather(city)
@@ -155,8 +150,9 @@ def query_rag_system(user_query, city):
 
     indices, distances = search_faiss(user_query, index, top_k=3)
 
-    retrieved_chunks = [chunks[idx]["text"] for idx in indices]
-    retrieved_metadata = [metadata_mapping[str(idx)] for idx in indices]  # Fix: Ensure correct metadata retrieval
+    rows = chunk_store.get_many([idx for idx in indices if 0 <= idx < len(chunk_store)])
+    retrieved_chunks = [row["text"] for row in rows]
+    retrieved_metadata = [row["metadata"] for row in rows]
 
     ai_response = generate_rag_response(user_query, retrieved_chunks, retrieved_metadata, weather_info)
 
@@ -183,17 +179,21 @@ def generate_rag_response():
     print(weather_section)
     # ✅ Retrieve FAISS Knowledge
     index = load_faiss_index()
-    chunks, metadata_mapping = load_chunks()
+    chunk_store = load_chunks()
     indices, distances = search_faiss(disease_diagnosis, index, top_k=3)
 
-    retrieved_chunks = [chunks[idx]["text"] for idx in indices]
-    retrieved_metadata = [metadata_mapping[str(idx)] for idx in indices]
+    rows = chunk_store.get_many([idx for idx in indices if 0 <= idx < len(chunk_store)])
+    retrieved_chunks = [row["text"] for row in rows]
+    retrieved_metadata = [row["metadata"] for row in rows]
 
-    # ✅ Prepare Knowledge Section with Sources
-    knowledge_section = "\n".join(
-        [f"📌 **Source {i+1}:** {metadata['filename']} ({metadata['file_type']})\n{chunk}"
-        for i, (chunk, metadata) in enumerate(zip(retrieved_chunks, retrieved_metadata))]
-    )
+    # ✅ Prepare Knowledge Section with Sources, packed into the token budget
+    knowledge_section = build_context(
+        retrieved_chunks,
+        retrieved_metadata,
+        format_chunk=lambda i, chunk, metadata: ("\n" if i else "") + f"📌 **Source {i+1}:** {metadata['filename']} ({metadata['file_type']})\n{chunk}",
+        format_citation=lambda i, metadata: "",
+        reserved_tokens=count_tokens(disease_diagnosis) + count_tokens(weather_section)
+    )["context"]
 
     # ✅ Generate Structured AI Response using GPT-4
     rag_prompt = f"""
@@ -254,7 +254,7 @@ def chat_ui():
 
     # ✅ Ensure session state variables
     if "chat_history" not in st.session_state:
-        st.session_state.chat_history = []
+        st.session_state.chat_history = ChatHistory()
     if "selected_farm" not in st.session_state:
         st.session_state.selected_farm = None
     if "farm_data" not in st.session_state:
@@ -282,26 +282,8 @@ def chat_ui():
     # ✅ Display chat history
     chat_placeholder = st.container()
     with chat_placeholder:
-        for message in st.session_state.chat_history:
-            row_class = "row-reverse" if message["role"] == "user" else ""
-            chat_bubble_class = "human-bubble" if message["role"] == "user" else "ai-bubble"
-            avatar_base64 = user_avatar_base64 if message["role"] == "user" else ai_avatar_base64
-            
-            # ✅ Correctly handle images and text
-            if message["type"] == "image":
-                message_content = f'<img src="data:image/png;base64,{message["content"]}" width="150">'
-            else:
-                message_content = message["content"]
-
-            div = f"""
-            <div class="chat-row {row_class}">
-                <img class="chat-icon" src="data:image/png;base64,{avatar_base64}" width="32" height="32">
-                <div class="chat-bubble {chat_bubble_class}">
-                    {message_content}
-                </div>
-            </div>
-            """
-            st.markdown(div, unsafe_allow_html=True)
+        # ✅ Each message's HTML is rendered once and cached; avatars come from CSS
+        st.markdown(render_history_html(st.session_state.chat_history), unsafe_allow_html=True)
 
     # ✅ Handle new text input
     # ✅ Handle new text input
@@ -316,9 +298,7 @@ def chat_ui():
         })
 
         # ✅ Retrieve past conversation context for follow-up response
-        previous_context = "\n".join([
-            msg["content"] for msg in st.session_state.chat_history if msg["role"] == "assistant"
-        ][-3:])
+        previous_context = "\n".join(st.session_state.chat_history.recent_assistant_messages())
 
         # ✅ Build prompt for AI with context
         followup_prompt = f"""
@@ -364,18 +344,23 @@ def chat_ui():
         st.session_state.image_processing_done = True
         st.session_state.last_uploaded_image = uploaded_image
 
-        # ✅ Convert image to Base64 before storing it in chat history
-        image_base64 = image_to_base64(uploaded_image)
-        st.session_state.chat_history.append({"role": "user", "type": "image", "content": image_base64})
+        # ✅ Downsize once, keep only a thumbnail in chat history
+        processed_image = preprocess_image(uploaded_image.getvalue())
+        st.session_state.chat_history.append({
+            "role": "user",
+            "type": "image",
+            "content": processed_image["thumbnail"],
+            "mime": processed_image["thumbnail_mime"]
+        })
 
         # ✅ Display uploaded image
         with st.chat_message("user"):
-            st.image(uploaded_image, width=100)
+            st.image(base64.b64decode(processed_image["thumbnail"]), width=100)
 
         # ✅ Step 1: Process image with OpenAI Assistant (Disease Detection)
         with st.chat_message("assistant"):
             with st.spinner("🧐 Analyzing image... Please wait."):
-                disease_diagnosis = analyze_image_with_openai(uploaded_image)  # ✅ Get disease diagnosis
+                disease_diagnosis = analyze_image_with_openai(uploaded_image, processed_image)  # ✅ Get disease diagnosis
         
         # ✅ Show only the diagnosis (RAG will be triggered later)
         st.session_state["last_ai_response"] = disease_diagnosis  # ✅ Store AI diagnosis
@@ -451,7 +436,7 @@ def chat_ui():
                     st.markdown(st.session_state["rag_response"])
 
         # ✅ Store response in chat history if not already there
-        if not any(msg["content"] == st.session_state["rag_response"] for msg in st.session_state.chat_history):
+        if st.session_state["rag_response"] not in st.session_state.chat_history.recent_assistant_messages():
             st.session_state.chat_history.append({
                 "role": "assistant",
                 "type": "text",
@@ -476,10 +461,16 @@ def send_message(user_prompt, selected_image):
         st.session_state.chat_history.append({"role": "user", "type": "text", "content": user_prompt})
 
     if selected_image:
-        st.session_state.chat_history.append({"role": "user", "type": "image", "content": selected_image})
+        processed_image = preprocess_image(selected_image.getvalue())
+        st.session_state.chat_history.append({
+            "role": "user",
+            "type": "image",
+            "content": processed_image["thumbnail"],
+            "mime": processed_image["thumbnail_mime"]
+        })
 
         with st.spinner("🧐 Analyzing image... Please wait."):
-            analysis_result = analyze_image_with_openai(selected_image)
+            analysis_result = analyze_image_with_openai(selected_image, processed_image)
         st.session_state.chat_history.append({"role": "assistant", "type": "text", "content": f"💡 **AI Diagnosis:** {analysis_result}"})
 
     # ✅ Force Streamlit to rerun, so messages appear immediately
@@ -487,15 +478,30 @@ def send_message(user_prompt, selected_image):
 
 
 
-def analyze_image_with_openai(uploaded_image):
-    """Sends an uploaded image to OpenAI Assistant for disease detection and returns AI response."""
+def analyze_image_with_openai(uploaded_image, processed_image=None):
+    """Sends an uploaded image to OpenAI Assistant for disease detection and returns AI response.
+
+    Images are downsized before upload and deduplicated by content hash, so a
+    re-uploaded photo reuses its earlier file id and diagnosis.
+    """
     try:
-        # ✅ Read the uploaded image as bytes
-        image_bytes = uploaded_image.getvalue()
+        # ✅ Downsize and hash the image (reuse the caller's result if available)
+        if processed_image is None:
+            processed_image = preprocess_image(uploaded_image.getvalue())
+
+        # ✅ Same photo seen before: skip the upload and the assistant run
+        cached = get_cached_diagnosis(processed_image["hash"])
+        if cached:
+            st.session_state.last_ai_response = cached["diagnosis"]
+            return cached["diagnosis"]
 
         # ✅ Upload image to OpenAI storage (for vision analysis)
         uploaded_file = openai.files.create(
-            file=("coffee_leaf.png", io.BytesIO(image_bytes), "image/png"),  # ✅ Convert to proper format
+            file=(
+                f"coffee_leaf_{processed_image['upload_name']}",
+                io.BytesIO(processed_image["upload_bytes"]),
+                processed_image["upload_mime"]
+            ),
             purpose="vision"
         )
 
@@ -520,13 +526,18 @@ def analyze_image_with_openai(uploaded_image):
 
         # ✅ Wait for Assistant to finish processing
         while run.status in ["queued", "in_progress"]:
+            time.sleep(RUN_POLL_SECONDS)
             run = openai.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
 
+        # ✅ Failed, expired or cancelled runs have no diagnosis to show (or cache)
+        if run.status != "completed":
+            return f"**⚠ Image analysis did not complete (status: {run.status}).**"
+
         # ✅ Retrieve messages from the assistant
         messages = openai.beta.threads.messages.list(thread_id=thread.id)
 
-        # ✅ Ensure response is received
-        if not messages.data:
+        # ✅ Ensure response is received (the newest message is the user's prompt if the Assistant did not answer)
+        if not messages.data or messages.data[0].role != "assistant":
             return "**⚠ No response received from AI.**"
 
         # ✅ Extract AI response in Markdown format
@@ -535,6 +546,9 @@ def analyze_image_with_openai(uploaded_image):
         # ✅ Store AI diagnosis in session state to use later in RAG
         st.session_state.last_ai_response = response_text  # ✅ Ensures it's available after farm selection
 
+        # ✅ Remember the diagnosis for re-uploads of the same photo
+        cache_diagnosis(processed_image["hash"], uploaded_file.id, response_text)
+
         return response_text  # ✅ Direct Markdown response
 
     except Exception as e: